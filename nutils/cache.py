@@ -11,21 +11,39 @@ The cache module.
 """
 
 from . import core, log, rational
-import os, sys, weakref, numpy, functools
+import os, sys, weakref, numpy, functools, itertools, threading
 
 
 _property = property
 
+class _Pending( object ):
+  'placeholder of a property under construction, by the recorded thread'
+
+  __slots__ = 'thread',
+
+  def __init__( self ):
+    self.thread = threading.get_ident()
+
+_publishlock = threading.Lock()
+
 def property( f ):
   name = f.__name__
-  def property_getter( self, name=name, f=f, tmp=object() ):
+  def property_getter( self, name=name, f=f ):
     try:
       value = self.__dict__[name]
-      assert value is not tmp, 'attribute requested during construction'
     except KeyError:
-      self.__dict__[name] = tmp
-      value = f( self )
-      self.__dict__[name] = value
+      self.__dict__.setdefault( name, _Pending() )
+    else:
+      if not isinstance( value, _Pending ):
+        return value
+      assert value.thread != threading.get_ident(), 'attribute requested during construction'
+    value = f( self ) # also if another thread is constructing, as waiting could deadlock
+    with _publishlock: # the first value to be completed is shared by all threads
+      current = self.__dict__[name]
+      if isinstance( current, _Pending ):
+        self.__dict__[name] = value
+      else:
+        value = current
     return value
   def property_setter( self, value, name=name ):
     assert name not in self.__dict__, 'property can be set only once'
@@ -202,6 +220,8 @@ class CallDict( object ):
   def summary( self ):
     return self.wrappercache.stats
 
+_serials = itertools.count()
+
 class ImmutableMeta( type ):
   def __init__( cls, *args, **kwargs ):
     type.__init__( cls, *args, **kwargs )
@@ -212,6 +232,7 @@ class ImmutableMeta( type ):
       self = cls.cache[key]
     except KeyError:
       self = type.__call__( cls, *args, **kwargs )
+      self._serial = next( _serials ) # creation order, reproducible unlike id
       cls.cache[key] = self
     return self
 
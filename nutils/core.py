@@ -11,10 +11,13 @@ The core module provides a collection of low level constructs that have no
 dependencies on other nutils modules. Primarily for internal use.
 """
 
-import sys, functools, os
+import sys, functools, os, threading
 
 globalproperties = {
   'nprocs': 1,
+  'parallel': 'fork',
+  'chunksize': 1,
+  'nplans': 4,
   'outrootdir': '~/public_html',
   'outdir': '.',
   'verbose': 6,
@@ -42,6 +45,31 @@ for nutilsrc in ['~/.config/nutils/config', '~/.nutilsrc']:
   break
 
 _nodefault = object()
+class _Scopes( threading.local ):
+  'per thread stack of properties contexts'
+
+  def __init__( self ):
+    self.stack = []
+
+_scopes = _Scopes()
+
+def _getscope():
+  '''Innermost properties context of the current thread as a (frame, props)
+  tuple, or (None, {}) if none was entered.'''
+
+  stack = _scopes.stack
+  return stack[-1] if stack else ( None, {} )
+
+def _collect( frame, stop, props ):
+  '''Add the properties held by the locals of frame and its parents up to
+  stop to the props dictionary, without overriding newer values.'''
+
+  while frame is not None and frame is not stop:
+    for key, value in frame.f_locals.items():
+      if len(key) > 4 and key.startswith('__') and key.endswith('__'):
+        props.setdefault( key[2:-2], value )
+    frame = frame.f_back
+
 def getprop( name, default=_nodefault, frame=None ):
   """Access a semi-global property.
 
@@ -56,6 +84,12 @@ def getprop( name, default=_nodefault, frame=None ):
   >>>   __myval__ = 2
   >>>   f()
 
+  Properties can also be set in a :class:`properties` context. Locals of
+  calling frames are searched only up to the frame that entered the innermost
+  context, which holds all properties visible at that point in a dictionary.
+  Since every function decorated with log.title enters such a context, the
+  cost of a lookup does not depend on the depth of the call stack.
+
   Args:
       name (str): Property name, corresponds to __name__ local variable.
       default: Optional default value.
@@ -67,18 +101,71 @@ def getprop( name, default=_nodefault, frame=None ):
   """
 
   key = '__%s__' % name
+  stop, props = _getscope()
   if frame is None:
     frame = sys._getframe(1)
-  while frame:
+  while frame is not None and frame is not stop:
     if key in frame.f_locals:
       return frame.f_locals[key]
     frame = frame.f_back
+  if name in props:
+    return props[name]
   if name in globalproperties:
     return globalproperties[name]
   if default is _nodefault:
     raise NameError( 'property %r is not defined' % name )
   return default
 
+def getprops( frame=None ):
+  '''Dictionary of all properties visible from frame except for the global
+  defaults, for instance to be set in a properties context of another
+  thread.'''
+
+  if frame is None:
+    frame = sys._getframe(1)
+  stop, scopeprops = _getscope()
+  props = {}
+  _collect( frame, stop, props )
+  for name, value in scopeprops.items():
+    props.setdefault( name, value )
+  return props
+
+class properties( object ):
+  '''Context in which the keyword arguments are set as properties.
+
+  >>> with properties( nprocs=4 ):
+  >>>   f() # getprop('nprocs') returns 4
+
+  On entering, the properties are merged with all properties that are visible
+  at that point, including those of enclosing contexts and the locals of
+  enclosing frames. Locals that the entering frame assigns within the context
+  are therefore not visible, but locals of frames that are called from it
+  are, and take precedence. Contexts are local to the thread that enters
+  them.'''
+
+  def __init__( self, **props ):
+    'constructor'
+
+    self.props = props
+
+  def __enter__( self ):
+    frame = sys._getframe(1)
+    stop, scopeprops = _getscope()
+    props = self.props.copy()
+    _collect( frame, stop, props )
+    for name, value in scopeprops.items():
+      props.setdefault( name, value )
+    self._scope = frame, props
+    _scopes.stack.append( self._scope )
+    return self
+
+  def __exit__( self, *exc_info ):
+    stack = _scopes.stack
+    i = len(stack) - 1
+    while stack[i] is not self._scope: # exited out of order, e.g. from a generator
+      i -= 1
+    del stack[i]
+
 def getoutdir():
   outdir = getprop( 'outdir' )
   if not os.path.isdir( outdir ):
@@ -250,7 +250,28 @@ class Reference( cache.Immutable ):
   def edgevertexmap( self ):
     return [ numpy.array( list( map( self.vertices.tolist().index, etrans.apply(edge.vertices).tolist() ) ), dtype=int ) for etrans, edge in self.edges ]
 
+  @cache.property
+  def _ischemes( self ):
+    return {}
+
   def getischeme( self, ischeme ):
+    '''get integration points and weights
+
+    Results are stored on the reference and returned as read-only arrays,
+    such that repeated requests yield the very same point set. This allows
+    evaluation of shape functions to be tabulated once per point set.'''
+
+    try:
+      return self._ischemes[ischeme]
+    except KeyError:
+      pass
+    points, weights = self._getischeme( ischeme )
+    points = _readonly( points )
+    weights = _readonly( weights )
+    self._ischemes[ischeme] = points, weights
+    return points, weights
+
+  def _getischeme( self, ischeme ):
     match = re.match( '([a-zA-Z]+)(.*)', ischeme )
     assert match, 'cannot parse integration scheme %r' % ischeme
     ptype, args = match.groups()
@@ -259,8 +280,15 @@ class Reference( cache.Immutable ):
 
   @classmethod
   def register( cls, ptype, func ):
+    '''register func as integration scheme ptype. Composite references such
+    as trimmed elements use a registered scheme directly, rather than forming
+    it from the schemes of their parts.'''
+
     setattr( cls, 'getischeme_%s' % ptype, func )
 
+  def _isregistered( self, ischeme ):
+    return hasattr( self, 'getischeme_' + re.match( '[a-zA-Z]*', ischeme ).group() )
+
   def with_children( self, child_refs ):
     child_refs = tuple(child_refs)
     if not any( child_refs ):
@@ -493,7 +521,7 @@ class PointReference( SimplexReference ):
   def child_refs( self ):
     return self,
 
-  def getischeme( self, ischeme ):
+  def _getischeme( self, ischeme ):
     return numpy.zeros((1,0)), numpy.ones(1)
 
 class LineReference( SimplexReference ):
@@ -654,7 +682,7 @@ class TriangleReference( SimplexReference ):
     points = numpy.asarray( points, dtype=float )
     assert points.ndim == 2 and points.shape[1] == self.ndims
     baricentric = numpy.linalg.solve( self.vertices[1:]-self.vertices[0], (points-self.vertices[0]).T ).T
-    return (baricentric >= -eps).all() and (baricentric <= 1+eps).all() and (baricentric.sum(1) <= 1+eps).all()
+    return ( (baricentric >= -eps) & (baricentric <= 1+eps) ).all( axis=1 ) & ( baricentric.sum(1) <= 1+eps )
 
 class TetrahedronReference( SimplexReference ):
   '3D simplex'
@@ -789,7 +817,7 @@ class TensorReference( Reference ):
     z = numpy.zeros_like( p )
     return numpy.hstack(( [p,z], [1-z,p], [1-p,1-z], [z,1-p] )).T, None
 
-  def getischeme( self, ischeme ):
+  def _getischeme( self, ischeme ):
     if '*' in ischeme:
       ischeme1, ischeme2 = ischeme.split( '*', 1 )
     else:
@@ -891,7 +919,7 @@ class Cone( Reference ):
     if core.getprop( 'selfcheck', False ):
       self.check_edges()
 
-  @property
+  @cache.property
   def volume( self ):
     return self.edgeref.volume * self.extnorm * self.height / self.ndims
 
@@ -922,14 +950,14 @@ class Cone( Reference ):
 
   def getischeme_gauss( self, degree ):
     if self.nverts == self.ndims+1: # simplex
-      spoints, sweights = getsimplex(self.ndims).getischeme_gauss( degree )
+      spoints, sweights = getsimplex(self.ndims).getischeme( 'gauss{}'.format(degree) )
       offset = self.vertices[0,:]
       linear = self.vertices[1:,:] - offset
       points = numpy.dot( spoints, linear ) + offset
       weights = sweights * abs(numpy.linalg.det(linear))
     else:
       epoints, eweights = self.edgeref.getischeme( 'gauss{}'.format(degree) )
-      tpoints, tweights = getsimplex(1).getischeme_gauss( degree + self.ndims - 1 )
+      tpoints, tweights = getsimplex(1).getischeme( 'gauss{}'.format( degree + self.ndims - 1 ) )
       tx, = tpoints.T
       points = ( tx[:,_,_] * (self.etrans.apply(epoints)-self.tip)[_,:,:] + self.tip ).reshape( -1, self.ndims )
       wx = tx**(self.ndims-1) * tweights * self.extnorm * self.height
@@ -938,7 +966,7 @@ class Cone( Reference ):
 
   def getischeme_bezier( self, degree ):
     assert self.nverts == self.ndims+1
-    spoints, none = getsimplex(self.ndims).getischeme_bezier( degree )
+    spoints, none = getsimplex(self.ndims).getischeme( 'bezier{}'.format(degree) )
     offset = self.vertices[0,:]
     linear = self.vertices[1:,:] - offset
     return numpy.dot( spoints, linear ) + offset, None
@@ -1121,7 +1149,7 @@ class OwnChildReference( Reference ):
   def volume( self ):
     return self.baseref.volume
 
-  def getischeme( self, ischeme ):
+  def _getischeme( self, ischeme ):
     return self.baseref.getischeme( ischeme )
 
   @property
@@ -1169,7 +1197,7 @@ class WithChildrenReference( Reference ):
       child_refs.append( self.child_refs[index].transform( rtrans ) )
     return WithChildrenReference( baseref, child_refs )
 
-  @property
+  @cache.property
   def volume( self ):
     return sum( abs(trans.det) * ref.volume for trans, ref in self.children )
 
@@ -1210,9 +1238,12 @@ class WithChildrenReference( Reference ):
         rng = numpy.array([],dtype=int)
     return npoints, rng
 
-  def getischeme( self, ischeme ):
+  def _getischeme( self, ischeme ):
     'get integration scheme'
     
+    if self._isregistered( ischeme ):
+      return Reference._getischeme( self, ischeme )
+
     if ischeme.startswith('vertex'):
       ischeme = 'vertex%d' % (int(ischeme[6:])-1)
 
@@ -1415,7 +1446,7 @@ class MosaicReference( Reference ):
   def stdfunc( self, degree ):
     return self.baseref.stdfunc( degree )
 
-  @property
+  @cache.property
   def volume( self ):
     return sum( subref.volume for subref in self.subrefs )
 
@@ -1423,9 +1454,12 @@ class MosaicReference( Reference ):
   def simplices( self ):
     return [ simplex for subvol in self.subrefs for simplex in subvol.simplices ]
 
-  def getischeme( self, ischeme ):
+  def _getischeme( self, ischeme ):
     'get integration scheme'
     
+    if self._isregistered( ischeme ):
+      return Reference._getischeme( self, ischeme )
+
     if ischeme.startswith('vertex'):
       assert ischeme=='vertex' or ischeme=='vertex0'
       return self.vertices, None
@@ -1440,6 +1474,30 @@ class MosaicReference( Reference ):
     return points, weights
 
 
+def getischeme_moment( self, degree ):
+  '''moment fitted integration scheme
+
+  Returns the gauss points of the untrimmed parent reference that exactly
+  integrate its shape functions of given degree, and weights such that these
+  shape functions have the same integrals as on the (trimmed) reference. The
+  resulting scheme integrates polynomials up to degree exactly, at the number
+  of points of a regular element.'''
+
+  baseref = self
+  while hasattr( baseref, 'baseref' ):
+    baseref = baseref.baseref
+  points, weights = baseref.getischeme( 'gauss%d' % (2*degree) )
+  if baseref is self:
+    return points, weights
+  stdfunc = baseref.stdfunc( degree )
+  cutpoints, cutweights = self.getischeme( 'gauss%d' % (degree*self.ndims) )
+  moments = numeric.dot( cutweights, stdfunc.eval( cutpoints ) )
+  weights, res, rank, sv = numpy.linalg.lstsq( stdfunc.eval( points ).T, moments, rcond=-1 )
+  return points, weights
+
+Reference.register( 'moment', getischeme_moment )
+
+
 # SHAPE FUNCTIONS
 
 class StdElem( cache.Immutable ):
@@ -1465,6 +1523,12 @@ class StdElem( cache.Immutable ):
 
     return ExtractionWrapper( self, extraction )
 
+  def contract( self, points, coeffs, grad=0 ):
+    '''contraction of the shape functions (or their gradients) with the columns
+    of the nshapes x k coefficient array coeffs, of shape (npoints,k)+(ndims,)*grad'''
+
+    return numpy.rollaxis( numpy.tensordot( self.eval( points, grad ), coeffs, (1,0) ), -1, 1 )
+
 class PolyProduct( StdElem ):
   'multiply standard elements'
 
@@ -1498,9 +1562,58 @@ class PolyProduct( StdElem ):
     N = numpy.newaxis,
 
     shape = points.shape[:-1] + (self.std1.nshapes * self.std2.nshapes,)
-    G12 = [ ( self.std1.eval( p1, grad=i )[E+S+N+S*i+N*j]
-            * self.std2.eval( p2, grad=j )[E+N+S+N*i+S*j] ).reshape( shape + (self.std1.ndims,) * i + (self.std2.ndims,) * j )
-            for i,j in zip( range(grad,-1,-1), range(grad+1) ) ]
+    factors = _tensorfactors( p1, p2 )
+    if factors:
+      # Points form a tensor grid, so both factors need to be evaluated only
+      # on their own unique coordinates, after which the full table is formed
+      # as an outer product over points and shapes simultaneously.
+      u1, u2 = factors
+      G12 = [ ( self.std1.eval( u1, grad=i )[S+N+S+N+S*i+N*j]
+              * self.std2.eval( u2, grad=j )[N+S+N+S+N*i+S*j] ).reshape( shape + (self.std1.ndims,) * i + (self.std2.ndims,) * j )
+              for i,j in zip( range(grad,-1,-1), range(grad+1) ) ]
+    else:
+      G12 = [ ( self.std1.eval( p1, grad=i )[E+S+N+S*i+N*j]
+              * self.std2.eval( p2, grad=j )[E+N+S+N*i+S*j] ).reshape( shape + (self.std1.ndims,) * i + (self.std2.ndims,) * j )
+              for i,j in zip( range(grad,-1,-1), range(grad+1) ) ]
+
+    return self._gradients( G12, shape, grad )
+
+  def contract( self, points, coeffs, grad=0 ):
+    '''contraction with coefficients, by sum factorization if the points form
+    a tensor grid: the coefficients are contracted with the shape functions of
+    the second factor first, and the result with those of the first factor.
+    For p+1 shapes and q points per dimension this costs O(q p^(d+1)) rather
+    than the O(q^d p^d) of contracting the full table.'''
+
+    assert coeffs.shape[0] == self.nshapes
+    factors = _tensorfactors( points[:,:self.std1.ndims], points[:,self.std1.ndims:] )
+    if not factors:
+      return StdElem.contract( self, points, coeffs, grad )
+
+    u1, u2 = factors
+    n1 = self.std1.nshapes
+    n2 = self.std2.nshapes
+    k = coeffs.shape[1]
+    C = coeffs.reshape( n1, n2, k ).swapaxes( 0, 1 ).reshape( n2, n1*k )
+    G12 = []
+    for i, j in zip( range(grad,-1,-1), range(grad+1) ):
+      C2 = self.std2.contract( u2, C, j ) # q2, n1*k, d2*j
+      C2 = numpy.rollaxis( C2.reshape( (len(u2),n1,k) + C2.shape[2:] ), 1 ).reshape( n1, -1 )
+      C12 = self.std1.contract( u1, C2, i ) # q1, q2*k*d2*j, d1*i
+      C12 = C12.reshape( (len(u1),len(u2),k) + (self.std2.ndims,)*j + (self.std1.ndims,)*i )
+      C12 = C12.transpose( [0,1,2] + list( range(3+j,3+j+i) ) + list( range(3,3+j) ) )
+      G12.append( C12.reshape( (len(points),k) + C12.shape[3:] ) )
+
+    return self._gradients( G12, (len(points),k), grad )
+
+  def _gradients( self, G12, shape, grad ):
+    '''combine the gradients G12 of the products of both factors, where the
+    iprod-th item holds grad-iprod derivatives to the first factor followed by
+    iprod derivatives to the second, into an array of all gradients'''
+
+    E = Ellipsis,
+    s1 = slice(0,self.std1.ndims)
+    s2 = slice(self.std1.ndims,None)
 
     data = numpy.empty( shape + (self.ndims,) * grad )
 
@@ -1509,7 +1622,7 @@ class PolyProduct( StdElem ):
     for n in range(2**grad):
       index = n>>R&1
       n = index.argsort() # index[s] = [0,...,1]
-      shuffle = list( range(points.ndim) ) + list( points.ndim + n )
+      shuffle = list( range(len(shape)) ) + list( len(shape) + n )
       iprod = index.sum()
       data.transpose(shuffle)[E+s[iprod:iprod+grad]] = G12[iprod]
 
@@ -1776,6 +1889,33 @@ class ExtractionWrapper( StdElem ):
 
 # UTILITY FUNCTIONS
 
+def _tensorfactors( p1, p2 ):
+  '''unique coordinates (u1,u2) if points [p1,p2] form a tensor grid with the
+  first factor running slowest, as produced by TensorReference, else None'''
+
+  if p1.ndim != 2 or len(p1) < 2:
+    return None
+  npoints = len(p1)
+  changes = numpy.any( p1[1:] != p1[:1], axis=1 )
+  n2 = changes.argmax() + 1 if changes.any() else npoints
+  if n2 == 1 or npoints % n2:
+    return None
+  n1 = npoints // n2
+  P1 = p1.reshape( n1, n2, -1 )
+  P2 = p2.reshape( n1, n2, -1 )
+  if not ( P1 == P1[:,:1] ).all() or not ( P2 == P2[:1] ).all():
+    return None
+  return P1[:,0], P2[0]
+
+def _readonly( array ):
+  'read-only view of array, None if array is None'
+
+  if array is None:
+    return None
+  array = numpy.asarray( array ).view()
+  array.flags.writeable = False
+  return array
+
 _gauss = []
 def gauss( degree ):
   n = degree // 2
@@ -31,13 +31,14 @@ expensive and currently unsupported operation.
 """
 
 from . import util, numpy, numeric, log, core, cache, transform, rational, _
-import sys, warnings, itertools, functools, operator, inspect, numbers
+import sys, warnings, itertools, functools, operator, inspect, numbers, weakref, collections.abc
 
 CACHE = 'Cache'
 TRANS = 'Trans'
 POINTS = 'Points'
+INDEX = 'Index'
 
-TOKENS = CACHE, TRANS, POINTS
+TOKENS = CACHE, TRANS, POINTS, INDEX
 
 class Evaluable( cache.Immutable ):
   'Base class'
@@ -60,29 +61,36 @@ class Evaluable( cache.Immutable ):
     '''returns (ops,inds), where len(ops) = len(inds)-1'''
 
     myops = list( TOKENS )
+    myindex = { token: i for i, token in enumerate( TOKENS ) }
     myinds = []
     indices = []
     for arg in self.__args:
       try:
-        index = myops.index( arg )
-      except ValueError:
+        index = myindex[arg]
+      except KeyError:
         argops, arginds = arg.serialized
         renumber = list( range( len(TOKENS) ) )
         for op, ind in zip( argops, arginds ):
           try:
-            n = myops.index( op )
-          except ValueError:
-            n = len(myops)
+            n = myindex[op]
+          except KeyError:
+            n = myindex[op] = len(myops)
             myops.append( op )
             myinds.append( numpy.take(renumber,ind) )
           renumber.append( n )
-        index = len(myops)
+        index = myindex[arg] = len(myops)
         myops.append( arg )
         myinds.append( numpy.take(renumber,arginds[-1]) )
       indices.append( index )
     myinds.append( indices )
     return tuple(myops[len(TOKENS):]), tuple(myinds)
 
+  @cache.property
+  def plan( self ):
+    'compiled evaluation plan'
+
+    return EvaluationPlan( self )
+
   def asciitree( self, seen=None ):
     'string representation'
 
@@ -126,42 +134,25 @@ class Evaluable( cache.Immutable ):
       points = ischeme
     else:
       trans = elem.transform, elem.opposite
-      if isinstance( ischeme, dict ):
-        ischeme = ischeme[elem]
-      if isinstance( ischeme, str ):
-        points, weights = fcache[elem.reference.getischeme]( ischeme )
-      elif isinstance( ischeme, tuple ):
-        points, weights = ischeme
-        assert points.shape[-1] == elem.ndims
-        assert points.shape[:-1] == weights.shape, 'non matching shapes: points.shape=%s, weights.shape=%s' % ( points.shape, weights.shape )
-      elif isinstance( ischeme, numpy.ndarray ):
-        points = ischeme.astype( float )
-        assert points.shape[-1] == elem.ndims
-      elif ischeme is None:
-        points = None
-      else:
-        raise Exception( 'invalid integration scheme of type %r' % type(ischeme) )
+      points, weights = _getpoints( elem, ischeme, fcache )
 
-    if trans is not None:
-      assert trans[0].fromdims == trans[1].fromdims
-    if points is not None:
-      assert points.ndim == 2 and points.shape[1] == trans[0].fromdims
+    return self.plan.evaluate( fcache, trans, points )
 
-    ops, inds = self.serialized
-    assert TOKENS == ( CACHE, TRANS, POINTS )
-    values = [ fcache, trans, points ]
-    for op, indices in zip( list(ops)+[self], inds ):
-      args = [ values[i] for i in indices ]
-      try:
-        retval = op.evalf( *args )
-      except KeyboardInterrupt:
-        raise
-      except:
-        etype, evalue, traceback = sys.exc_info()
-        excargs = etype, evalue, self, values
-        raise EvaluationError(*excargs).with_traceback( traceback )
-      values.append( retval )
-    return values[-1]
+  def elemeval( self, items, ischeme, fcache=cache.WrapperDummyCache(), edict=None ):
+    '''evaluate on a sequence of elements
+
+    Evaluates on every element of the ``items`` iterable, which yields pairs
+    of a free identifier (typically the element index) and an element, taking
+    points and weights from ischeme as in eval. If the transform index edict
+    of the iterated topology is given, the identifiers must be the element
+    indices in edict, which functions defined on the same topology then use
+    directly instead of looking up the transform. Yields (identifier, weights,
+    value) triplets in order.'''
+
+    for ident, elem in items:
+      points, weights = _getpoints( elem, ischeme, fcache )
+      value = self.plan.evaluate( fcache, (elem.transform,elem.opposite), points, None if edict is None else (edict,ident) )
+      yield ident, weights, value
 
   @log.title
   def graphviz( self ):
@@ -216,6 +207,108 @@ class Evaluable( cache.Immutable ):
   def _edit( self, op ):
     return self
 
+class EvaluationPlan( object ):
+  '''compiled evaluation plan
+
+  Flattened form of the serialized graph of an evaluable, built once per
+  evaluable and reused for every element. Besides the operations and their
+  argument indices the plan holds, per operation, the list of values that
+  are used for the last time, such that intermediate arrays are released as
+  soon as they are no longer needed rather than at the end of the
+  evaluation. This limits peak memory to the live set of the graph.'''
+
+  def __init__( self, evaluable ):
+    'constructor'
+
+    ops, inds = evaluable.serialized
+    self.evaluable = evaluable
+    self.ops = ops + (evaluable,)
+    self.inds = tuple( tuple(indices) for indices in inds )
+    lastuse = {}
+    for iop, indices in enumerate( self.inds ):
+      for i in indices:
+        if i >= len(TOKENS):
+          lastuse[i] = iop
+    release = [ [] for iop in self.ops ]
+    for i, iop in lastuse.items():
+      release[iop].append( i )
+    self.release = tuple( tuple(sorted(r)) for r in release )
+
+  @property
+  def peak( self ):
+    'maximum number of simultaneously held intermediate values'
+
+    nlive = numpy.cumsum( [ 1 - len(release) for release in self.release ] )
+    return int( ( nlive + [ len(release) for release in self.release ] ).max() )
+
+  def evaluate( self, fcache, trans, points, index=None ):
+    '''evaluate the plan for the given cache, transformation pair and points,
+    and optionally the (edict,ielem) pair that gives the element index of the
+    transformation in the transform index of its topology'''
+
+    if trans is not None:
+      assert trans[0].fromdims == trans[1].fromdims
+    if points is not None:
+      assert points.ndim == 2 and points.shape[1] == trans[0].fromdims
+
+    assert TOKENS == ( CACHE, TRANS, POINTS, INDEX )
+    values = [ fcache, trans, points, index ]
+    for op, indices, release in zip( self.ops, self.inds, self.release ):
+      args = [ values[i] for i in indices ]
+      try:
+        retval = op.evalf( *args )
+      except KeyboardInterrupt:
+        raise
+      except:
+        etype, evalue, traceback = sys.exc_info()
+        excargs = etype, evalue, self.evaluable, values
+        raise EvaluationError(*excargs).with_traceback( traceback )
+      for i in release:
+        values[i] = None
+      values.append( retval )
+    return values[-1]
+
+_tables = collections.OrderedDict()
+def _tabulate( std, tail, points, igrad ):
+  '''shape functions of std evaluated in tail-transformed points, tabulated
+  for read-only point sets such as obtained from getischeme, keeping the most
+  recently used tables, the number of which is set by the ntables property'''
+
+  key = id(points), std, tail, igrad
+  try:
+    ref, F = _tables.pop( key )
+  except KeyError:
+    ref = None
+  if ref is None or ref() is not points:
+    F = std.eval( tail.apply( points ), igrad )
+    F.flags.writeable = False
+    ref = weakref.ref( points )
+    while len(_tables) >= core.getprop( 'ntables', 1024 ):
+      _tables.popitem( last=False )
+  _tables[key] = ref, F
+  return F
+
+def _getpoints( elem, ischeme, fcache ):
+  'obtain points and weights for an element from an integration scheme'
+
+  if isinstance( ischeme, dict ):
+    ischeme = ischeme[elem]
+  if isinstance( ischeme, str ):
+    points, weights = fcache[elem.reference.getischeme]( ischeme )
+  elif isinstance( ischeme, tuple ):
+    points, weights = ischeme
+    assert points.shape[-1] == elem.ndims
+    assert points.shape[:-1] == weights.shape, 'non matching shapes: points.shape=%s, weights.shape=%s' % ( points.shape, weights.shape )
+  elif isinstance( ischeme, numpy.ndarray ):
+    points = ischeme.astype( float )
+    weights = None
+    assert points.shape[-1] == elem.ndims
+  elif ischeme is None:
+    points = weights = None
+  else:
+    raise Exception( 'invalid integration scheme of type %r' % type(ischeme) )
+  return points, weights
+
 class EvaluationError( Exception ):
   'evaluation error'
 
@@ -308,6 +401,82 @@ class TransformChain( Evaluable ):
   def evalf( self, trans ):
     return trans[ self.side ].promote( self.promote )
 
+class ElemIndex( Evaluable ):
+  '''head of the transform found in a transform index, and its element index,
+  taken directly from the index token if the element loop runs over the
+  topology of the same transform index'''
+
+  def __init__( self, edict, side=0 ):
+    assert isinstance( edict, transform.TransformIndex )
+    self.edict = edict
+    self.side = side
+    Evaluable.__init__( self, args=[INDEX,TransformChain(side,edict.fromdims)] )
+
+  def evalf( self, index, trans ):
+    if index is not None and self.side == 0 and index[0] is self.edict:
+      return trans, index[1]
+    head = trans.lookup( self.edict )
+    return head, self.edict[head]
+
+class IndexedMap( collections.abc.Mapping ):
+  '''read-only transform -> value mapping by dense element index
+
+  Values are obtained as getitem(ielem), typically the __getitem__ of a list
+  or CSRTable, where ielem follows from edict, the transform index of the
+  topology that is shared by all its bases. Functions and dof maps that are
+  backed by an IndexedMap obtain ielem once per evaluation, via ElemIndex,
+  from the element loop or else by a single transform lookup, rather than
+  searching every map by transform.'''
+
+  def __init__( self, edict, getitem ):
+    'constructor'
+
+    assert isinstance( edict, transform.TransformIndex )
+    self.edict = edict
+    self.getitem = getitem
+
+  def __getitem__( self, trans ):
+    return self.getitem( self.edict[trans] )
+
+  def __contains__( self, trans ):
+    return trans in self.edict
+
+  def __iter__( self ):
+    return iter( self.edict )
+
+  def __len__( self ):
+    return len( self.edict )
+
+class CSRTable( object ):
+  '''rows of varying length in compressed sparse row format: row i is
+  values[offsets[i]:offsets[i+1]]'''
+
+  def __init__( self, offsets, values ):
+    'constructor'
+
+    self.offsets = numpy.asarray( offsets, dtype=int )
+    self.values = numpy.asarray( values )
+    assert self.offsets.ndim == 1 and self.offsets[0] == 0 and self.offsets[-1] == len(self.values)
+
+  @classmethod
+  def fromrows( cls, rows, dtype=int ):
+    'form table from a sequence of arrays'
+
+    rows = [ numpy.asarray( row, dtype=dtype ) for row in rows ]
+    offsets = numpy.cumsum( [0] + [ len(row) for row in rows ] )
+    return cls( offsets, numpy.concatenate( rows ) if rows else numpy.zeros( 0, dtype=dtype ) )
+
+  def __getitem__( self, i ):
+    return self.values[ self.offsets[i]:self.offsets[i+1] ]
+
+  def __len__( self ):
+    return len( self.offsets ) - 1
+
+  def select( self, mask ):
+    'concatenated values of the rows selected by boolean mask'
+
+    return self.values[ numpy.repeat( mask, numpy.diff( self.offsets ) ) ]
+
 
 # ARRAYFUNC
 #
@@ -670,15 +839,23 @@ class DofMap( Array ):
 
     self.side = side
     self.dofmap = dofmap
-    for trans in dofmap:
-      break
+    self.indexed = isinstance( dofmap, IndexedMap )
+    if self.indexed:
+      args = [ ElemIndex(dofmap.edict,side) ]
+    else:
+      for trans in dofmap:
+        break
+      args = [ TransformChain(side,trans.fromdims) ]
 
-    Array.__init__( self, args=[TransformChain(side,trans.fromdims)], shape=(length,), dtype=int )
+    Array.__init__( self, args=args, shape=(length,), dtype=int )
 
-  def evalf( self, trans ):
+  def evalf( self, where ):
     'evaluate'
 
-    return self.dofmap[ trans.lookup(self.dofmap) ][_]
+    if self.indexed:
+      head, ielem = where
+      return self.dofmap.getitem( ielem )[_]
+    return self.dofmap[ where.lookup(self.dofmap) ][_]
 
   def _opposite( self ):
     return DofMap( self.dofmap, self.shape[0], 1-self.side )
@@ -929,31 +1106,51 @@ class Function( Array ):
     self.localcoords = LocalCoords( self.ndims, side=self.side ) # only an implicit dependency for now
     for trans in stdmap:
       break
-    Array.__init__( self, args=(CACHE,POINTS,TransformChain(side,trans.fromdims)), shape=(length,)+(ndims,)*igrad, dtype=float )
+    args = [ CACHE, POINTS, TransformChain(side,trans.fromdims) ]
+    if isinstance( stdmap, IndexedMap ):
+      args.append( ElemIndex(stdmap.edict,side) )
+    Array.__init__( self, args=args, shape=(length,)+(ndims,)*igrad, dtype=float )
 
-  def evalf( self, cache, points, trans ):
+  def evalf( self, cache, points, trans, index=None ):
     'evaluate'
 
     fvals = []
-    head = trans.lookup( self.stdmap )
-    for std, keep in self.stdmap[head]:
+    head, stdkeep = self._stdkeep( trans, index )
+    for std, keep in stdkeep:
       if std:
-        transpoints = cache[trans.slicefrom(len(head)).apply]( points )
-        F = cache[std.eval]( transpoints, self.igrad )
+        if points.flags.writeable:
+          transpoints = cache[trans.slicefrom(len(head)).apply]( points )
+          F = cache[std.eval]( transpoints, self.igrad )
+        else:
+          F = _tabulate( std, trans.slicefrom(len(head)), points, self.igrad )
         assert F.ndim == self.igrad+2
         if keep is not None:
           F = F[(Ellipsis,keep)+(slice(None),)*self.igrad]
-        if self.igrad:
-          invlinear = head.split(head.fromdims)[1].invlinear
-          if invlinear.ndim:
-            for axis in range(-self.igrad,0):
-              F = numeric.dot( F, invlinear, axis )
-          elif invlinear != 1:
-            F = F * (invlinear**self.igrad)
-        fvals.append( F )
+        fvals.append( self._gradtransform( F, head ) )
       head = head.sliceto(-1)
     return fvals[0] if len(fvals) == 1 else numpy.concatenate( fvals, axis=-1-self.igrad )
 
+  def _stdkeep( self, trans, index ):
+    'head of trans in stdmap and its (stdelem,keep) tuples'
+
+    if index is not None:
+      head, ielem = index
+      return head, self.stdmap.getitem( ielem )
+    head = trans.lookup( self.stdmap )
+    return head, self.stdmap[head]
+
+  def _gradtransform( self, F, head ):
+    'transform gradients in the trailing igrad axes of F from the coordinate system of head'
+
+    if self.igrad:
+      invlinear = head.split(head.fromdims)[1].invlinear
+      if invlinear.ndim:
+        for axis in range(-self.igrad,0):
+          F = numeric.dot( F, invlinear, axis )
+      elif invlinear != 1:
+        F = F * (invlinear**self.igrad)
+    return F
+
   def _opposite( self ):
     return Function( self.ndims, self.stdmap, self.igrad, self.shape[0], 1-self.side )
 
@@ -964,7 +1161,8 @@ class Function( Array ):
   def _take( self, indices, axis ):
     if axis != 0:
       return
-    stdmap = {}
+    indexed = isinstance( self.stdmap, IndexedMap )
+    stdmap = [ None ] * len(self.stdmap) if indexed else {}
     for trans, stdkeep in self.stdmap.items():
       ind, = indices.eval( trans )
       assert all( numpy.diff( ind ) > 0 )
@@ -988,9 +1186,68 @@ class Function( Array ):
           where = where[n:]
         newstdkeep.append(( std, keep ))
       assert not where.size
-      stdmap[trans] = newstdkeep
+      stdmap[ self.stdmap.edict[trans] if indexed else trans ] = newstdkeep
+    if indexed:
+      stdmap = IndexedMap( self.stdmap.edict, stdmap.__getitem__ )
     return Function( self.ndims, stdmap, self.igrad, indices.shape[0], side=self.side )
 
+class FunctionDot( Array ):
+  '''contraction of a Function over its shape functions with coefficients that
+  are constant within the element, as formed by optimize from dot products
+  such as that of a basis with a vector of dofs. The shape functions are not
+  tabulated but contracted through StdElem.contract, which for tensor product
+  elements and points on a tensor grid contracts one dimension at a time.
+  Small tables of read-only points, up to maxtable points times shapes, are
+  still tabulated and contracted whole, which is faster at low orders.'''
+
+  maxtable = 4096
+
+  def __init__( self, func, coeffs ):
+    'constructor'
+
+    assert isinstance( func, Function ) and isinstance( coeffs, Array )
+    assert coeffs.shape[-1] == func.shape[0] and all( n == 1 for n in coeffs.shape[:-1] )
+    self.func = func
+    self.coeffs = coeffs
+    for trans in func.stdmap:
+      break
+    args = [ CACHE, POINTS, TransformChain(func.side,trans.fromdims), coeffs ]
+    if isinstance( func.stdmap, IndexedMap ):
+      args.append( ElemIndex(func.stdmap.edict,func.side) )
+    Array.__init__( self, args=args, shape=func.shape[1:], dtype=float )
+
+  def evalf( self, cache, points, trans, coeffs, index=None ):
+    'evaluate'
+
+    coeffs = coeffs.reshape( coeffs.shape[0], -1 )
+    if len(coeffs) != 1: # coefficients vary within the element
+      F = self.func.evalf( cache, points, trans, index )
+      return numeric.contract( F, coeffs[(Ellipsis,)+(_,)*self.func.igrad], axis=1 )
+    coeffs = coeffs[0]
+    retval = 0
+    offset = 0
+    head, stdkeep = self.func._stdkeep( trans, index )
+    for std, keep in stdkeep:
+      if std:
+        n = std.nshapes if keep is None else keep.sum()
+        c = coeffs[offset:offset+n]
+        if keep is not None:
+          c = numpy.zeros( std.nshapes )
+          c[keep] = coeffs[offset:offset+n]
+        offset += n
+        tail = trans.slicefrom(len(head))
+        if not points.flags.writeable and len(points) * std.nshapes <= self.maxtable:
+          F = numpy.tensordot( _tabulate( std, tail, points, self.func.igrad ), c, (1,0) )
+        else:
+          F = std.contract( tail.apply( points ), c[:,_], self.func.igrad )[:,0]
+        retval += self.func._gradtransform( F, head )
+      head = head.sliceto(-1)
+    assert offset == len(coeffs)
+    return retval
+
+  def _edit( self, op ):
+    return FunctionDot( op(self.func), op(self.coeffs) )
+
 class Choose( Array ):
   'piecewise function'
 
@@ -2529,7 +2786,7 @@ _abs = abs
 _ascending = lambda arg: ( numpy.diff(arg) > 0 ).all()
 _normdims = lambda ndim, shapes: tuple( numeric.normdim(ndim,sh) for sh in shapes )
 _taketuple = lambda values, index: tuple( values[i] for i in index )
-_issorted = lambda a, b: not isevaluable(b) or isevaluable(a) and id(a) <= id(b)
+_issorted = lambda a, b: not isevaluable(b) or isevaluable(a) and a._serial <= b._serial
 _sorted = lambda a, b: (a,b) if _issorted(a,b) else (b,a)
 
 def _jointshape( shape, *shapes ):
@@ -3447,6 +3704,81 @@ def opposite( arg ):
 
   return arg._edit( opposite )
 
+def optimize( arg ):
+  '''canonicalize for common subexpression elimination
+
+  Rebuilds the tree of ``arg`` with chains of additions and multiplications
+  flattened and refolded in canonical order, such that algebraically equal
+  subtrees that were constructed differently, e.g. (a*b)*c and a*(c*b),
+  become identical objects. The operands of a dot are treated as one chain of
+  multiplications, such that dot(a*b,c) and dot(a,c*b) coincide as well, and a
+  function that is contracted over its shapes with coefficients, such as a
+  basis with a vector of dofs, becomes a FunctionDot. The
+  order is that of creation of the operands, which unlike their id does not
+  vary between runs, and which fixes the order of floating point operations.
+  Identical objects are evaluated only once, also between the items of a
+  Tuple, through the deduplication in serialized.'''
+
+  optimized = {}
+  def op( f ):
+    if not isevaluable( f ):
+      return f
+    try:
+      return optimized[f]
+    except KeyError:
+      pass
+    if isinstance( f, (Add,Multiply) ):
+      cls = type(f)
+      terms = sorted( ( op(term) for term in _flatten( f, cls ) ), key=_creationorder )
+      retval = functools.reduce( add if cls is Add else multiply, terms )
+    elif isinstance( f, Dot ):
+      terms = sorted( ( op(term) for func in f.funcs for term in ( _flatten( func, Multiply ) if isinstance( func, Multiply ) else [func] ) ), key=_creationorder )
+      retval = _functiondot( terms, f.axes )
+      if retval is None:
+        retval = dot( functools.reduce( multiply, terms[:-1] ), terms[-1], f.axes )
+    else:
+      retval = f._edit( op )
+    optimized[f] = retval
+    return retval
+  return op( arg )
+
+def _functiondot( terms, axes ):
+  '''FunctionDot times the remaining terms, if the terms of a dot over a single
+  axis are a function with its shapes along that axis, coefficients that are
+  constant along all other axes, and further terms that are constant along
+  the shapes; None otherwise'''
+
+  if len(axes) != 1 or not all( isinstance( term, Array ) for term in terms ):
+    return None
+  func = coeffs = None
+  others = []
+  for term in terms:
+    shapefunc = term.func if isinstance( term, Align ) and term.axes == (term.ndim-1,)+tuple(range(term.ndim-1)) else term if term.ndim == 1 else None
+    if func is None and isinstance( shapefunc, Function ):
+      func = shapefunc
+    elif coeffs is None and term.shape[-1] != 1 and all( n == 1 for n in term.shape[:-1] ):
+      coeffs = term
+    elif term.shape[-1] == 1:
+      others.append( term )
+    else:
+      return None
+  if func is None or coeffs is None or coeffs.shape[-1] != func.shape[0]:
+    return None
+  retval = FunctionDot( func, coeffs )
+  if others:
+    retval = multiply( retval, sum( functools.reduce( multiply, others ), -1 ) )
+  return retval
+
+def _flatten( arg, cls ):
+  'operands of nested binary operations of type cls'
+
+  return [ term for func in arg.funcs for term in ( _flatten(func,cls) if isinstance(func,cls) else [func] ) ]
+
+def _creationorder( arg ):
+  'sort key placing evaluables in order of creation, followed by constants'
+
+  return ( 0, arg._serial ) if isevaluable( arg ) else ( 1, 0 )
+
 def function( fmap, nmap, ndofs, ndims ):
   'create function on ndims-element'
 
@@ -3538,7 +3870,6 @@ def pointdata ( topo, ischeme, func=None, shape=None, value=None ):
 
   data = {}
   for elem in topo:
-    # TODO use cache for getischeme
     ipoints, iweights = elem.reference.getischeme( ischeme )
     values = numpy.empty( ipoints.shape[:-1]+shape, dtype=float )
     values[:] = func.eval(elem,ischeme) if func is not None else value
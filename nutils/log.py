@@ -12,7 +12,7 @@ The log module provides print methods ``debug``, ``info``, ``user``,
 stdout as well as to an html formatted log file if so configured.
 """
 
-import sys, time, warnings, functools, itertools, re
+import sys, time, warnings, functools, itertools, re, threading
 from . import core
 
 warnings.showwarning = lambda message, category, filename, lineno, *args: \
@@ -23,10 +23,38 @@ LEVELS = 'path', 'error', 'warning', 'user', 'info', 'progress', 'debug'
 
 ## LOG
 
+class _ThreadContext( threading.local ):
+  'per thread context stack'
+
+  def __init__( self ):
+    self.stack = []
+
 class Log( object ):
   '''The log object is what is stored in the __log__ property. It should define
   a push function to add a contextual layer, a pop method to remove it, and a
-  write method.'''
+  write method.
+
+  The context attribute is local to the thread that accesses it, such that
+  worker threads that share a log do not push and pop each other's titles.
+  A thread starts from an empty context; parallel sets that of its workers to
+  a copy of the context of the calling thread.'''
+
+  @property
+  def context( self ):
+    return self._threadcontext.stack
+
+  @context.setter
+  def context( self, context ):
+    try:
+      threadcontext = self._threadcontext
+    except AttributeError:
+      threadcontext = self._threadcontext = _ThreadContext()
+    threadcontext.stack = context
+
+  def contexts( self ):
+    'context stacks of the current thread, for modification in place'
+
+    return [ self.context ]
 
 class StdoutLog( Log ):
   '''Output plain text to stream.'''
@@ -107,6 +135,15 @@ class TeeLog( Log ):
   def __init__( self, *logs ):
     self.logs = logs
 
+  @property
+  def context( self ):
+    return self.logs[0].context if self.logs else []
+
+  @context.setter
+  def context( self, context ):
+    for log in self.logs:
+      log.context = list( context )
+
   def push( self, title ):
     for log in self.logs:
       log.push(title)
@@ -115,6 +152,9 @@ class TeeLog( Log ):
     for log in self.logs:
       log.pop()
 
+  def contexts( self ):
+    return [ context for log in self.logs for context in log.contexts() ]
+
   def write( self, level, text ):
     for log in self.logs:
       log.write( level, text )
@@ -160,30 +200,64 @@ def _len( iterable ):
   except:
     return None
 
-def _logiter( text, iterator, length=None ):
-  dt = core.getprop( 'progress_interval', 1. )
-  dtexp = core.getprop( 'progress_interval_scale', 2 )
-  dtmax = core.getprop( 'progress_interval_max', 0 )
-  tnext = time.time() + dt
-  log = _getlog()
-  index = 0
-  for item in iterator:
-    title = '%s %d' % ( text, index )
-    if length is not None:
-      title += '/%d (%d%%)' % ( length, (index-.5) * 100. / length )
-    index += 1
+class _Progress( object ):
+  '''Sampled progress logger. Iterating pushes a single log context for the
+  duration of the loop, the title of which shows the current item but is
+  updated, in place, only when the clock is read. To keep the overhead per
+  item low the clock is read once every stride items, with stride adapted to
+  the observed iteration rate such that this happens about ten times per
+  progress interval. The number of items consumed and the iteration rate in
+  items per second, as of the last reading of the clock, are available as
+  the index and rate attributes.'''
+
+  def __init__( self, text, iterator, length=None ):
+    self.text = text
+    self.iterator = iterator
+    self.length = length
+    self.index = 0
+    self.rate = None
+
+  def _title( self ):
+    title = '%s %d' % ( self.text, self.index )
+    if self.length:
+      title += '/%d (%d%%)' % ( self.length, (self.index-.5) * 100. / self.length )
+    return title
+
+  def __iter__( self ):
+    dt = core.getprop( 'progress_interval', 1. )
+    dtexp = core.getprop( 'progress_interval_scale', 2 )
+    dtmax = core.getprop( 'progress_interval_max', 0 )
+    log = _getlog()
+    tstart = time.time()
+    tnext = tstart + dt
+    stride = icheck = 1
+    title = self._title()
     log.push( title )
+    contexts = log.contexts() # held on to, as the loop may be resumed from other threads
+    depth = len( contexts[0] ) - 1 # titles pushed by the loop body or by self.iterator lie above
     try:
-      now = time.time()
-      if now > tnext:
-        dt *= dtexp
-        if dt > dtmax > 0:
-          dt = dtmax
-        log.write( 'progress', None )
-        tnext = now + dt
-      yield item
-    finally:
-      log.pop()
+      for item in self.iterator:
+        if self.index == icheck:
+          now = time.time()
+          if now > tstart:
+            self.rate = self.index / ( now - tstart )
+            stride = max( 1, min( 2 * stride, int( self.rate * dt / 10 ) ) )
+          icheck = self.index + stride
+          title = self._title()
+          for context in contexts:
+            context[depth] = title
+          if now > tnext:
+            dt *= dtexp
+            if dt > dtmax > 0:
+              dt = dtmax
+            log.write( 'progress', None )
+            tnext = now + dt
+        self.index += 1
+        yield item
+    finally: # if the loop was abandoned the entry may have been removed already
+      for context in contexts:
+        if len( context ) > depth and context[depth] is title:
+          del context[depth]
 
 def _mklog():
   return RichOutputLog() if core.getprop( 'richoutput', False ) else StdoutLog()
@@ -221,27 +295,27 @@ def range( title, *args ):
   '''Progress logger identical to built in range'''
 
   items = _range( *args )
-  return _logiter( title, _iter(items), len(items) )
+  return _Progress( title, _iter(items), len(items) )
 
 def iter( title, iterable, length=None ):
   '''Progress logger identical to built in iter'''
 
-  return _logiter( title, _iter(iterable), length or _len(iterable) )
+  return _Progress( title, _iter(iterable), length or _len(iterable) )
 
 def enumerate( title, iterable, length=None ):
   '''Progress logger identical to built in enumerate'''
 
-  return _logiter( title, _enumerate(iterable), length or _len(iterable) )
+  return _Progress( title, _enumerate(iterable), length or _len(iterable) )
 
 def zip( title, *iterables ):
   '''Progress logger identical to built in enumerate'''
 
-  return _logiter( title, _zip(*iterables), None )
+  return _Progress( title, _zip(*iterables), None )
 
 def count( title, start=0, step=1 ):
   '''Progress logger identical to itertools.count'''
 
-  return _logiter( title, itertools.count(start,step), None )
+  return _Progress( title, itertools.count(start,step), None )
     
 def stack( msg, frames ):
   '''Print stack trace'''
@@ -265,12 +339,16 @@ def title( f ): # decorator
     gettitle = lambda args, kwargs: kwargs.pop('title',default)
   @functools.wraps(f)
   def wrapped( *args, **kwargs ):
-    __log__ = _getlog() # repeat as property for fast retrieval
-    __log__.push( gettitle(args,kwargs) )
+    log = _getlog()
+    log.push( gettitle(args,kwargs) )
+    contexts = log.contexts()
+    depth = len( contexts[0] ) - 1
     try:
-      return f( *args, **kwargs )
-    finally:
-      __log__.pop()
+      with core.properties( log=log ): # bounds the frames searched by getprop
+        return f( *args, **kwargs )
+    finally: # truncate rather than pop, to also remove titles of abandoned progress loggers
+      for context in contexts:
+        del context[depth:]
   return wrapped
 
 
@@ -146,7 +146,7 @@ class ScipyMatrix( Matrix ):
     else:
       # keep scipy from making things circular by shielding the nature of A
       A = scipy.sparse.linalg.LinearOperator( A.shape, A.__mul__, dtype=float )
-      if isinstance( precon, str ):
+      if isinstance( precon, ( str, Precon ) ):
         precon = self.getprecon( precon, constrain, lconstrain, rconstrain )
       elif not precon:
         # identity operator, because scipy's native identity operator has circular references
@@ -160,22 +160,19 @@ class ScipyMatrix( Matrix ):
     return (lhs,solverinfo) if info else lhs
 
   def getprecon( self, name='SPLU', constrain=None, lconstrain=None, rconstrain=None ):
+    'preconditioner by name or Precon object'
 
     import scipy.sparse.linalg
 
-    name = name.lower()
     x, I, J = parsecons( constrain, lconstrain, rconstrain, self.shape )
     A = self.core[I,:][:,J]
     assert A.shape[0] == A.shape[1], 'constrained matrix must be square'
-    log.info( 'building %s preconditioner' % name )
-    if name == 'splu':
-      precon = scipy.sparse.linalg.splu( A.tocsc() ).solve
-    elif name == 'spilu':
-      precon = scipy.sparse.linalg.spilu( A.tocsc(), drop_tol=1e-5, fill_factor=None, drop_rule=None, permc_spec=None, diag_pivot_thresh=None, relax=None, panel_size=None, options=None ).solve
-    elif name == 'diag':
-      precon = numpy.reciprocal( A.diagonal() ).__mul__
-    else:
-      raise Exception( 'invalid preconditioner %r' % name )
+    if isinstance( name, str ) and name.lower() == 'amg':
+      try:
+        name = self._amg
+      except AttributeError:
+        name = self._amg = AMG() # reuses aggregates while assembled in place
+    precon = _buildprecon( name, A, J )
     return scipy.sparse.linalg.LinearOperator( A.shape, precon, dtype=float )
 
 class NumpyMatrix( Matrix ):
@@ -214,23 +211,343 @@ class NumpyMatrix( Matrix ):
     x[J] = numpy.linalg.solve( data[:,J], b[I] - numpy.dot( data[:,~J], x[~J] ) )
     return x
 
+class Precon( object ):
+  '''preconditioner base class
+
+  Preconditioners that require more than the matrix itself, such as a
+  hierarchy of bases or a block structure, are passed to ScipyMatrix.solve as
+  Precon objects rather than by name. Subclasses implement build, which
+  receives the constrained matrix and the boolean mask of unconstrained dofs
+  in the full system, and returns a function that applies the approximate
+  inverse of the matrix to a vector.'''
+
+  def build( self, A, free ):
+    raise NotImplementedError
+
+class Multigrid( Precon ):
+  '''geometric multigrid preconditioner
+
+  Performs a V-cycle with nsmooth damped Jacobi iterations before and after
+  every coarse grid correction, using Galerkin coarse matrices P^T A P. The
+  prolongators are the prolongation matrices of successively coarser bases,
+  the first of which maps onto the basis of the system, as obtained from
+  Topology.prolongation. For vector valued bases they are to be extended with
+  scipy.sparse.kron. Coarse dofs that couple to constrained fine dofs only are
+  removed. The coarsest system is solved using the coarse preconditioner. The
+  cycle is symmetric, and therefore suitable for use with cg.'''
+
+  def __init__( self, prolongators, nsmooth=2, omega=2/3., coarse='splu' ):
+    'constructor'
+
+    self.prolongators = [ P.toscipy() if isinstance( P, Matrix ) else P for P in prolongators ]
+    self.nsmooth = nsmooth
+    self.omega = omega
+    self.coarse = coarse
+
+  @classmethod
+  def fromlevels( cls, levels, basisargs, ischeme, **kwargs ):
+    '''multigrid preconditioner for a sequence of nested topologies
+
+    The levels are ordered from coarse to fine, such as the uniform
+    refinements [ topo, topo.refined, topo.refined.refined ] or the levels
+    attribute of a HierarchicalTopology. Every level carries the basis
+    topo.basis( **basisargs ), the finest of which is the basis of the
+    system; for a locally refined HierarchicalTopology that is the basis of
+    its finest level rather than its own hierarchical basis. The
+    prolongators are formed on the finer topology of every pair of levels by
+    Topology.prolongation, with ischeme integrating products of basis
+    functions exactly. Remaining arguments are passed to the constructor.'''
+
+    levels = list( levels )
+    assert len( levels ) > 1, 'multigrid requires at least two levels'
+    bases = [ topo.basis( **basisargs ) for topo in levels ]
+    prolongators = [ fine.prolongation( coarsebasis, finebasis, ischeme=ischeme )
+      for fine, finebasis, coarsebasis in zip( levels[:0:-1], bases[:0:-1], bases[-2::-1] ) ]
+    return cls( prolongators, **kwargs )
+
+  def build( self, A, free ):
+    matrices = [ A.tocsr() ]
+    prolongators = []
+    for P in self.prolongators:
+      P = P.tocsr()[free]
+      free = numpy.diff( P.tocsc().indptr ) > 0
+      P = P[:,free]
+      prolongators.append( P )
+      matrices.append( ( P.T * matrices[-1] * P ).tocsr() )
+    return self._vcycle( matrices, prolongators, free )
+
+  def _vcycle( self, matrices, prolongators, free ):
+    log.info( 'multigrid levels:', ', '.join( str(A.shape[0]) for A in matrices ) )
+    coarse = _buildprecon( self.coarse, matrices[-1], free )
+    scales = [ self.omega / A.diagonal() for A in matrices[:-1] ]
+
+    def vcycle( b, level=0 ):
+      if level == len( prolongators ):
+        return coarse( b )
+      A = matrices[level]
+      P = prolongators[level]
+      x = scales[level] * b
+      for ismooth in range( self.nsmooth-1 ):
+        x += scales[level] * ( b - A * x )
+      x += P * vcycle( P.T * ( b - A * x ), level+1 )
+      for ismooth in range( self.nsmooth ):
+        x += scales[level] * ( b - A * x )
+      return x
+
+    return vcycle
+
+class AMG( Multigrid ):
+  '''smoothed aggregation algebraic multigrid preconditioner
+
+  Multigrid preconditioner for problems that lack a hierarchy of bases, such
+  as on unstructured meshes, which forms its prolongators from the matrix. Dofs
+  are grouped into aggregates of strongly coupled neighbours, for which
+  a_ij^2 > theta^2 |a_ii a_jj|, and the piecewise constant tentative
+  prolongator is smoothed by a damped Jacobi step. Coarsening stops when at
+  most maxcoarse dofs remain. The aggregates are stored and reused in
+  subsequent builds for matrices of the same sparsity pattern, such as in a
+  Newton iteration, leaving only the sparse products to be recomputed. The
+  method targets scalar elliptic problems, and is available by name as 'amg',
+  for which every matrix keeps an instance of its own, such that a matrix that
+  is assembled in place reuses its aggregates between solves.'''
+
+  def __init__( self, theta=.08, maxcoarse=256, maxlevels=10, nsmooth=2, omega=2/3., coarse='splu' ):
+    'constructor'
+
+    Multigrid.__init__( self, (), nsmooth=nsmooth, omega=omega, coarse=coarse )
+    self.theta = theta
+    self.maxcoarse = maxcoarse
+    self.maxlevels = maxlevels
+    self.pattern = None
+    self.aggregates = None
+
+  def build( self, A, free ):
+    A = A.tocsr()
+    A.sort_indices()
+    pattern = A.indptr, A.indices
+    reuse = self.pattern is not None and all( numpy.array_equal( a, b ) for a, b in zip( pattern, self.pattern ) )
+    if not reuse:
+      self.pattern = tuple( array.copy() for array in pattern )
+      self.aggregates = []
+    else:
+      log.info( 'reusing aggregates' )
+    matrices = [ A ]
+    prolongators = []
+    for level in range( self.maxlevels-1 ):
+      if A.shape[0] <= self.maxcoarse:
+        break
+      if level == len( self.aggregates ):
+        self.aggregates.append( _aggregate( A, self.theta ) )
+      aggregates = self.aggregates[level]
+      naggregates = aggregates.max() + 1
+      if naggregates == A.shape[0]:
+        break
+      P = _smoothedprolongator( A, aggregates, naggregates )
+      A = ( P.T * A * P ).tocsr()
+      A.sort_indices()
+      prolongators.append( P )
+      matrices.append( A )
+    return self._vcycle( matrices, prolongators, numpy.ones( A.shape[0], dtype=bool ) )
+
+class BlockSchur( Precon ):
+  '''block triangular preconditioner for saddle point systems
+
+  Splits the dofs in two groups, the first of which is selected from the full
+  system by first (a mask, index array or slice, such as the velocity dofs of
+  a chained basis), and writes the system as [[A,B1],[B2,C]]. The inverse is
+  approximated by that of [[A,B1],[0,S]], where S = C - B2 diag(A)^-1 B1 is
+  the Schur complement with A replaced by its diagonal. A is inverted using
+  precon and S using schurprecon, which are preconditioner names or Precon
+  objects such as Multigrid.'''
+
+  def __init__( self, first, precon='splu', schurprecon='splu' ):
+    'constructor'
+
+    self.first = first
+    self.precon = precon
+    self.schurprecon = schurprecon
+
+  def build( self, A, free ):
+    import scipy.sparse
+    mask = numpy.zeros( len(free), dtype=bool )
+    mask[ self.first ] = True
+    first = mask[free]
+    A = A.tocsr()
+    A11 = A[first][:,first]
+    B1 = A[first][:,~first]
+    B2 = A[~first][:,first]
+    C = A[~first][:,~first]
+    S = ( C - B2 * scipy.sparse.diags( numpy.reciprocal( A11.diagonal() ) ) * B1 ).tocsr()
+    log.info( 'block sizes:', A11.shape[0], S.shape[0] )
+    solve1 = _buildprecon( self.precon, A11, free[mask] )
+    solve2 = _buildprecon( self.schurprecon, S, free[~mask] )
+
+    def blocksolve( b ):
+      x = numpy.empty_like( b )
+      x[~first] = solve2( b[~first] )
+      x[first] = solve1( b[first] - B1 * x[~first] )
+      return x
+
+    return blocksolve
+
 
 # UTILITY FUNCTIONS
 
-def assemble( data, index, shape, force_dense=False ):
-  'create data from values and indices'
+def _buildprecon( precon, A, free ):
+  'function that applies the approximate inverse of scipy matrix A'
+
+  import scipy.sparse.linalg
+
+  if isinstance( precon, Precon ):
+    log.info( 'building %s preconditioner' % precon.__class__.__name__.lower() )
+    return precon.build( A, free )
+  name = precon.lower()
+  log.info( 'building %s preconditioner' % name )
+  if name == 'splu':
+    return scipy.sparse.linalg.splu( A.tocsc() ).solve
+  if name == 'spilu':
+    return scipy.sparse.linalg.spilu( A.tocsc(), drop_tol=1e-5, fill_factor=None, drop_rule=None, permc_spec=None, diag_pivot_thresh=None, relax=None, panel_size=None, options=None ).solve
+  if name == 'diag':
+    return numpy.reciprocal( A.diagonal() ).__mul__
+  if name == 'amg':
+    return AMG().build( A, free )
+  raise Exception( 'invalid preconditioner %r' % name )
+
+class SparsityPattern( object ):
+  '''csr structure of a matrix with a fixed set of possibly repeated entries
+
+  The pattern is formed from the flat, row major positions of all entries and
+  maps every entry onto its location in the csr data array, such that values
+  can be summed into place without sorting. Matrices assembled from the same
+  pattern share its index arrays.'''
+
+  def __init__( self, flatindex, shape ):
+    'constructor'
+
+    assert len(shape) == 2
+    self.shape = tuple( shape )
+    keys, self.entries = numpy.unique( flatindex, return_inverse=True )
+    self.indices = keys % shape[1]
+    self.indptr = numpy.searchsorted( keys, numpy.arange( shape[0]+1 ) * shape[1] )
+
+  @property
+  def nnz( self ):
+    return len( self.indices )
+
+  def assemble( self, data, out=None ):
+    '''create ScipyMatrix from values ordered as the entries of the pattern, or
+    overwrite the values of out, a matrix earlier assembled from the pattern'''
+
+    import scipy.sparse
+    assert len(data) == len(self.entries)
+    csrdata = numpy.bincount( self.entries, data, self.nnz ) if self.nnz else numpy.zeros( 0 )
+    if out is not None:
+      assert isinstance( out, ScipyMatrix ) and out.shape == self.shape and ( numpy.may_share_memory( out.core.indices, self.indices )
+        or numpy.array_equal( out.core.indptr, self.indptr ) and numpy.array_equal( out.core.indices, self.indices ) ), 'matrix does not match sparsity pattern'
+      out.core.data[...] = csrdata
+      return out
+    csr = scipy.sparse.csr_matrix( ( csrdata, self.indices, self.indptr ), self.shape )
+    self.indices, self.indptr = csr.indices, csr.indptr # keep scipy's index dtype
+    return ScipyMatrix( csr )
+
+def _aggregate( A, theta ):
+  'aggregate index of every dof, grouping strongly coupled dofs'
+
+  import scipy.sparse
+
+  n = A.shape[0]
+  rows = numpy.repeat( numpy.arange(n), numpy.diff(A.indptr) )
+  diag = numpy.abs( A.diagonal() )
+  strong = ( A.data**2 > theta**2 * diag[rows] * diag[A.indices] ) & ( rows != A.indices )
+  S = scipy.sparse.csr_matrix( ( numpy.ones( strong.sum() ), ( rows[strong], A.indices[strong] ) ), shape=A.shape )
+  C = ( S + S.T + scipy.sparse.identity( n, format='csr' ) ).tocsr() # closed strong neighbourhoods
+  priority = numpy.random.RandomState( 0 ).permutation( n )
+
+  # First, aggregates are formed of dofs and their strongly coupled
+  # neighbours, all of which are not yet aggregated, with roots selected at
+  # least three apart by _independentset. Second, dofs that are left over
+  # form aggregates among each other likewise, with roots at least two apart,
+  # provided that a root has at least two leftover neighbours. Remaining dofs
+  # are next added to the aggregate of any of their neighbours, which exists
+  # as otherwise the dof would have been within reach of another root.
+
+  aggregates = _neighbourmax( C, numpy.where( _independentset( C, priority, 2 ), numpy.arange(n), -1 ) )
+  left, = ( aggregates == -1 ).nonzero()
+  if len(left):
+    L = C[left][:,left].tocsr()
+    roots = _independentset( L, priority[left], 1 ) & ( numpy.diff( L.indptr ) > 2 )
+    aggregates[left] = _neighbourmax( L, numpy.where( roots, n + numpy.arange(len(left)), -1 ) )
+  remaining = aggregates == -1
+  aggregates[remaining] = _neighbourmax( C, aggregates )[remaining]
+  return numpy.unique( aggregates, return_inverse=True )[1]
+
+def _neighbourmax( C, values ):
+  'maximum of values over the closed neighbourhoods of csr graph C'
+
+  return numpy.maximum.reduceat( values[C.indices], C.indptr[:-1] )
+
+def _independentset( C, priority, distance ):
+  '''mask of a maximal set of nodes of csr graph C that are more than distance
+  apart, selected greedily in order of decreasing priority. In every round
+  all undecided nodes that take precedence over undecided nodes within reach
+  are selected at once, after which nodes within their reach are decided;
+  with random priorities the number of rounds grows only slowly with size.'''
+
+  def reach( values ):
+    for i in range( distance ):
+      values = _neighbourmax( C, values )
+    return values
+
+  undecided = numpy.ones( C.shape[0], dtype=bool )
+  selected = numpy.zeros( C.shape[0], dtype=bool )
+  while undecided.any():
+    new = undecided & ( reach( numpy.where( undecided, priority, -1 ) ) == priority )
+    selected |= new
+    undecided &= reach( new.astype(int) ) == 0
+  return selected
+
+def _smoothedprolongator( A, aggregates, naggregates, omega=4/3., niter=10 ):
+  'tentative prolongator of aggregates smoothed by damped jacobi'
+
+  import scipy.sparse
+
+  n = len( aggregates )
+  counts = numpy.bincount( aggregates, minlength=naggregates )
+  T = scipy.sparse.csr_matrix( ( 1 / numpy.sqrt( counts[aggregates] ), ( numpy.arange(n), aggregates ) ), shape=(n,naggregates) )
+  DinvA = scipy.sparse.diags( numpy.reciprocal( A.diagonal() ) ) * A
+  x = numpy.random.RandomState( 0 ).uniform( size=n )
+  for i in range( niter ): # power iteration for the spectral radius of DinvA
+    x = DinvA * x
+    rho = numpy.linalg.norm( x )
+    x /= rho
+  return ( T - (omega/rho) * ( DinvA * T ) ).tocsr()
+
+def assemble( data, index, shape, force_dense=False, out=None ):
+  '''create data from values and indices
+
+  The index is either an ndim x n array of coordinates, an array of n flat,
+  row major positions as produced by numpy.ravel_multi_index, or a
+  SparsityPattern. If out is given values are written into this existing
+  array or matrix, which is then returned.'''
 
   if len(shape) == 0:
+    assert out is None, 'cannot assemble scalar in place'
     retval = data.sum()
-  elif len(shape) == 2 and not force_dense:
-    import scipy.sparse.linalg
-    csr = scipy.sparse.csr_matrix( (data,index), shape )
-    retval = ScipyMatrix( csr )
+  elif isinstance( index, SparsityPattern ):
+    assert index.shape == shape and not force_dense
+    retval = index.assemble( data, out )
   else:
-    flatindex = numpy.dot( numpy.cumprod( (1,)+shape[:0:-1] )[::-1], index )
-    retval = numpy.bincount( flatindex, data, numpy.prod(shape) ).reshape( shape ).astype( data.dtype, copy=False )
-    if retval.ndim == 2:
-      retval = NumpyMatrix( retval )
+    if index.ndim == 2:
+      index = numpy.ravel_multi_index( index, shape )
+    if len(shape) == 2 and not force_dense:
+      retval = SparsityPattern( index, shape ).assemble( data, out )
+    else:
+      retval = numpy.bincount( index, data, numpy.prod(shape) ).reshape( shape ).astype( data.dtype, copy=False )
+      if out is not None:
+        ( out.core if isinstance( out, NumpyMatrix ) else out )[...] = retval
+        retval = out
+      elif retval.ndim == 2:
+        retval = NumpyMatrix( retval )
   assert retval.shape == shape
   log.debug( 'assembled', '%s(%s)' % ( retval.__class__.__name__, ','.join( str(n) for n in shape ) ) )
   return retval
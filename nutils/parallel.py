@@ -7,14 +7,17 @@
 # and others. More info at http://nutils.org <info@nutils.org>. (c) 2014
 
 """
-The parallel module provides tools aimed at parallel computing. At this point
-all parallel solutions use the ``fork`` system call and are supported on limited
+The parallel module provides tools aimed at parallel computing. By default
+parallel solutions use the ``fork`` system call and are supported on limited
 platforms, notably excluding Windows. On unsupported platforms parallel features
-will disable and a warning is printed.
+will disable and a warning is printed. Alternatively, setting the ``parallel``
+property to ``'threads'`` selects a persistent pool of threads, which avoids
+process startup for short element loops that spend most of their time in
+numpy.
 """
 
 from . import core, log, numpy, debug, numeric
-import os, sys, multiprocessing
+import os, sys, multiprocessing, threading, itertools
 
 Lock = multiprocessing.Lock
 cpu_count = multiprocessing.cpu_count
@@ -168,33 +171,127 @@ def shzeros( shape, dtype=float ):
   buf = multiprocessing.RawArray( typecode, int(size) )
   return numpy.frombuffer( buf, dtype ).reshape( shape )
 
-def pariter( iterable ):
+def pariter( iterable, length=None ):
   'iterate parallel'
 
   nprocs = core.getprop( 'nprocs', 1 )
-  return iterable if nprocs <= 1 else _pariter( iterable, nprocs )
+  return iterable if nprocs <= 1 else _pariter( iterable, nprocs, length )
 
-def _pariter( iterable, nprocs ):
+def _chunksize( start, length, nworkers ):
+  '''size of the next chunk of work starting at item start. If the length is
+  known chunks are a fixed fraction of the remaining work (guided
+  self-scheduling): large chunks keep the number of synchronizations low,
+  while small chunks at the end balance out differences in cost between
+  items, such as between trimmed and untrimmed elements. The ``chunksize``
+  property sets the minimum chunk size, which is also the fixed chunk size
+  if the length is unknown.'''
+
+  minsize = core.getprop( 'chunksize', 1 )
+  if length is None:
+    return minsize
+  return max( minsize, ( length - start ) // ( 2 * nworkers ) )
+
+def _pariter( iterable, nprocs, length=None ):
   'iterate parallel, helper generator'
 
-  shared_iter = multiprocessing.RawValue( 'i', nprocs )
+  if length is None:
+    length = log._len( iterable )
+  shared_iter = multiprocessing.RawValue( 'i', 0 )
   lock = Lock()
   with Fork( nprocs ) as iproc:
-    iiter = iproc
+    start = stop = 0
     for n, it in enumerate( iterable ):
-      if n < iiter:
+      if n == stop:
+        with lock:
+          start = shared_iter.value
+          stop = start + _chunksize( start, length, nprocs )
+          shared_iter.value = stop
+      if n < start:
         continue
-      assert n == iiter
       yield it
+
+def parexec( func, iterable, length=None ):
+  '''call func in every worker with an iterator over its share of iterable
+
+  Workers are forked processes or threads depending on the ``parallel``
+  property. Items are handed out in chunks of decreasing size, see
+  _chunksize, for which the length of iterable is used if known. Output must
+  be written to memory that is shared between workers, such as obtained from
+  shzeros, in disjoint locations. Calls from within a worker thread run
+  serially, as the pool has no threads to spare for nested work.'''
+
+  nprocs = core.getprop( 'nprocs', 1 )
+  if nprocs <= 1 or _threadstate.inworker:
+    func( iter(iterable) )
+  elif core.getprop( 'parallel', 'fork' ) == 'threads':
+    _threadexec( func, iterable, nprocs, length, frame=sys._getframe(1) )
+  else:
+    func( _pariter( iterable, nprocs, length ) )
+
+class _ThreadState( threading.local ):
+  'per thread flag marking workers of the thread pool'
+
+  def __init__( self ):
+    self.inworker = False
+
+_threadstate = _ThreadState()
+_threadpool = None
+
+def _getthreadpool( nthreads ):
+  'persistent thread pool of at least nthreads workers'
+
+  global _threadpool
+  if _threadpool is None or _threadpool._max_workers < nthreads:
+    import concurrent.futures
+    if _threadpool is not None:
+      _threadpool.shutdown()
+    _threadpool = concurrent.futures.ThreadPoolExecutor( nthreads )
+  return _threadpool
+
+def _threadexec( func, iterable, nthreads, length, frame ):
+  'run func in nthreads threads, handing out items in chunks'
+
+  if length is None:
+    length = log._len( iterable )
+  items = iter( iterable )
+  lock = threading.Lock()
+  consumed = [ 0 ]
+  def nextchunk():
+    chunk = list( itertools.islice( items, _chunksize( consumed[0], length, nthreads ) ) )
+    consumed[0] += len(chunk)
+    return chunk
+  pending = [ nextchunk() ] # start iterating in the calling thread, such that progress loggers push onto its context
+  def chunked():
+    while True:
       with lock:
-        iiter = shared_iter.value
-        shared_iter.value = iiter + 1
+        chunk = pending.pop() if pending else nextchunk()
+      if not chunk:
+        break
+      yield from chunk
+  properties = core.getprops( frame )
+  properties['log'] = logger = log._getlog()
+  context = list( logger.context )
+  def worker():
+    _threadstate.inworker = True
+    logger.context = list( context ) # continue from the caller's titles
+    try:
+      with core.properties( **properties ): # make caller's properties visible to getprop
+        func( chunked() )
+    finally:
+      logger.context = []
+      _threadstate.inworker = False
+  pool = _getthreadpool( nthreads )
+  futures = [ pool.submit( worker ) for ithread in range( nthreads ) ]
+  for future in futures:
+    future.result()
 
 def parmap( func, iterable, shape=(), dtype=float ):
   n = len(iterable)
   out = shzeros( (n,)+shape, dtype=dtype )
-  for i, item in pariter( enumerate(iterable) ):
-    out[i] = func( item )
+  def mapitems( items ):
+    for i, item in items:
+      out[i] = func( item )
+  parexec( mapitems, enumerate(iterable), n )
   return out
 
 # vim:shiftwidth=2:softtabstop=2:expandtab:foldmethod=indent:foldnestmax=1
@@ -13,7 +13,7 @@ backends. At this point `matplotlib <http://matplotlib.org/>`_ and `vtk
 """
 
 from . import numpy, log, core, cache, numeric, _
-import os, warnings, sys, subprocess
+import os, warnings, sys, subprocess, zlib, tempfile, shutil, threading, queue
 
 
 class BasePlot( object ):
@@ -565,6 +565,8 @@ class VTKFile( BasePlot ):
     ( numpy.float64, 'double' ),
   )
 
+  _swapsize = 2**16
+
   def __init__( self, name=None, index=None, ndigits=0, ascii=False ):
     'constructor'
 
@@ -590,10 +592,12 @@ class VTKFile( BasePlot ):
     if self.ascii:
       array.tofile( output, sep=' ' )
       output.write( b'\n' )
-    else:
-      if sys.byteorder != 'big':
-        array = array.byteswap()
+    elif sys.byteorder == 'big':
       array.tofile( output )
+    else: # legacy vtk is big endian; swap in blocks to avoid a full copy
+      array = array.ravel()
+      for i in range( 0, len(array), self._swapsize ):
+        array[i:i+self._swapsize].byteswap().tofile( output )
 
   def save( self, name=None, index=None ):
     assert self._mesh is not None, 'Grid not specified'
@@ -627,7 +631,7 @@ class VTKFile( BasePlot ):
         write( 'DIMENSIONS {} {} {}\n'.format( *map( len, coords ) ) )
         for label, array in zip( 'XYZ', coords ):
           write( '{}_COORDINATES {} {}\n'.format( label, len(array), self._getvtkdtype( array ) ) )
-          self._writearray( array )
+          self._writearray( vtk, array )
       else:
         raise NotImplementedError
 
@@ -729,6 +733,138 @@ class VTKFile( BasePlot ):
 
     self._dataarrays[location].append(( name, extdata ))
 
+class VTUFile( BasePlot ):
+  '''streaming vtk xml unstructured grid file
+
+  Cells are appended in chunks through `addcells`. Every data array is
+  written to a temporary file of its own in native byte order, optionally zlib
+  compressed, such that no more than a single chunk needs to be held in memory.
+  On `save` the xml header is written with the offsets of all arrays, followed
+  by the appended raw data. If `background` is True, compression and disk
+  access are left to a writer thread that buffers at most `maxqueue` arrays;
+  `save` then returns before the file is complete, and `wait` blocks until it
+  is.'''
+
+  _vtkdtypes = dict( i1='Int8', u1='UInt8', i2='Int16', u2='UInt16', i4='Int32', u4='UInt32', i8='Int64', u8='UInt64', f4='Float32', f8='Float64' )
+  _celltypes = { (2,1): 3, (3,2): 5, (4,2): 9, (4,3): 10, (5,3): 14, (8,3): 11 }
+
+  def __init__( self, name=None, index=None, ndigits=0, compress=False, background=False, maxqueue=4 ):
+    'constructor'
+
+    BasePlot.__init__( self, name, ndigits=ndigits, index=index )
+    self.compress = 6 if compress is True else compress
+    self.npoints = 0
+    self.ncells = 0
+    self._arrays = None
+    self._error = None
+    if background:
+      self._queue = queue.Queue( maxqueue )
+      self._thread = threading.Thread( target=self._work, args=(self._queue,) )
+      self._thread.start()
+    else:
+      self._queue = None
+      self._thread = None
+
+  def _work( self, items ):
+    while True:
+      item = items.get()
+      if item is None:
+        break
+      if self._error is None:
+        try:
+          item[0]( *item[1:] )
+        except Exception as e:
+          self._error = e
+
+  def _put( self, func, *args ):
+    if self._thread is None:
+      func( *args )
+    else:
+      assert self._queue is not None, 'file is closed'
+      self._queue.put( (func,)+args )
+
+  def addcells( self, points, ncellpoints, npars=None, pointdata=(), celldata=() ):
+    '''append cells
+
+    Adds len(ncellpoints) cells, the i-th of which is formed by the next
+    ncellpoints[i] rows of points. Pointdata and celldata are sequences of
+    (name,array) pairs, with arrays of len(points) or len(ncellpoints) rows,
+    respectively. All chunks should define the same data arrays.'''
+
+    points = numpy.asarray( points )
+    ncellpoints = numpy.asarray( ncellpoints )
+    npoints, ndims = points.shape
+    ncells, = ncellpoints.shape
+    assert ncellpoints.sum() == npoints, 'points do not match cells'
+    assert self.npoints + npoints < 2**31, 'number of points exceeds int32 range'
+    if npars is None:
+      npars = ndims
+    pointdata = [ ( name, _extendcomponents( numpy.asarray(data), npoints ) ) for name, data in pointdata ]
+    celldata = [ ( name, _extendcomponents( numpy.asarray(data), ncells ) ) for name, data in celldata ]
+    points = _extendcomponents( points, npoints )
+    if self._arrays is None:
+      outdir = self.path
+      self._arrays = [ ( 'Points', [ ( None, _AppendedArray( points, self.compress, outdir ) ) ] ),
+        ( 'Cells', [ ( name, _AppendedArray( numpy.empty( 0, dtype=dtype ), self.compress, outdir ) ) for name, dtype in ( ( 'connectivity', numpy.int32 ), ( 'offsets', numpy.int32 ), ( 'types', numpy.uint8 ) ) ] ),
+        ( 'PointData', [ ( name, _AppendedArray( data, self.compress, outdir ) ) for name, data in pointdata ] ),
+        ( 'CellData', [ ( name, _AppendedArray( data, self.compress, outdir ) ) for name, data in celldata ] ) ]
+    (pointsarray,), cellsarrays, pointdataarrays, celldataarrays = [ [ array for name, array in arrays ] for section, arrays in self._arrays ]
+    assert [ name for name, data in pointdata ] == [ name for name, array in self._arrays[2][1] ], 'point data does not match previous chunks'
+    assert [ name for name, data in celldata ] == [ name for name, array in self._arrays[3][1] ], 'cell data does not match previous chunks'
+
+    types = numpy.empty( ncells, dtype=numpy.uint8 )
+    for np in numpy.unique( ncellpoints ):
+      types[ ncellpoints == np ] = self._celltypes[ np, npars ]
+    cellsdata = numpy.arange( self.npoints, self.npoints+npoints, dtype=numpy.int32 ), \
+      numpy.cumsum( ncellpoints, dtype=numpy.int32 ) + self.npoints, types
+
+    for array, data in zip( [pointsarray] + cellsarrays + pointdataarrays + celldataarrays, [points] + list(cellsdata) + [ data for name, data in pointdata+celldata ] ):
+      self._put( array.write, data )
+    self.npoints += npoints
+    self.ncells += ncells
+
+  def save( self, name=None, index=None ):
+    assert self._arrays is not None, 'no cells added'
+    self._put( self._write, self.getpath(name,index,'vtu'), self.npoints, self.ncells )
+
+  def _write( self, path, npoints, ncells ):
+    header = [ '<?xml version="1.0"?>',
+      '<VTKFile type="UnstructuredGrid" version="1.0" byte_order="{}" header_type="UInt64"{}>'.format(
+        'LittleEndian' if sys.byteorder == 'little' else 'BigEndian',
+        ' compressor="vtkZLibDataCompressor"' if self.compress else '' ),
+      '<UnstructuredGrid>',
+      '<Piece NumberOfPoints="{}" NumberOfCells="{}">'.format( npoints, ncells ) ]
+    offset = 0
+    for section, arrays in self._arrays:
+      header.append( '<{}>'.format( section ) )
+      for name, array in arrays:
+        array.finish()
+        header.append( '<DataArray type="{}"{} NumberOfComponents="{}" format="appended" offset="{}"/>'.format(
+          self._vtkdtypes[ array.dtype.str[1:] ], '' if name is None else ' Name="{}"'.format( name ), array.ncomp, offset ) )
+        offset += array.nbytes
+      header.append( '</{}>'.format( section ) )
+    header.extend([ '</Piece>', '</UnstructuredGrid>', '<AppendedData encoding="raw">', '_' ])
+    with open( path, 'wb' ) as vtu:
+      vtu.write( '\n'.join( header ).encode( 'ascii' ) )
+      for section, arrays in self._arrays:
+        for name, array in arrays:
+          array.copyto( vtu )
+      vtu.write( b'\n</AppendedData>\n</VTKFile>\n' )
+
+  def close( self ):
+    if self._queue is not None:
+      self._queue.put( None )
+      self._queue = None
+
+  def wait( self ):
+    'block until all data is written'
+
+    self.close()
+    if self._thread is not None:
+      self._thread.join()
+    if self._error is not None:
+      raise self._error
+
 
 ## INTERNAL HELPER FUNCTIONS
 
@@ -741,6 +877,89 @@ def _getnextindex( path, name, ext ):
         index = max( index, int(num)+1 )
   return index
 
+def _extendcomponents( data, length ):
+  assert len(data) == length, 'data mismatch: expected length {}, got {}'.format( length, len(data) )
+  assert data.ndim <= 3, 'data array should have at most 3 axes'
+  extshp = (length,)+(3,)*(data.ndim-1)
+  if data.shape == extshp:
+    return data
+  extdata = numpy.zeros( extshp, dtype=data.dtype )
+  extdata[tuple(slice(sh) for sh in data.shape)] = data
+  return extdata
+
+class _AppendedArray( object ):
+  'temporary storage of an appended vtk data array'
+
+  blocksize = 2**20
+
+  def __init__( self, template, compress, outdir ):
+    self.dtype = template.dtype
+    self.ncomp = numpy.prod( template.shape[1:], dtype=int )
+    self.compress = compress
+    self.file = tempfile.TemporaryFile( dir=outdir )
+    self.size = 0
+    self.blocks = []
+    self.pending = bytearray()
+    self.nbytes = None
+
+  def write( self, array ):
+    assert array.dtype == self.dtype and numpy.prod( array.shape[1:], dtype=int ) == self.ncomp
+    data = numpy.ascontiguousarray( array ).reshape( -1 ).view( numpy.uint8 )
+    self.size += len(data)
+    if not self.compress:
+      self.file.write( data )
+      return
+    # vtk requires equally sized blocks, so data is regrouped irrespective of chunks
+    if self.pending:
+      n = self.blocksize - len(self.pending)
+      self.pending += data[:n].tobytes()
+      data = data[n:]
+      if len(self.pending) < self.blocksize:
+        return
+      self._writeblock( self.pending )
+      self.pending = bytearray()
+    n = len(data) - len(data) % self.blocksize
+    for i in range( 0, n, self.blocksize ):
+      self._writeblock( data[i:i+self.blocksize] )
+    self.pending += data[n:].tobytes()
+
+  def _writeblock( self, data ):
+    block = zlib.compress( data, self.compress )
+    self.blocks.append( len(block) )
+    self.file.write( block )
+
+  def finish( self ):
+    if self.nbytes is not None:
+      return
+    if not self.compress:
+      self.header = numpy.array( [ self.size ], dtype=numpy.uint64 )
+    else:
+      if self.pending:
+        self._writeblock( self.pending )
+        self.pending = bytearray()
+      self.header = numpy.array( [ len(self.blocks), self.blocksize, self.size % self.blocksize ] + self.blocks, dtype=numpy.uint64 )
+    self.nbytes = self.header.nbytes + self.file.tell()
+
+  def copyto( self, output ):
+    output.write( self.header.tobytes() )
+    self.file.seek( 0 )
+    shutil.copyfileobj( self.file, output )
+    self.file.close()
+
+def _streamcells( vtufile, ndims, elems, coords, pointdata, celldata, chunksize, ischeme ):
+  from . import topology
+  pointkeys = tuple( pointdata )
+  pointfuncs = tuple( pointdata[key] for key in pointkeys )
+  cellkeys = tuple( celldata )
+  cellfuncs = tuple( celldata[key] for key in cellkeys )
+  chunks = [ elems[i:i+chunksize] for i in range( 0, len(elems), chunksize ) ]
+  for chunk in log.iter( 'chunk', chunks ):
+    chunk = topology.UnstructuredTopology( ndims, chunk )
+    ncellpoints = [ len( elem.reference.getischeme('vtk')[0] ) for elem in chunk ]
+    points = chunk.elem_eval( (coords,)+pointfuncs, ischeme='vtk' )
+    cells = chunk.elem_mean( cellfuncs, geometry=coords, ischeme=ischeme ) if cellfuncs else ()
+    vtufile.addcells( points[0], ncellpoints, npars=ndims, pointdata=zip( pointkeys, points[1:] ), celldata=zip( cellkeys, cells ) )
+
 def _triangulate_quad( n, m ):
   ind = numpy.arange( n*m ).reshape( n, m )
   vert1 = numpy.array([ ind[:-1,:-1].ravel(), ind[1:,:-1].ravel(), ind[:-1,1:].ravel() ]).T
@@ -795,6 +1014,75 @@ def writevtu( name, topo, coords, pointdata={}, celldata={}, ascii=False, supere
       for key, array in zip( keys, arrays ):
         vtkfile.celldataarray( key, array )
 
+def streamvtu( name, topo, coords, pointdata={}, celldata={}, compress=False, background=False, chunksize=1024, superelements=False, ndigits=0, ischeme='gauss1' ):
+  '''write vtu from coords function in element chunks
+
+  Evaluates coords and pointdata in the vtk points, and averages celldata over
+  the elements, for chunks of at most chunksize elements at a time, appending
+  the results to a VTUFile. If background is True the file is completed by a
+  writer thread, and the returned VTUFile's wait method should be called
+  before the file is used.'''
+
+  if not superelements:
+    topo = topo.simplex
+  vtufile = VTUFile( name, ndigits=ndigits, compress=compress, background=background )
+  try:
+    _streamcells( vtufile, topo.ndims, tuple(topo), coords, pointdata, celldata, chunksize, ischeme )
+    vtufile.save()
+  finally:
+    vtufile.close()
+  if not background:
+    vtufile.wait()
+  return vtufile
+
+def writepvtu( name, topo, coords, pointdata={}, celldata={}, nparts=None, compress=False, chunksize=1024, superelements=False, ndigits=0, ischeme='gauss1' ):
+  '''write partitioned vtu from coords function
+
+  Splits the elements in nparts contiguous ranges, by default one per process
+  as set by the nprocs property. Every range is evaluated and written to a vtu
+  piece of its own by a parallel worker, after which a pvtu file is written
+  that combines all pieces.'''
+
+  from . import function, parallel
+
+  if not superelements:
+    topo = topo.simplex
+  elems = tuple( topo )
+  if nparts is None:
+    nparts = core.getprop( 'nprocs', 1 )
+  nparts = max( 1, min( nparts, len(elems) ) )
+  path = BasePlot( name, ndigits=ndigits ).getpath( None, None, 'pvtu' )
+  basename = os.path.basename( path )[:-len('.pvtu')]
+  piecenames = [ '{}_{}'.format( basename, ipart ) for ipart in range( nparts ) ]
+
+  def writepieces( iparts ):
+    __nprocs__ = 1 # pieces are the unit of parallelism
+    for ipart in iparts:
+      with VTUFile( piecenames[ipart], compress=compress ) as vtufile:
+        _streamcells( vtufile, topo.ndims, elems[ipart*len(elems)//nparts:(ipart+1)*len(elems)//nparts], coords, pointdata, celldata, chunksize, ischeme )
+  parallel.parexec( writepieces, range(nparts), nparts )
+
+  dataarray = '<PDataArray type="{}" Name="{}" NumberOfComponents="{}"/>'.format
+  lines = [ '<?xml version="1.0"?>',
+    '<VTKFile type="PUnstructuredGrid" version="1.0" byte_order="{}" header_type="UInt64">'.format( 'LittleEndian' if sys.byteorder == 'little' else 'BigEndian' ),
+    '<PUnstructuredGrid GhostLevel="0">',
+    '<PPoints>',
+    '<PDataArray type="Float64" NumberOfComponents="3"/>',
+    '</PPoints>',
+    '<PPointData>' ]
+  for key, func in pointdata.items():
+    func = function.asarray( func )
+    lines.append( dataarray( { float: 'Float64', int: 'Int32', bool: 'Int8' }[ func.dtype ], key, 3**func.ndim ) ) # cf. parallel.shzeros
+  lines.append( '</PPointData>' )
+  lines.append( '<PCellData>' )
+  for key, func in celldata.items():
+    lines.append( dataarray( 'Float64', key, 3**function.asarray(func).ndim ) )
+  lines.append( '</PCellData>' )
+  lines.extend( '<Piece Source="{}.vtu"/>'.format( piecename ) for piecename in piecenames )
+  lines.extend([ '</PUnstructuredGrid>', '</VTKFile>' ])
+  with open( path, 'w' ) as pvtu:
+    pvtu.write( '\n'.join( lines ) + '\n' )
+
 def triangulate( points, mergetol=0 ):
   triangulate_bezier = cache.Wrapper(_triangulate_bezier)
   npoints = 0
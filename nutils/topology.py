@@ -25,7 +25,7 @@ out in element loops. For lower level operations topologies can be used as
 
 from . import element, function, util, numpy, parallel, matrix, log, core, numeric, cache, rational, transform, _
 from .index import IndexedArray
-import warnings, functools, collections, itertools
+import warnings, functools, collections, collections.abc, itertools, weakref
 
 _identity = lambda x: x
 
@@ -131,7 +131,16 @@ class Topology( object ):
   @cache.property
   def edict( self ):
     '''transform -> ielement mapping'''
-    return { elem.transform: ielem for ielem, elem in enumerate(self) }
+    return transform.TransformIndex( ( elem.transform, ielem ) for ielem, elem in enumerate(self) )
+
+  def indexedbasis( self, stdkeeps, dofs, ndofs ):
+    '''function object from per element (stdelem,keep) tuples and dof arrays
+    in element order, stored by element index in a list and a csr table'''
+
+    assert len(stdkeeps) == len(dofs) == len(self.edict)
+    fmap = function.IndexedMap( self.edict, stdkeeps.__getitem__ )
+    nmap = function.IndexedMap( self.edict, function.CSRTable.fromrows( dofs ).__getitem__ )
+    return function.function( fmap=fmap, nmap=nmap, ndofs=ndofs, ndims=self.ndims )
 
   def outward_from( self, outward, inward=None ):
     'direct interface elements to evaluate in topo first'
@@ -168,8 +177,8 @@ class Topology( object ):
 
     assert degree == 1 # for now!
     dofmap = {}
-    fmap = {}
-    nmap = {}
+    fmap = []
+    nmap = []
     for elem in self:
       dofs = numpy.empty( elem.nverts, dtype=int )
       for i, v in enumerate( elem.vertices ):
@@ -180,17 +189,16 @@ class Topology( object ):
         dofs[i] = dof
       stdfunc = elem.reference.stdfunc(1)
       assert stdfunc.nshapes == elem.nverts
-      fmap[elem.transform] = (stdfunc,None),
-      nmap[elem.transform] = dofs
-    return function.function( fmap=fmap, nmap=nmap, ndofs=len(dofmap), ndims=self.ndims )
+      fmap.append( ((stdfunc,None),) )
+      nmap.append( dofs )
+    return self.indexedbasis( fmap, nmap, len(dofmap) )
 
   def basis_bubble( self ):
     'bubble from vertices'
 
     assert self.ndims == 2
     dofmap = {}
-    fmap = {}
-    nmap = {}
+    nmap = []
     stdfunc = element.BubbleTriangle()
     for ielem, elem in enumerate(self):
       assert isinstance( elem.reference, element.TriangleReference )
@@ -202,9 +210,8 @@ class Topology( object ):
           dofmap[v] = dof
         dofs[i] = dof
       dofs[ elem.nverts ] = ielem
-      fmap[elem.transform] = (stdfunc,None),
-      nmap[elem.transform] = dofs
-    return function.function( fmap=fmap, nmap=nmap, ndofs=len(self)+len(dofmap), ndims=self.ndims )
+      nmap.append( dofs )
+    return self.indexedbasis( [((stdfunc,None),)] * len(nmap), nmap, len(self)+len(dofmap) )
 
   def basis_spline( self, degree ):
     assert degree == 1
@@ -214,15 +221,15 @@ class Topology( object ):
     'discontinuous shape functions'
 
     assert numeric.isint( degree ) and degree >= 0
-    fmap = {}
-    nmap = {}
+    fmap = []
+    nmap = []
     ndofs = 0
     for elem in self:
       stdfunc = elem.reference.stdfunc(degree)
-      fmap[elem.transform] = (stdfunc,None),
-      nmap[elem.transform] = ndofs + numpy.arange(stdfunc.nshapes)
+      fmap.append( ((stdfunc,None),) )
+      nmap.append( ndofs + numpy.arange(stdfunc.nshapes) )
       ndofs += stdfunc.nshapes
-    return function.function( fmap=fmap, nmap=nmap, ndofs=ndofs, ndims=self.ndims )
+    return self.indexedbasis( fmap, nmap, ndofs )
 
   @log.title
   @core.single_or_multiple
@@ -256,22 +263,24 @@ class Topology( object ):
         idata.append( function.Tuple([ ifunc, (), func ]) )
       retvals.append( retval )
     idata = function.Tuple( idata )
+    edict = self.edict
 
-    fcache = cache.WrapperCache()
-    for ielem, elem in parallel.pariter( log.enumerate( 'elem', self ) ):
-      ipoints, iweights = fcache[elem.reference.getischeme]( ischeme )
-      s = slices[ielem],
-      for ifunc, index, data in idata.eval( elem, ipoints, fcache ):
-        retvals[ifunc][s+numpy.ix_(*[ ind for (ind,) in index ])] += numeric.dot(iweights,data) if geometry else data
+    def evalelems( elems ):
+      fcache = cache.WrapperCache()
+      for ielem, iweights, ivalues in idata.elemeval( elems, ischeme, fcache, edict ):
+        s = slices[ielem],
+        for ifunc, index, data in ivalues:
+          retvals[ifunc][s+numpy.ix_(*[ ind for (ind,) in index ])] += numeric.dot(iweights,data) if geometry else data
+      log.debug( 'cache', fcache.stats )
 
-    log.debug( 'cache', fcache.stats )
+    parallel.parexec( evalelems, log.enumerate( 'elem', self ), len(self) )
     log.info( 'created', ', '.join( '%s(%s)' % ( retval.__class__.__name__, ','.join( str(n) for n in retval.shape ) ) for retval in retvals ) )
 
     if asfunction:
       if geometry:
         retvals = [ function.Elemwise( { elem.transform: value for elem, value in zip( self, retval ) }, shape=retval.shape[1:] ) for retval in retvals ]
       else:
-        tsp = [ ( elem.transform, s, fcache[elem.reference.getischeme](ischeme)[0] ) for elem, s in zip( self, slices ) ]
+        tsp = [ ( elem.transform, s, elem.reference.getischeme(ischeme)[0] ) for elem, s in zip( self, slices ) ]
         retvals = [ function.Sampled({ trans: (retval[s],points) for trans, s, points in tsp }) for retval in retvals ]
     elif separate:
       retvals = [ [ retval[s] for s in slices ] for retval in retvals ]
@@ -286,6 +295,26 @@ class Topology( object ):
     retvals = self.elem_eval( (1,)+funcs, geometry=geometry, ischeme=ischeme )
     return [ v / retvals[0][(slice(None),)+(_,)*(v.ndim-1)] for v in retvals[1:] ]
 
+  @cache.property
+  def _integrationplans( self ):
+    return collections.OrderedDict()
+
+  def _integrationplan( self, indexfunc, block2func, shapes ):
+    '''return the IntegrationPlan for the given block structure, reusing one
+    of the most recently used plans if possible, the number of which is set
+    by the nplans property'''
+
+    key = indexfunc, block2func, shapes
+    plans = self._integrationplans
+    try:
+      plan = plans.pop( key )
+    except KeyError:
+      plan = IntegrationPlan( self, indexfunc, block2func, shapes )
+      while len(plans) >= core.getprop( 'nplans', 4 ):
+        plans.popitem( last=False )
+    plans[key] = plan
+    return plan
+
   def _integrate( self, funcs, ischeme ):
 
     # Functions may consist of several blocks, such as originating from
@@ -298,7 +327,7 @@ class Topology( object ):
 
     block2func, indices, values = zip( *blocks ) if blocks else ([],[],[])
     indexfunc = function.Tuple( indices )
-    valuefunc = function.Tuple( values )
+    valuefunc = function.Tuple([ function.optimize( value ) for value in values ])
 
     log.debug( 'integrating %s distinct blocks' % '+'.join(
       str(block2func.count(ifunc)) for ifunc in range(len(funcs)) ) )
@@ -306,71 +335,48 @@ class Topology( object ):
     if core.getprop( 'dot', False ):
       valuefunc.graphviz()
 
-    fcache = cache.WrapperCache()
-
-    # To allocate (shared) memory for all block data we evaluate indexfunc to
-    # build an nblocks x nelems+1 offset array, and nblocks index lists of
-    # length nelems.
-
-    offsets = numpy.zeros( ( len(blocks), len(self)+1 ), dtype=int )
-    indices = [ [] for i in range( len(blocks) ) ]
+    # The locations of all block data and their indices depend only on
+    # indexfunc, and are reused from earlier integrations of functions with
+    # the same block structure, see IntegrationPlan.
 
-    for ielem, elem in enumerate( self ):
-      for iblock, index in enumerate( indexfunc.eval( elem, None, fcache ) ):
-        n = util.product( len(ind) for (ind,) in index ) if index else 1
-        offsets[iblock,ielem+1] = offsets[iblock,ielem] + n
-        indices[iblock].append([ ind for (ind,) in index ])
+    plan = self._integrationplan( indexfunc, tuple(block2func), tuple( func.shape for func in funcs ) )
+    data = [ parallel.shzeros( n, dtype=float ) for n in plan.nvals ]
 
-    # Since several blocks may belong to the same function, we post process the
-    # offsets to form consecutive intervals in longer arrays. The length of
-    # these arrays is captured in the nfuncs-array nvals.
+    # In a parallel element loop, valuefunc is evaluated to fill data using the
+    # offsets array for location. Each element has its own location so no
+    # locks are required. The element index is passed on along with the
+    # transform index, such that functions on this topology need not search
+    # for the transform.
 
-    nvals = numpy.zeros( len(funcs), dtype=int )
-    for iblock, ifunc in enumerate( block2func ):
-      offsets[iblock] += nvals[ifunc]
-      nvals[ifunc] = offsets[iblock,-1]
+    edict = self.edict
 
-    # The data_index list contains shared memory index and value arrays for
-    # each function argument.
-
-    data_index = [
-      ( parallel.shzeros( n, dtype=float ),
-        parallel.shzeros( (funcs[ifunc].ndim,n), dtype=int ) )
-            for ifunc, n in enumerate(nvals) ]
-
-    # In a second, parallel element loop, valuefunc is evaluated to fill the
-    # data part of data_index using the offsets array for location. Each
-    # element has its own location so no locks are required. The index part of
-    # data_index is filled in the same loop. It does not use valuefunc data but
-    # benefits from parallel speedup.
-
-    for ielem, elem in parallel.pariter( log.enumerate( 'elem', self ) ):
-      ipoints, iweights = fcache[elem.reference.getischeme]( ischeme[elem] if isinstance(ischeme,dict) else ischeme )
-      assert iweights is not None, 'no integration weights found'
-      for iblock, intdata in enumerate( valuefunc.eval( elem, ipoints, fcache ) ):
-        s = slice(*offsets[iblock,ielem:ielem+2])
-        data, index = data_index[ block2func[iblock] ]
-        w_intdata = numeric.dot( iweights, intdata )
-        data[s] = w_intdata.ravel()
-        si = (slice(None),) + (_,) * (w_intdata.ndim-1)
-        for idim, ii in enumerate( indices[iblock][ielem] ):
-          index[idim,s].reshape(w_intdata.shape)[...] = ii[si]
-          si = si[:-1]
+    def integrateelems( elems ):
+      fcache = cache.WrapperCache()
+      for ielem, iweights, ivalues in valuefunc.elemeval( elems, ischeme, fcache, edict ):
+        assert iweights is not None, 'no integration weights found'
+        for iblock, intdata in enumerate( ivalues ):
+          s = slice(*plan.offsets[iblock,ielem:ielem+2])
+          data[ block2func[iblock] ][s] = numeric.dot( iweights, intdata ).ravel()
+      log.debug( 'cache', fcache.stats )
 
-    log.debug( 'cache', fcache.stats )
+    parallel.parexec( integrateelems, log.enumerate( 'elem', self ), len(self) )
 
-    return data_index
+    return plan, data
 
   @log.title
   @core.single_or_multiple
-  def integrate( self, funcs, ischeme, geometry=None, force_dense=False, edit=_identity ):
-    'integrate'
+  def integrate( self, funcs, ischeme, geometry=None, force_dense=False, edit=_identity, out=None ):
+    '''integrate
+
+    Matrices and vectors can be assembled in place by passing the result of an
+    earlier integration with the same sparsity structure as out, one for every
+    function or None to allocate new ones.'''
 
     iwscale = function.J( geometry, self.ndims ) if geometry else 1
     funcs = [ func.unwrap( geometry ) if isinstance( func, IndexedArray ) else func for func in funcs ]
     integrands = [ function.asarray( edit( func * iwscale ) ) for func in funcs ]
-    data_index = self._integrate( integrands, ischeme )
-    return [ matrix.assemble( data, index, integrand.shape, force_dense ) for integrand, (data,index) in zip( integrands, data_index ) ]
+    plan, data = self._integrate( integrands, ischeme )
+    return plan.assemble( data, force_dense, out )
 
   @log.title
   @core.single_or_multiple
@@ -390,12 +396,12 @@ class Topology( object ):
         diagelems.append( elem )
       elif head1 < head2:
         trielems.append( elem )
-    diag_data_index = UnstructuredTopology( self.ndims, diagelems )._integrate( integrands, ischeme )
-    tri_data_index = UnstructuredTopology( self.ndims, trielems )._integrate( integrands, ischeme )
+    diagplan, diagdata = UnstructuredTopology( self.ndims, diagelems )._integrate( integrands, ischeme )
+    triplan, tridata = UnstructuredTopology( self.ndims, trielems )._integrate( integrands, ischeme )
     retvals = []
-    for integrand, (diagdata,diagindex), (tridata,triindex) in zip( integrands, diag_data_index, tri_data_index ):
+    for integrand, diagdata, diagindex, tridata, triindex in zip( integrands, diagdata, diagplan.indices, tridata, triplan.indices ):
       data = numpy.concatenate( [ diagdata, tridata, tridata ], axis=0 )
-      index = numpy.concatenate( [ diagindex, triindex, triindex[::-1] ], axis=1 )
+      index = numpy.concatenate( [ diagindex, triindex, numpy.ravel_multi_index( numpy.unravel_index( triindex, integrand.shape )[::-1], integrand.shape ) ] )
       retvals.append( matrix.assemble( data, index, integrand.shape, force_dense ) )
     return retvals
 
@@ -535,12 +541,50 @@ class Topology( object ):
   def trim( self, levelset, maxrefine, ndivisions=8, name='trimmed' ):
     'trim element along levelset'
 
+    # In a parallel element loop the levelset is evaluated in the vertices of
+    # all elements refined maxrefine times, which are stored consecutively in
+    # shared memory. Elements on which the levelset cannot be evaluated at this
+    # level are marked as failed and left to Reference.trim.
+
+    ischeme = 'vertex%d' % maxrefine
+    elems = tuple( self )
+    offsets = numpy.cumsum( [0] + [ len( elem.reference.getischeme( ischeme )[0] ) for elem in elems ] )
+    levels = parallel.shzeros( offsets[-1], dtype=float )
+    failed = parallel.shzeros( len(elems), dtype=bool )
+
+    def evalelems( elems ):
+      fcache = cache.WrapperCache()
+      for ielem, elem in elems:
+        try:
+          levels[offsets[ielem]:offsets[ielem+1]] = levelset.eval( elem, ischeme, fcache )
+        except function.EvaluationError:
+          failed[ielem] = True
+      log.debug( 'cache', fcache.stats )
+
+    parallel.parexec( evalelems, log.enumerate( 'elem', elems ), len(elems) )
+
+    # Elements are classified as inside, outside or cut by the extreme values
+    # of their levels. Only cut elements are trimmed, using the levels
+    # evaluated above.
+
+    failed = failed.astype( bool )
+    if elems:
+      inside = ~failed & ( numpy.minimum.reduceat( levels, offsets[:-1] ) > 0 )
+      cut = failed | ~inside & ( numpy.maximum.reduceat( levels, offsets[:-1] ) >= 0 )
+    else:
+      inside = cut = failed
+    log.info( '%d elements inside, %d cut' % ( inside.sum(), cut.sum() ) )
+
     fcache = cache.WrapperCache()
     elements = []
-    for elem in log.iter( 'elem', self ):
-      ref = elem.trim( levelset=levelset, maxrefine=maxrefine, ndivisions=ndivisions, fcache=fcache )
-      if ref:
-        elements.append( element.Element( ref, elem.transform, elem.opposite ) )
+    for ielem, elem in enumerate( elems ):
+      if inside[ielem]:
+        elements.append( elem )
+      elif cut[ielem]:
+        ref = elem.reference.trim( (elem.transform,levelset) if failed[ielem] else levels[offsets[ielem]:offsets[ielem+1]],
+          maxrefine=maxrefine, ndivisions=ndivisions, fcache=fcache )
+        if ref:
+          elements.append( element.Element( ref, elem.transform, elem.opposite ) )
     log.debug( 'cache', fcache.stats )
     return self.subset( elements, name, precise=True )
 
@@ -596,6 +640,45 @@ class Topology( object ):
 
     return extractions
 
+  @log.title
+  def prolongation( self, coarse, fine, ischeme, droptol=1e-12 ):
+    '''prolongation matrix of coarse to fine basis
+
+    Returns the sparse matrix P for which coarse[i] = sum_j P[j,i] fine[j],
+    which exists if the coarse basis spans a subspace of the fine basis, as
+    for bases on a topology and its refinement. P is formed by elementwise L2
+    projection of the coarse functions onto the fine functions, which are
+    required to be linearly independent on every element of self; ischeme
+    should integrate their products exactly. Entries that are shared by
+    several elements are averaged.'''
+
+    import scipy.sparse
+
+    assert coarse.ndim == fine.ndim == 1, 'prolongation requires scalar bases'
+    blocks = function.Tuple([ function.Tuple([ function.Tuple( ind_f )
+      for ind_f in function.blocks( func ) ])
+        for func in ( fine, coarse ) ])
+
+    rows, cols, vals = [], [], []
+    for elem in log.iter( 'elem', self ):
+      points, weights = elem.reference.getischeme( ischeme )
+      (find, fval), (cind, cval) = [ ( numpy.concatenate([ ind.ravel() for (ind,), val in ind_val ]), numpy.concatenate([ val for ind, val in ind_val ], axis=1) )
+        for ind_val in blocks.eval( elem, points ) ]
+      M = numeric.dot( weights, fval[:,:,_] * fval[:,_,:] )
+      B = numeric.dot( weights, fval[:,:,_] * cval[:,_,:] )
+      P = numpy.linalg.solve( M, B )
+      I, J = numpy.nonzero( numpy.abs(P) > droptol )
+      rows.append( find[I] )
+      cols.append( cind[J] )
+      vals.append( P[I,J] )
+
+    ij = numpy.concatenate( rows ), numpy.concatenate( cols )
+    vals = numpy.concatenate( vals )
+    P = scipy.sparse.coo_matrix( ( vals, ij ), shape=( fine.shape[0], coarse.shape[0] ) ).tocsr()
+    count = scipy.sparse.coo_matrix( ( numpy.ones_like(vals), ij ), shape=P.shape ).tocsr()
+    P.data /= count.data
+    return matrix.ScipyMatrix( P )
+
   @log.title
   def volume( self, geometry, ischeme='gauss1' ):
     return self.integrate( 1, geometry=geometry, ischeme=ischeme )
@@ -625,46 +708,135 @@ class Topology( object ):
         used[dofs] = True
     return basis[used]
 
+  @cache.property
+  def _boxindices( self ):
+    'box indices per geometry, released along with the geometry'
+    return weakref.WeakKeyDictionary()
+
+  @cache.property
+  def _refinedlevels( self ):
+    'uniform refinements of self, shared by all its hierarchical refinements'
+    return [ self ]
+
+  @cache.property
+  def _levelbases( self ):
+    return {}
+
+  def boxindex( self, geom, ischeme='vertex', scale=1 ):
+    '''spatial index of element bounding boxes, formed by evaluating geom in
+    the points of ischeme and scaled about their mean by scale'''
+
+    boxindices = self._boxindices.setdefault( geom, {} )
+    key = ischeme, scale
+    try:
+      index = boxindices[key]
+    except KeyError:
+      vertices = self.elem_eval( geom, ischeme=ischeme, separate=True )
+      bboxes = numpy.array([ numpy.mean(v,axis=0) * (1-scale) + numpy.array([ numpy.min(v,axis=0), numpy.max(v,axis=0) ]) * scale
+        for v in vertices ]) # nelems x {min,max} x ndims
+      index = boxindices[key] = BoxIndex( bboxes )
+    return index
+
   def locate( self, geom, points, ischeme='vertex', scale=1, tol=1e-12, eps=0, maxiter=100 ):
+    located = self.locatepoints( geom, points, ischeme, scale, tol, eps, maxiter )
+    vref = element.getsimplex(0)
+    pelems = []
+    for ielem, xi in zip( located.ielems, located.xis ):
+      elem = self.elements[ielem]
+      trans = transform.affine( linear=numpy.zeros(shape=(self.ndims,0),dtype=int), offset=xi, isflipped=False )
+      pelems.append( element.Element( vref, elem.transform << trans, elem.opposite << trans ) )
+    return UnstructuredTopology( 0, pelems )
+
+  @log.title
+  def locatepoints( self, geom, points, ischeme='vertex', scale=1, tol=1e-12, eps=0, maxiter=100, previous=None ):
+    '''locate points in elements
+
+    Returns LocatedPoints, which evaluates functions in all points with one
+    evaluation per element. If previous, the LocatedPoints of an earlier
+    query for the same number of points, is given, then each point is first
+    sought in its previous element, starting from its previous local
+    coordinates. For slowly moving points this avoids most index searches.'''
+
     if geom.ndim == 0:
       geom = geom[_]
       points = points[...,_]
     assert geom.shape == (self.ndims,)
     points = numpy.asarray( points, dtype=float )
     assert points.ndim == 2 and points.shape[1] == self.ndims
-    vertices = self.elem_eval( geom, ischeme=ischeme, separate=True )
-    bboxes = numpy.array([ numpy.mean(v,axis=0) * (1-scale) + numpy.array([ numpy.min(v,axis=0), numpy.max(v,axis=0) ]) * scale
-      for v in vertices ]) # nelems x {min,max} x ndims
-    vref = element.getsimplex(0)
-    pelems = []
-    for point in points:
-      ielems, = ((point >= bboxes[:,0,:]) & (point <= bboxes[:,1,:])).all(axis=-1).nonzero()
-      for ielem in sorted( ielems, key=lambda i: numpy.linalg.norm(bboxes[i].mean(0)-point) ):
-        converged = False
+    if previous is not None:
+      assert previous.topo is self and len(previous) == len(points)
+    ielems, xis = self._locate( geom, points, ischeme, scale, tol, eps, maxiter, previous )
+    return LocatedPoints( self, ielems, xis )
+
+  def _locate( self, geom, points, ischeme, scale, tol, eps, maxiter, previous=None ):
+    '''find element indices and local coordinates of points
+
+    Candidate elements are obtained from the bounding box index, and tried in
+    order of distance between point and box center. In every round each
+    unresolved point is assigned its next candidate, after which geom is
+    inverted for all points of an element at once by a vectorized Newton
+    iteration.'''
+
+    ielems = numpy.empty( len(points), dtype=int )
+    xis = numpy.empty( points.shape, dtype=float )
+    found = numpy.zeros( len(points), dtype=bool )
+    geom_J = function.Tuple(( geom, function.localgradient( geom, self.ndims ) ))
+
+    def tryelems( ipoints, ielems_, xi0=None ):
+      order = numpy.argsort( ielems_, kind='mergesort' )
+      groupelems, offsets = numpy.unique( ielems_[order], return_index=True )
+      for ielem, select in zip( groupelems, numpy.split( order, offsets[1:] ) ):
         elem = self.elements[ielem]
-        xi, w = elem.reference.getischeme( 'gauss1' )
-        xi = ( numpy.dot(w,xi) / w.sum() )[_] if len(xi) > 1 else xi.copy()
-        linear = function.TransformChain( True, self.ndims ).eval( elem, xi ).split(self.ndims)[1].linear
-        J = function.localgradient( geom, self.ndims )
-        J = J * linear if numpy.ndim( linear ) == 0 else ( J[:,:,_] * linear[_,:,:] ).sum(1)
-        geom_J = function.Tuple(( geom, J ))
-        for iiter in range( maxiter ):
-          point_xi, J_xi = geom_J.eval( elem, xi )
-          err = numpy.linalg.norm( point - point_xi )
-          if err < tol:
-            converged = True
-            break
-          if iiter and err > prev_err:
-            break
-          prev_err = err
-          xi += numpy.linalg.solve( J_xi, point - point_xi )
-        if converged and elem.reference.inside( xi, eps=eps ):
-          break
-      else:
-        raise Exception( 'failed to locate point', point )
-      trans = transform.affine( linear=numpy.zeros(shape=(self.ndims,0),dtype=int), offset=xi[0], isflipped=False )
-      pelems.append( element.Element( vref, elem.transform << trans, elem.opposite << trans ) )
-    return UnstructuredTopology( 0, pelems )
+        iselect = ipoints[select]
+        xi, converged = self._invert( elem, geom_J, points[iselect], tol, maxiter, xi0=xi0 if xi0 is None else xi0[select] )
+        ok = converged & elem.reference.inside( xi, eps=eps )
+        ielems[ iselect[ok] ] = ielem
+        xis[ iselect[ok] ] = xi[ok]
+        found[ iselect[ok] ] = True
+
+    if previous is not None:
+      tryelems( numpy.arange( len(points) ), previous.ielems, previous.xis )
+      log.debug( '%d/%d points found in previous element' % ( found.sum(), len(points) ) )
+
+    unresolved, = ( ~found ).nonzero()
+    candidates, ranks = self.boxindex( geom, ischeme, scale ).candidates( points[unresolved] )
+    for rank in range( len(ranks)-1 ):
+      ipoints, ielems_ = candidates[ ranks[rank]:ranks[rank+1] ].T
+      ipoints = unresolved[ipoints]
+      select = ~found[ipoints]
+      tryelems( ipoints[select], ielems_[select] )
+
+    if not found.all():
+      raise Exception( 'failed to locate point', points[ numpy.argmin(found) ] )
+    return ielems, xis
+
+  def _invert( self, elem, geom_J, points, tol, maxiter, xi0=None ):
+    '''find local coordinates of points in elem by Newton iteration, starting
+    from xi0 or the element's centroid, returning local coordinates and a
+    convergence mask'''
+
+    xi, w = elem.reference.getischeme( 'gauss1' )
+    xi = numpy.dot(w,xi) / w.sum() if len(xi) > 1 else xi[0]
+    linear = elem.opposite.promote( self.ndims ).split( self.ndims )[1].linear
+    xi = numpy.repeat( xi[_], len(points), axis=0 ) if xi0 is None else numpy.array( xi0, dtype=float )
+    converged = numpy.zeros( len(points), dtype=bool )
+    active = numpy.ones( len(points), dtype=bool )
+    prev_err = numpy.empty( len(points) )
+    for iiter in range( maxiter ):
+      if not active.any():
+        break
+      point_xi, J_xi = geom_J.eval( elem, xi[active] )
+      J_xi = numpy.broadcast_to( J_xi * linear if numpy.ndim( linear ) == 0 else numpy.dot( J_xi, linear ), ( len(point_xi), self.ndims, self.ndims ) )
+      err = numpy.linalg.norm( points[active] - point_xi, axis=1 )
+      iactive, = active.nonzero()
+      done = err < tol
+      converged[ iactive[done] ] = True
+      diverged = ~done & ( err > prev_err[iactive] ) if iiter else numpy.zeros_like( done )
+      update = ~done & ~diverged
+      xi[ iactive[update] ] += numpy.linalg.solve( J_xi[update], ( points[active] - point_xi )[update,:,_] )[...,0]
+      prev_err[iactive] = err
+      active[ iactive[~update] ] = False
+    return xi, converged
 
 class ItemTopology( Topology ):
   'item topology'
@@ -773,6 +945,9 @@ class ItemTopology( Topology ):
   def basis( self, name, *args, **kwargs ):
     return self.basetopo.basis( name, *args, **kwargs )
 
+  def _locate( self, *args ):
+    return self.basetopo._locate( *args )
+
   @cache.property
   def refined( self ):
     subtopos = { name: topo.refined for name, topo in self.subtopos.items() }
@@ -833,7 +1008,48 @@ class StructuredTopology( Topology ):
 
   def __iter__( self ):
     reference = element.getsimplex(1)**self.ndims
-    return ( element.Element( reference, trans, opp ) for trans, opp in zip( self._transform.flat, self._opposite.flat ) )
+    return ( element.Element( reference, trans, opp ) for trans, opp in self._iterpairs() )
+
+  def _iterpairs( self ):
+    '''transformation pairs in element order, taken from the object arrays of
+    _transform and _opposite if these exist, and otherwise generated from the
+    grid index and memoized as these arrays once the pass is complete'''
+
+    if '_transform' in self.__dict__:
+      for pair in zip( self._transform.flat, self._opposite.flat ):
+        yield pair
+      return
+    transforms = []
+    opposites = []
+    for trans, opp in self._itertransforms():
+      transforms.append( trans )
+      opposites.append( opp )
+      yield trans, opp
+    transforms = numeric.asobjvector( transforms ).reshape( self.shape )
+    opposites = numeric.asobjvector( opposites ).reshape( self.shape ) if self._oppaxes else transforms
+    self.__dict__.setdefault( '_transform', transforms )
+    self.__dict__.setdefault( '_opposite', opposites )
+
+  def _itertransforms( self ):
+    '''generate transformation pairs on demand, in element order, without
+    forming the object arrays of _transform and _opposite'''
+
+    oppaxes = self._oppaxes
+    updim = self.mkupdim( self.axes )
+    oppupdim = oppaxes and self.mkupdim( oppaxes )
+    scales = {}
+    for index in numpy.ndindex( *self.shape ):
+      trans = self.mktransform( self.axes, self.root, self.nrefine, index, updim, scales )
+      yield trans, trans if not oppaxes else self.mktransform( oppaxes, self.root, self.nrefine, index, oppupdim, scales )
+
+  def transform_at( self, index ):
+    'transformation pair of the element at grid index'
+
+    index = tuple( index )
+    assert len(index) == self.ndims
+    trans = self.mktransform( self.axes, self.root, self.nrefine, index )
+    oppaxes = self._oppaxes
+    return trans, trans if not oppaxes else self.mktransform( oppaxes, self.root, self.nrefine, index )
 
   def __len__( self ):
     return numpy.prod( self.shape, dtype=int )
@@ -863,14 +1079,18 @@ class StructuredTopology( Topology ):
   def elements( self ):
     return tuple( self )
 
+  @cache.property
+  def edict( self ):
+    '''transform -> ielement mapping, computed from the grid offset of the
+    transform rather than stored per element'''
+    return StructuredIndex( self )
+
   @property
   def periodic( self ):
     return tuple( idim for idim, axis in enumerate(self.axes) if axis.isdim and axis.isperiodic )
 
   @staticmethod
-  def mktransforms( axes, root, nrefine ):
-    assert nrefine >= 0
-
+  def mkupdim( axes ):
     updim = transform.identity
     ndims = len(axes)
     active = numpy.ones( ndims, dtype=bool )
@@ -881,6 +1101,35 @@ class StructuredTopology( Topology ):
       updim <<= transform.affine(matrix,offset,isflipped=(idim%2==1)==side)
       ndims -= 1
       active[idim] = False
+    return updim
+
+  @staticmethod
+  def mktransform( axes, root, nrefine, index, updim=None, scales=None ):
+    '''transformation chain of a single element at grid index, identical to the
+    corresponding entry of mktransforms; the optional scales dictionary
+    memoizes the refinement transformations between calls'''
+
+    if updim is None:
+      updim = StructuredTopology.mkupdim( axes )
+    if scales is None:
+      scales = {}
+    index = iter( index )
+    gridindex = [ axis.i + next(index) if axis.isdim else axis.i-1 if axis.side else axis.j for axis in axes ]
+    trans = transform.affine( 1, [ i >> nrefine for i in gridindex ] )
+    for irefine in range( nrefine-1, -1, -1 ):
+      bits = tuple( ( i >> irefine ) & 1 for i in gridindex )
+      try:
+        scale = scales[bits]
+      except KeyError:
+        scale = scales[bits] = transform.affine( .5, numpy.multiply( bits, .5 ) )
+      trans <<= scale
+    return ( root << trans << updim ).canonical
+
+  @staticmethod
+  def mktransforms( axes, root, nrefine ):
+    assert nrefine >= 0
+
+    updim = StructuredTopology.mkupdim( axes )
 
     grid = [ numpy.arange(axis.i>>nrefine,((axis.j-1)>>nrefine)+1) if axis.isdim else numpy.array([(axis.i-1 if axis.side else axis.j)>>nrefine]) for axis in axes ]
     indices = numeric.broadcast( *numeric.ix(grid) )
@@ -907,11 +1156,19 @@ class StructuredTopology( Topology ):
   @cache.property
   @log.title
   def _opposite( self ):
+    oppaxes = self._oppaxes
+    if not oppaxes:
+      return self._transform
+    return self.mktransforms( oppaxes, self.root, self.nrefine )
+
+  @property
+  def _oppaxes( self ):
+    'axes of the opposite side, None if opposite equals transform'
+
     nbounds = len( self.axes ) - self.ndims
     if nbounds == 0:
-      return self._transform
-    axes = [ BndAxis( axis.i, axis.j, axis.ibound, not axis.side ) if not axis.isdim and axis.ibound==nbounds-1 else axis for axis in self.axes ]
-    return self.mktransforms( axes, self.root, self.nrefine )
+      return None
+    return tuple( BndAxis( axis.i, axis.j, axis.ibound, not axis.side ) if not axis.isdim and axis.ibound==nbounds-1 else axis for axis in self.axes )
 
   @property
   def structure( self ):
@@ -969,9 +1226,10 @@ class StructuredTopology( Topology ):
     else:
       assert len(removedofs) == self.ndims
 
-    vertex_structure = numpy.array( 0 )
-    dofcount = 1
+    numbers = []
+    ndofs = []
     slices = []
+    stdelems = []
 
     for idim in range( self.ndims ):
       periodic_i = idim in periodic
@@ -987,45 +1245,27 @@ class StructuredTopology( Topology ):
         assert neumann ==(), 'Neumann option not allowed for closed spline'
         stdelems_i = element.PolyLine.spline( degree=p, nelems=n, periodic=True )
 
-      stdelems = stdelems[...,_] * stdelems_i if idim else stdelems_i
-
       nd = n + p
-      numbers = numpy.arange( nd )
+      numbers_i = numpy.arange( nd )
       if periodic_i and p > 0:
         overlap = p
-        assert len(numbers) >= 2 * overlap
-        numbers[ -overlap: ] = numbers[ :overlap ]
+        assert len(numbers_i) >= 2 * overlap
+        numbers_i[ -overlap: ] = numbers_i[ :overlap ]
         nd -= overlap
       remove = removedofs[idim]
-      if remove is None:
-        vertex_structure = vertex_structure[...,_] * nd + numbers
-      else:
+      if remove is not None:
         mask = numpy.zeros( nd, dtype=bool )
         mask[numpy.array(remove)] = True
+        renumber = numpy.arange( nd ) - mask.cumsum()
+        renumber[mask] = -1
+        numbers_i = renumber[numbers_i]
         nd -= mask.sum()
-        numbers -= mask.cumsum()
-        vertex_structure = vertex_structure[...,_] * nd + numbers
-        vertex_structure[...,mask] = -1
-      dofcount *= nd
+      numbers.append( numbers_i )
+      ndofs.append( nd )
       slices.append( [ slice(i,i+p+1) for i in range(n) ] )
+      stdelems.append( stdelems_i )
 
-    dofmap = {}
-    funcmap = {}
-    for item in numpy.broadcast( self._transform, stdelems, *numpy.ix_(*slices) ):
-      trans = item[0]
-      std = item[1]
-      S = item[2:]
-      dofs = vertex_structure[S].ravel()
-      mask = dofs >= 0
-      if mask.all():
-        dofmap[trans] = dofs
-        funcmap[trans] = (std,None),
-      else:
-        assert mask.any()
-        dofmap[trans] = dofs[mask]
-        funcmap[trans] = (std,mask),
-
-    return function.function( funcmap, dofmap, dofcount, self.ndims )
+    return TensorBasis( self.shape, numbers, ndofs, slices, stdelems ).function( self.edict )
 
   def basis_bspline( self, degree, knotvalues=None, knotmultiplicities=None, periodic=None ):
     'Bspline from vertices'
@@ -1044,9 +1284,10 @@ class StructuredTopology( Topology ):
     if knotmultiplicities is None:
       knotmultiplicities = [None]*self.ndims
 
-    vertex_structure = numpy.array( 0 )
-    dofcount = 1
+    numbers = []
+    ndofs = []
     slices = []
+    stdelems = []
     cache = {}
     for idim in range( self.ndims ):
       p = degree[idim]
@@ -1109,29 +1350,19 @@ class StructuredTopology( Topology ):
           cache[key] = coeffs
         poly = element.PolyLine( coeffs[:,start:stop] )
         stdelems_i.append( poly )
-      stdelems = stdelems[...,_]*stdelems_i if idim else numpy.array(stdelems_i)
+      stdelems.append( stdelems_i )
 
-      numbers = numpy.arange(nd)
+      numbers_i = numpy.arange(nd)
       if isperiodic:
-        numbers = numpy.concatenate([numbers,numbers[:p]])
-      vertex_structure = vertex_structure[...,_]*nd+numbers
-      dofcount*=nd
+        numbers_i = numpy.concatenate([numbers_i,numbers_i[:p]])
+      numbers.append( numbers_i )
+      ndofs.append( nd )
       slices.append(slices_i)
 
     #Cache effectivity
     log.debug( 'Local knot vector cache effectivity: %d' % (100*(1.-len(cache)/float(sum(self.shape)))) )
 
-    dofmap = {}
-    funcmap = {}
-    for item in numpy.broadcast( self._transform, stdelems, *numpy.ix_(*slices) ):
-      trans = item[0]
-      std = item[1]
-      S = item[2:]
-      dofs = vertex_structure[S].ravel()
-      dofmap[trans] = dofs
-      funcmap[trans] = (std,None),
-
-    return function.function( funcmap, dofmap, dofcount, self.ndims )
+    return TensorBasis( self.shape, numbers, ndofs, slices, stdelems ).function( self.edict )
 
   @staticmethod
   def _localsplinebasis ( lknots, p ):
@@ -1178,14 +1409,12 @@ class StructuredTopology( Topology ):
     assert all( p >= 0 for p in degree )
 
     stdfunc = util.product( element.PolyLine( element.PolyLine.bernstein_poly(p) ) for p in degree )
-      
-    fmap = {}
-    nmap = {}
-    ndofs = 0
-    for elem in self:
-      fmap[elem.transform] = (stdfunc,None),
-      nmap[elem.transform] = ndofs + numpy.arange(stdfunc.nshapes)
-      ndofs += stdfunc.nshapes
+    nelems = len(self)
+    ndofs = nelems * stdfunc.nshapes
+    stdkeeps = [ ((stdfunc,None),) ] * nelems
+    dofs = function.CSRTable( numpy.arange( nelems+1 ) * stdfunc.nshapes, numpy.arange( ndofs ) )
+    fmap = function.IndexedMap( self.edict, stdkeeps.__getitem__ )
+    nmap = function.IndexedMap( self.edict, dofs.__getitem__ )
     return function.function( fmap=fmap, nmap=nmap, ndofs=ndofs, ndims=self.ndims )
 
   def basis_std( self, degree, removedofs=None ):
@@ -1199,49 +1428,34 @@ class StructuredTopology( Topology ):
     else:
       assert len(removedofs) == self.ndims
 
-    vertex_structure = numpy.array( 0 )
-    dofcount = 1
+    numbers = []
+    ndofs = []
     slices = []
-
-    stdelem = util.product( element.PolyLine( element.PolyLine.bernstein_poly( d ) ) for d in degree )
+    stdelems = []
 
     for idim in range( self.ndims ):
       n = self.shape[idim]
       p = degree[idim]
 
       nd = n * p + 1
-      numbers = numpy.arange( nd )
+      numbers_i = numpy.arange( nd )
       if idim in self.periodic and p > 0:
-        numbers[-1] = numbers[0]
+        numbers_i[-1] = numbers_i[0]
         nd -= 1
       remove = removedofs[idim]
-      if remove is None:
-        vertex_structure = vertex_structure[...,_] * nd + numbers
-      else:
+      if remove is not None:
         mask = numpy.zeros( nd, dtype=bool )
         mask[numpy.array(remove)] = True
+        renumber = numpy.arange( nd ) - mask.cumsum()
+        renumber[mask] = -1
+        numbers_i = renumber[numbers_i]
         nd -= mask.sum()
-        numbers -= mask.cumsum()
-        vertex_structure = vertex_structure[...,_] * nd + numbers
-        vertex_structure[...,mask] = -1
-      dofcount *= nd
+      numbers.append( numbers_i )
+      ndofs.append( nd )
       slices.append( [ slice(p*i,p*i+p+1) for i in range(n) ] )
+      stdelems.append( [ element.PolyLine( element.PolyLine.bernstein_poly( p ) ) ] * n )
 
-    dofmap = {}
-    funcmap = {}
-    for item in numpy.broadcast( self._transform, *numpy.ix_(*slices) ):
-      trans = item[0]
-      S = item[1:]
-      dofs = vertex_structure[S].ravel()
-      mask = dofs >= 0
-      if mask.all():
-        dofmap[ trans ] = dofs
-        funcmap[ trans ] = (stdelem,None),
-      elif mask.any():
-        dofmap[ trans ] = dofs[mask]
-        funcmap[ trans ] = (stdelem,mask),
-
-    return function.function( funcmap, dofmap, dofcount, self.ndims )
+    return TensorBasis( self.shape, numbers, ndofs, slices, stdelems ).function( self.edict )
 
   @property
   def refined( self ):
@@ -1251,6 +1465,67 @@ class StructuredTopology( Topology ):
         else BndAxis(i=axis.i*2,j=axis.j*2,ibound=axis.ibound,side=axis.side) for axis in self.axes ]
     return StructuredTopology( self.root, axes, self.nrefine+1 )
 
+  @cache.property
+  def _rectilineargrids( self ):
+    'rectilinear grids per geometry, released along with the geometry'
+    return weakref.WeakKeyDictionary()
+
+  def rectilineargrid( self, geom ):
+    '''vertex coordinates per axis if geom maps every element affinely onto an
+    axis aligned box of a tensor grid, None otherwise'''
+
+    try:
+      return self._rectilineargrids[geom]
+    except KeyError:
+      pass
+    grid = None
+    if geom.shape == (self.ndims,) and self.ndims:
+      xi, w = ( element.getsimplex(1)**self.ndims ).getischeme( 'vertex1' )
+      x = self.elem_eval( geom, ischeme='vertex1', separate=False ).reshape( self.shape + xi.shape )
+      corners = numpy.array([ (xi==0).all(1), (xi==1).all(1) ]).argmax( axis=1 )
+      lo = x[...,corners[0],:]
+      hi = x[...,corners[1],:]
+      affine = lo[...,_,:] + xi * ( hi - lo )[...,_,:]
+      if numpy.all( hi > lo ) and numpy.allclose( x, affine, rtol=0, atol=1e-12*numpy.abs(x).max() ):
+        grid = []
+        for idim, n in enumerate( self.shape ):
+          index = (0,)*idim + (slice(None),) + (0,)*(self.ndims-idim-1) + (idim,)
+          vertices = numpy.append( lo[index], hi[index][-1] )
+          expand = (_,)*idim + (slice(None),) + (_,)*(self.ndims-idim-1)
+          if not ( numpy.all( lo[...,idim] == vertices[:-1][expand] ) and numpy.all( hi[...,idim] == vertices[1:][expand] ) ):
+            grid = None
+            break
+          grid.append( vertices )
+    self._rectilineargrids[geom] = grid
+    return grid
+
+  def _locate( self, geom, points, ischeme, scale, tol, eps, maxiter, previous=None ):
+    '''find element indices and local coordinates of points, by bisection of
+    the vertex coordinates and affine inversion if geom is rectilinear
+
+    Since rectilineargrid only inspects geom in the element vertices, the
+    result is verified by evaluating geom in the located points. Points with
+    a residual exceeding tol are located by the generic Newton path, starting
+    from the affine estimate.'''
+
+    grid = self.rectilineargrid( geom )
+    if grid is None:
+      return Topology._locate( self, geom, points, ischeme, scale, tol, eps, maxiter, previous )
+    index = numpy.array([ numpy.searchsorted( vertices, x, side='right' ) - 1 for vertices, x in zip( grid, points.T ) ])
+    index = numpy.minimum( numpy.maximum( index, 0 ), numpy.array( self.shape )[:,_]-1 )
+    lo = numpy.array([ vertices[i] for vertices, i in zip( grid, index ) ])
+    hi = numpy.array([ vertices[i+1] for vertices, i in zip( grid, index ) ])
+    xis = ( ( points.T - lo ) / ( hi - lo ) ).T
+    ielems = numpy.ravel_multi_index( index, self.shape )
+    outside = ~( ( xis >= -eps ) & ( xis <= 1+eps ) ).all( axis=1 )
+    residual = numpy.linalg.norm( LocatedPoints( self, ielems, xis ).eval( geom ) - points, axis=1 )
+    retry, = ( outside | ( residual > tol ) ).nonzero()
+    if len(retry):
+      log.info( '%d/%d points not resolved by affine inversion, falling back on newton' % ( len(retry), len(points) ) )
+      guess = LocatedPoints( self, ielems[retry], xis[retry] )
+      ielems[retry], xis[retry] = Topology._locate( self, geom, points[retry], ischeme, scale, tol, eps, maxiter, previous=guess )
+    return ielems, xis
+
   def __str__( self ):
     'string representation'
 
@@ -1654,16 +1929,29 @@ class HierarchicalTopology( Topology ):
 
   @cache.property
   @log.title
-  def levels( self ):
-    levels = [ self.basetopo ]
-    for elem in self:
+  def _levelindex( self ):
+    '''uniform refinements of basetopo up to the finest level of self, and
+    the level and index within that level of every element'''
+
+    levels = self.basetopo._refinedlevels
+    ilevels = numpy.empty( len(self), dtype=int )
+    indices = numpy.empty( len(self), dtype=int )
+    for ielem, elem in enumerate( self ):
       trans = elem.transform.lookup( self.basetopo.edict )
       assert trans, 'element is not a refinement of basetopo'
       nrefine = len(elem.transform) - len(trans)
       while nrefine >= len(levels):
         levels.append( levels[-1].refined )
-      assert elem.transform in levels[nrefine].edict, 'element is not a refinement of basetopo'
-    return tuple(levels)
+      index = levels[nrefine].edict.get( elem.transform )
+      assert index is not None, 'element is not a refinement of basetopo'
+      ilevels[ielem] = nrefine
+      indices[ielem] = index
+    nlevels = ilevels.max()+1 if len(ilevels) else 1
+    return tuple(levels[:nlevels]), ilevels, indices
+
+  @property
+  def levels( self ):
+    return self._levelindex[0]
 
   @cache.property
   def refined( self ):
@@ -1712,71 +2000,50 @@ class HierarchicalTopology( Topology ):
     # least one supporting element coinsiding with self ('touched') and no
     # supporting element finer than self ('supported').
 
-    collect = {}
-    ndofs = 0 # total number of dofs of new function object
-    remaining = len(self) # element count down (know when to stop)
-
-    for topo in log.iter( 'level', self.levels ):
-
-      funcsp = topo.basis( name, *args, **kwargs ) # shape functions for current level
-      supported = numpy.ones( funcsp.shape[0], dtype=bool ) # True if dof is fully contained in self or parents
-      touchtopo = numpy.zeros( funcsp.shape[0], dtype=bool ) # True if dof touches at least one elem in self
-      myelems = [] # all top-level or parent elements in current level
+    levels, ilevels, indices = self._levelindex
+    try:
+      leveldata = self.basetopo._levelbases.setdefault( ( name, args, tuple(sorted(kwargs.items())) ), [] )
+    except TypeError: # unhashable arguments
+      leveldata = []
+    for topo in log.iter( 'level', levels[len(leveldata):] ):
+      leveldata.append( self._leveldata( topo, leveldata[-1][0] if leveldata else None, name, args, kwargs ) )
 
-      (axes,func), = function.blocks( funcsp )
-      dofmap, = axes
-      stdmap = func.stdmap
-      for elem in topo:
-        trans = elem.transform
-        idofs, = dofmap.eval( elem )
-        stds = stdmap[trans]
-        mytrans = trans.lookup( self.edict )
-        if mytrans == trans: # trans is in domain
-          remaining -= 1
-          touchtopo[idofs] = True
-          myelems.append(( trans, idofs, stds ))
-        elif mytrans: # trans is finer than domain
-          supported[idofs] = False
-        else: # trans is coarser than domain
-          myelems.append(( trans, idofs, stds ))
-  
+    ndofs = 0 # total number of dofs of new function object
+    keeps = []
+    renumbers = []
+    for ilevel, (topo, dofs, stds, parents, nleveldofs) in enumerate( leveldata[:len(levels)] ):
+      inself = numpy.zeros( len(topo), dtype=bool ) # True if elem is in self
+      inself[ indices[ ilevels == ilevel ] ] = True
+      finer = numpy.zeros( len(topo), dtype=bool ) if not ilevel else covered[parents] # True if elem is finer than self
+      supported = numpy.ones( nleveldofs, dtype=bool ) # True if dof is fully contained in self or parents
+      supported[ dofs.select( finer ) ] = False
+      touchtopo = numpy.zeros( nleveldofs, dtype=bool ) # True if dof touches at least one elem in self
+      touchtopo[ dofs.select( inself ) ] = True
       keep = numpy.logical_and( supported, touchtopo ) # THE refinement law
-      renumber = (ndofs-1) + keep.cumsum()
-
-      for trans, idofs, stds in myelems: # loop over all top-level or parent elements in current level
-        (std,origkeep), = stds
-        assert origkeep is None
-        mykeep = keep[idofs]
-        if mykeep.all():
-          newstds = (std,None),
-          newdofs = renumber[idofs]
-        elif mykeep.any():
-          newstds = (std,mykeep),
-          newdofs = renumber[idofs[mykeep]]
-        else:
-          newstds = (None,None),
-          newdofs = numpy.zeros( [0], dtype=int )
-        if topo != self.basetopo:
-          olddofs, oldstds = collect[ trans[:-1] ] # dofs, stds of all underlying 'broader' shapes
-          newstds += oldstds
-          newdofs = numpy.hstack([ newdofs, olddofs ])
-        collect[ trans ] = newdofs, newstds # add result to IEN mapping of new function object
-  
+      keeps.append( keep )
+      renumbers.append( (ndofs-1) + keep.cumsum() )
       ndofs += int( keep.sum() ) # update total number of dofs
-      if not remaining:
-        break
+      covered = inself | finer
 
-    nmap = {}
-    fmap = {}
-    check = numpy.zeros( ndofs, dtype=bool )
-    for elem in self:
-      dofs, stds = collect[ elem.transform ]
-      nmap[ elem.transform ] = dofs
-      fmap[ elem.transform ] = stds
-      check[dofs] = True
-    assert check.all()
+    basis = HierarchicalBasis( leveldata[:len(levels)], keeps, renumbers, ilevels, indices )
+    return basis.function( self.edict, ndofs, self.ndims )
 
-    return function.function( fmap=fmap, nmap=nmap, ndofs=ndofs, ndims=self.ndims )
+  @staticmethod
+  def _leveldata( topo, coarse, name, args, kwargs ):
+    '''basis of a single level in element order: csr dof table, (stdelem,keep)
+    tuples, and the element index of the parents in the coarser level'''
+
+    basis = topo.basis( name, *args, **kwargs )
+    (axes,func), = function.blocks( basis )
+    dofmap, = axes
+    if isinstance( dofmap, function.DofMap ) and dofmap.indexed and isinstance( func.stdmap, function.IndexedMap ):
+      dofs = [ dofmap.dofmap.getitem( ielem ) for ielem in range( len(topo) ) ]
+      stds = [ func.stdmap.getitem( ielem ) for ielem in range( len(topo) ) ]
+    else:
+      dofs = [ dofmap.eval( elem )[0] for elem in topo ]
+      stds = [ func.stdmap[ elem.transform ] for elem in topo ]
+    parents = None if coarse is None else numpy.array([ coarse.edict[ elem.transform.sliceto(-1) ] for elem in topo ], dtype=int )
+    return topo, function.CSRTable.fromrows( dofs ), stds, parents, basis.shape[0]
 
 class RevolvedTopology( Topology ):
   'revolved'
@@ -1804,12 +2071,12 @@ class RevolvedTopology( Topology ):
 
   @log.title
   @core.single_or_multiple
-  def integrate( self, funcs, ischeme, geometry, force_dense=False, edit=_identity ):
+  def integrate( self, funcs, ischeme, geometry, force_dense=False, edit=_identity, out=None ):
     iwscale = function.jacobian( geometry, self.ndims+1 ) * function.Iwscale(self.ndims)
     funcs = [ func.unwrap( geometry ) if isinstance( func, IndexedArray ) else func for func in funcs ]
     integrands = [ function.asarray( edit( func * iwscale ) ) for func in funcs ]
-    data_index = self._integrate( integrands, ischeme )
-    return [ matrix.assemble( data, index, integrand.shape, force_dense ) for integrand, (data,index) in zip( integrands, data_index ) ]
+    plan, data = self._integrate( integrands, ischeme )
+    return plan.assemble( data, force_dense, out )
 
   def basis( self, name, *args, **kwargs ):
     return function.revolved( self.basetopo.basis( name, *args, **kwargs ) )
@@ -1821,6 +2088,373 @@ class RevolvedTopology( Topology ):
     return RevolvedTopology( self.basetopo.refined_by(refine) )
 
 
+class IntegrationPlan( object ):
+  '''data layout for integrating functions of fixed block structure
+
+  Evaluates the index functions of all blocks on every element of topo, to
+  determine the location of each element's block data in the consecutive data
+  arrays of the integrated functions (offsets), and the flat, row major
+  position of every value in its function (indices). Sparsity patterns of
+  matrices are formed when first needed. A plan is reused for all subsequent
+  integrations of functions with the same indexfunc, such as in a Newton or
+  time stepping loop, so that only values need to be evaluated.'''
+
+  def __init__( self, topo, indexfunc, block2func, shapes ):
+    'constructor'
+
+    self.shapes = shapes
+    fcache = cache.WrapperCache()
+
+    # We evaluate indexfunc to build an nblocks x nelems+1 offset array, and
+    # the flat indices of every block on every element.
+
+    offsets = numpy.zeros( ( len(block2func), len(topo)+1 ), dtype=int )
+    blockindices = [ [] for ifunc in shapes ]
+    for ielem, weights, blocks in indexfunc.elemeval( enumerate( topo ), None, fcache, topo.edict ):
+      for iblock, index in enumerate( blocks ):
+        n = util.product( len(ind) for (ind,) in index ) if index else 1
+        offsets[iblock,ielem+1] = offsets[iblock,ielem] + n
+        shape = shapes[ block2func[iblock] ]
+        if shape:
+          blockindices[ block2func[iblock] ].append( ( iblock, ielem, numpy.ravel_multi_index( numpy.ix_( *[ ind for (ind,) in index ] ), shape ).ravel() ) )
+
+    # Since several blocks may belong to the same function, we post process the
+    # offsets to form consecutive intervals in longer arrays. The length of
+    # these arrays is captured in the nfuncs-array nvals.
+
+    nvals = numpy.zeros( len(shapes), dtype=int )
+    for iblock, ifunc in enumerate( block2func ):
+      offsets[iblock] += nvals[ifunc]
+      nvals[ifunc] = offsets[iblock,-1]
+
+    self.indices = []
+    for n, shape, iblockindices in zip( nvals, shapes, blockindices ):
+      index = numpy.empty( n if shape else 0, dtype=int )
+      for iblock, ielem, ind in iblockindices:
+        index[ offsets[iblock,ielem]:offsets[iblock,ielem+1] ] = ind
+      self.indices.append( index )
+
+    self.offsets = offsets
+    self.nvals = nvals
+    self._patterns = {}
+
+  def pattern( self, ifunc ):
+    'sparsity pattern of matrix-valued function ifunc'
+
+    try:
+      pattern = self._patterns[ifunc]
+    except KeyError:
+      pattern = self._patterns[ifunc] = matrix.SparsityPattern( self.indices[ifunc], self.shapes[ifunc] )
+    return pattern
+
+  def assemble( self, data, force_dense=False, out=None ):
+    'assemble data of all functions, optionally in place'
+
+    if out is None:
+      out = [ None ] * len(data)
+    elif not isinstance( out, (list,tuple) ):
+      out = [ out ]
+    assert len(out) == len(data)
+    return [ matrix.assemble( idata, self.pattern(ifunc) if len(shape) == 2 and not force_dense else self.indices[ifunc], shape, force_dense, iout )
+      for ifunc, (idata, shape, iout) in enumerate( zip( data, self.shapes, out ) ) ]
+
+class LocatedPoints( object ):
+  '''points of a topology given by element indices and local coordinates,
+  such as obtained from Topology.locatepoints
+
+  Points are grouped by element, so that functions can be evaluated in all
+  points of an element with a single evaluation.'''
+
+  def __init__( self, topo, ielems, xis ):
+    'constructor'
+
+    self.topo = topo
+    self.ielems = ielems
+    self.xis = xis
+    self.order = numpy.argsort( ielems, kind='mergesort' )
+    self.groupelems, offsets = numpy.unique( ielems[self.order], return_index=True )
+    self.offsets = numpy.append( offsets, len(ielems) )
+
+  def __len__( self ):
+    return len( self.ielems )
+
+  @log.title
+  @core.single_or_multiple
+  def eval( self, funcs ):
+    'evaluate functions in all points, in order of the located points'
+
+    funcs = [ function.asarray( func ) for func in funcs ]
+    valuefunc = function.Tuple( funcs )
+    retvals = [ parallel.shzeros( (len(self),)+func.shape, dtype=float ) for func in funcs ]
+    elements = self.topo.elements
+
+    def evalgroups( igroups ):
+      fcache = cache.WrapperCache()
+      for igroup in igroups:
+        select = self.order[ self.offsets[igroup]:self.offsets[igroup+1] ]
+        for retval, value in zip( retvals, valuefunc.eval( elements[self.groupelems[igroup]], self.xis[select], fcache ) ):
+          retval[select] = value
+      log.debug( 'cache', fcache.stats )
+
+    parallel.parexec( evalgroups, log.range( 'group', len(self.groupelems) ), len(self.groupelems) )
+    return retvals
+
+class BoxIndex( object ):
+  '''uniform bin grid over bounding boxes
+
+  The bounding box of all boxes is divided into roughly as many bins as there
+  are boxes, and every box is registered with all bins it overlaps, in csr
+  format, such that the boxes containing a point are found by inspecting a
+  single bin.'''
+
+  def __init__( self, bboxes ):
+    'constructor'
+
+    self.bboxes = numpy.asarray( bboxes, dtype=float ) # nboxes x {min,max} x ndims
+    nboxes, two, ndims = self.bboxes.shape
+    self.lo = self.bboxes[:,0].min( axis=0 ) if nboxes else numpy.zeros( ndims )
+    hi = self.bboxes[:,1].max( axis=0 ) if nboxes else numpy.ones( ndims )
+    size = numpy.maximum( hi - self.lo, 1e-15 )
+    self.shape = numpy.maximum( numpy.round( size * ( nboxes / numpy.prod(size) )**(1./ndims) ), 1 ).astype( int ) if ndims else numpy.zeros( 0, dtype=int )
+    self.binsize = size / self.shape
+    imin = self._bin( self.bboxes[:,0] )
+    ext = self._bin( self.bboxes[:,1] ) - imin + 1
+    ibins = []
+    iboxes = []
+    for offset in numpy.ndindex( *ext.max( axis=0 ) if nboxes else () ):
+      select, = ( offset < ext ).all( axis=1 ).nonzero()
+      ibins.append( numpy.ravel_multi_index( ( imin[select] + offset ).T, self.shape ) )
+      iboxes.append( select )
+    ibins = numpy.concatenate( ibins ) if ibins else numpy.zeros( 0, dtype=int )
+    order = numpy.argsort( ibins, kind='mergesort' )
+    self.boxes = numpy.concatenate( iboxes )[order] if iboxes else numpy.zeros( 0, dtype=int )
+    self.offsets = numpy.searchsorted( ibins[order], numpy.arange( numpy.prod(self.shape)+1 ) )
+
+  def _bin( self, points ):
+    return numpy.minimum( numpy.maximum( numpy.floor( ( points - self.lo ) / self.binsize ), 0 ), self.shape-1 ).astype( int )
+
+  def candidates( self, points ):
+    '''return pairs of point and box indices for all boxes containing the
+    points, sorted per point by distance to the box center, and the offsets
+    of the groups of n-th candidates of all points'''
+
+    points = numpy.asarray( points, dtype=float )
+    ibins = numpy.ravel_multi_index( self._bin( points ).T, self.shape )
+    counts = self.offsets[ibins+1] - self.offsets[ibins]
+    ipoints = numpy.repeat( numpy.arange( len(points) ), counts )
+    ncum = numpy.cumsum( counts )
+    iboxes = self.boxes[ numpy.arange( ncum[-1] if len(ncum) else 0 ) - numpy.repeat( ncum - counts - self.offsets[ibins], counts ) ]
+    bboxes = self.bboxes[iboxes]
+    inside = ( ( points[ipoints] >= bboxes[:,0] ) & ( points[ipoints] <= bboxes[:,1] ) ).all( axis=1 )
+    ipoints = ipoints[inside]
+    iboxes = iboxes[inside]
+    dist = numpy.linalg.norm( self.bboxes[iboxes].mean(1) - points[ipoints], axis=1 )
+    order = numpy.lexsort([ dist, ipoints ])
+    ipoints = ipoints[order]
+    iboxes = iboxes[order]
+    start = numpy.searchsorted( ipoints, ipoints )
+    rank = numpy.arange( len(ipoints) ) - start
+    order = numpy.argsort( rank, kind='mergesort' )
+    ranks = numpy.searchsorted( rank[order], numpy.arange( rank.max()+2 if len(rank) else 1 ) )
+    return numpy.array([ ipoints[order], iboxes[order] ]).T, ranks
+
+class StructuredIndex( transform.TransformIndex ):
+  '''transform -> element index mapping of a structured topology
+
+  The grid index of a candidate transform follows from its offset relative to
+  the root, which in every dimension of the topology is the grid index scaled
+  by the refinement level. The candidate is accepted if it equals the
+  transform of the element at that grid index. Nothing is stored per
+  element.'''
+
+  __slots__ = 'topo', 'nroot', 'nitems', 'axes'
+
+  def __init__( self, topo ):
+    'constructor'
+
+    transform.TransformIndex.__init__( self )
+    self.topo = topo
+    self.nroot = len( topo.root )
+    self.nitems = len( topo.transform_at( (0,)*topo.ndims )[0] )
+    self.axes = tuple( ( iaxis, axis.i, axis.j - axis.i ) for iaxis, axis in enumerate( topo.axes ) if axis.isdim )
+
+  def _index( self, trans ):
+    'element index of trans, None if it is not an element of the topology'
+
+    if len(trans) != self.nitems or trans[:self.nroot] != self.topo.root:
+      return None
+    offset = transform.TransformChain( trans[self.nroot:] ).offset * 2**self.topo.nrefine
+    index = []
+    for iaxis, i, n in self.axes:
+      j = int( round( offset[iaxis] ) ) - i
+      if not 0 <= j < n:
+        return None
+      index.append( j )
+    ielem = numpy.ravel_multi_index( index, self.topo.shape ) if index else 0
+    transforms = self.topo.__dict__.get( '_transform' )
+    elemtrans = transforms.flat[ielem] if transforms is not None else self.topo.transform_at( index )[0]
+    return ielem if trans == elemtrans else None
+
+  def __getitem__( self, trans ):
+    ielem = self._index( trans )
+    if ielem is None:
+      raise KeyError( trans )
+    return ielem
+
+  def __contains__( self, trans ):
+    return self._index( trans ) is not None
+
+  def get( self, trans, default=None ):
+    ielem = self._index( trans )
+    return default if ielem is None else ielem
+
+  def __iter__( self ):
+    return ( trans for trans, opp in self.topo._iterpairs() )
+
+  def __len__( self ):
+    return len( self.topo )
+
+  keys = collections.abc.Mapping.keys
+  items = collections.abc.Mapping.items
+  values = collections.abc.Mapping.values
+
+  @property
+  def fromdims( self ):
+    return self.topo.ndims
+
+class TensorBasis( object ):
+  '''tensor product basis on a structured topology
+
+  Every axis is described by its dof numbers (-1 for removed dofs), its number
+  of dofs, the slice of dof numbers supported by each element, and the
+  standard element of each element, which are typically shared between many
+  elements. The dofs and shape functions of an element follow from its grid
+  index, without storing anything per element.'''
+
+  def __init__( self, shape, numbers, ndofs, slices, stdelems ):
+    'constructor'
+
+    assert len(shape) == len(numbers) == len(ndofs) == len(slices) == len(stdelems)
+    self.shape = tuple( shape )
+    self.ndofs = tuple( ndofs )
+    self.axisdofs = [] # per axis and element: dof numbers along axis
+    self.axiskeys = [] # per axis and element: index of distinct (stdelem,mask) pair
+    self.axisstdkeep = [] # per axis: distinct (stdelem,mask) pairs
+    for n, numbers_i, slices_i, stdelems_i in zip( self.shape, numbers, slices, stdelems ):
+      assert len(slices_i) == len(stdelems_i) == n
+      numbers_i = numpy.asarray( numbers_i )
+      dofs = [ numbers_i[s] for s in slices_i ]
+      pairs = {}
+      keys = [ pairs.setdefault( ( std, tuple( d >= 0 ) ), len(pairs) ) for std, d in zip( stdelems_i, dofs ) ]
+      self.axisdofs.append( dofs )
+      self.axiskeys.append( keys )
+      self.axisstdkeep.append( sorted( pairs, key=pairs.__getitem__ ) )
+    self.removed = [ any( ( d < 0 ).any() for d in dofs ) for dofs in self.axisdofs ]
+    self._stdkeep = {}
+
+  @property
+  def length( self ):
+    return numpy.prod( self.ndofs, dtype=int )
+
+  def _unravel( self, ielem ):
+    index = []
+    for n in reversed( self.shape ):
+      ielem, i = divmod( ielem, n )
+      index.append( i )
+    return index[::-1]
+
+  def dofs( self, ielem ):
+    'global dof numbers of the shape functions of element ielem'
+
+    dofs = None
+    for i, axisdofs, nd, removed in zip( self._unravel( ielem ), self.axisdofs, self.ndofs, self.removed ):
+      numbers = axisdofs[i]
+      dofs = numbers if dofs is None else numpy.add.outer( dofs * nd, numbers )
+      if removed:
+        dofs[...,numbers<0] = -1
+    dofs = dofs.ravel()
+    return dofs if not any( self.removed ) else dofs[ dofs >= 0 ]
+
+  def stdkeep( self, ielem ):
+    'standard element and mask of retained shape functions of element ielem'
+
+    key = tuple( keys[i] for i, keys in zip( self._unravel( ielem ), self.axiskeys ) )
+    try:
+      return self._stdkeep[key]
+    except KeyError:
+      pass
+    pairs = [ stdkeep[k] for k, stdkeep in zip( key, self.axisstdkeep ) ]
+    std = util.product( std for std, keep in pairs )
+    mask = functools.reduce( numpy.logical_and.outer, ( numpy.array( keep ) for std, keep in pairs ) ).ravel()
+    stdkeep = self._stdkeep[key] = (std,None if mask.all() else mask),
+    return stdkeep
+
+  def function( self, edict ):
+    'function object with dofs and shape functions looked up via edict'
+
+    return function.function( function.IndexedMap( edict, self.stdkeep ), function.IndexedMap( edict, self.dofs ), self.length, len(self.shape) )
+
+class HierarchicalBasis( object ):
+  '''hierarchical basis by element index
+
+  Elements are identified by their refinement level and their index within
+  that level. An element is supported by the dofs of its own level and of all
+  its parents, of which only those selected by the keep mask of the level are
+  retained and renumbered. Level data are tuples of the level topology, the
+  csr dof table, the (stdelem,keep) tuples and the parent indices.'''
+
+  def __init__( self, leveldata, keeps, renumbers, ilevels, indices ):
+    'constructor'
+
+    self.leveldata = leveldata
+    self.keeps = keeps
+    self.renumbers = renumbers
+    self.ilevels = ilevels
+    self.indices = indices
+    self._last = None, None
+
+  def _collect( self, ielem ):
+    last, result = self._last
+    if last == ielem:
+      return result
+    index = self.indices[ielem]
+    newdofs = []
+    newstds = []
+    for ilevel in range( self.ilevels[ielem], -1, -1 ):
+      topo, dofs, stds, parents, nleveldofs = self.leveldata[ilevel]
+      idofs = dofs[index]
+      (std,origkeep), = stds[index]
+      assert origkeep is None
+      mykeep = self.keeps[ilevel][idofs]
+      if mykeep.all():
+        newstds.append(( std, None ))
+        newdofs.append( self.renumbers[ilevel][idofs] )
+      elif mykeep.any():
+        newstds.append(( std, mykeep ))
+        newdofs.append( self.renumbers[ilevel][idofs[mykeep]] )
+      else:
+        newstds.append(( None, None ))
+      if ilevel:
+        index = parents[index]
+    result = numpy.concatenate( newdofs ) if newdofs else numpy.zeros( 0, dtype=int ), tuple( newstds )
+    self._last = ielem, result
+    return result
+
+  def dofs( self, ielem ):
+    'global dof numbers of the shape functions of element ielem'
+
+    return self._collect( ielem )[0]
+
+  def stdkeep( self, ielem ):
+    'standard elements and masks of retained shape functions of element ielem'
+
+    return self._collect( ielem )[1]
+
+  def function( self, edict, ndofs, ndims ):
+    'function object with dofs and shape functions looked up via edict'
+
+    return function.function( function.IndexedMap( edict, self.stdkeep ), function.IndexedMap( edict, self.dofs ), ndofs, ndims )
+
 # UTILITY FUNCTIONS
 
 DimAxis = collections.namedtuple( 'DimAxis', ['i','j','isperiodic'] )
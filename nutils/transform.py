@@ -206,6 +206,24 @@ class CanonicalTransformChain( TransformChain ):
 
 mayswap = lambda trans1, trans2: isinstance( trans1, Scale ) and trans1.linear == .5 and trans2.todims == trans2.fromdims + 1 and trans2.fromdims > 0
 
+class TransformIndex( dict ):
+  '''transform -> dense index mapping, compared and hashed by identity such
+  that it can parameterize evaluables without hashing its items'''
+
+  __slots__ = ()
+  __hash__ = object.__hash__
+
+  def __eq__( self, other ):
+    return self is other
+
+  def __ne__( self, other ):
+    return self is not other
+
+  @property
+  def fromdims( self ):
+    for trans in self:
+      return trans.fromdims
+
 
 ## TRANSFORM ITEMS
 
@@ -436,6 +436,9 @@ def run( *functions ):
     print( '''
   --help                  Display this help
   --nprocs=%(nprocs)-14s Select number of processors
+  --parallel=%(parallel)-12s Select parallel backend, fork or threads
+  --chunksize=%(chunksize)-11s Set minimum number of elements per parallel chunk
+  --nplans=%(nplans)-14s Set number of integration plans kept per topology
   --outrootdir=%(outrootdir)-10s Define the root directory for output
   --outdir=               Define custom directory for output
   --verbose=%(verbose)-13s Set verbosity level, 9=all
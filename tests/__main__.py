@@ -10,8 +10,13 @@ from . import \
   quadrature, \
   element,    \
   numeric,    \
+  matrix,     \
   basis,      \
   finitecell, \
+  parallel,   \
+  progress,   \
+  properties, \
+  plot,       \
   runtests
 
 runtests()
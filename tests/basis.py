@@ -45,3 +45,59 @@ def basis( btype, degree, ndims=None ):
     projection = domain.projection( target, onto=basis, geometry=geom, ischeme=gauss, droptol=0 )
     error = numpy.sqrt( domain.integrate( (target-projection)**2, geometry=geom, ischeme=gauss ) )
     numpy.testing.assert_almost_equal( error, 0, decimal=12 )
+
+@register
+def tensorbasis():
+
+  domain, geom = mesh.rectilinear( [[0,1,2,3,4],[0,1,2,3]], periodic=[0] )
+
+  @unittest
+  def dofs():
+    basis = domain.basis( 'spline', degree=2, removedofs=[None,[0,4]] )
+    numbers = numpy.arange(4)[:,_] * 3 + numpy.array([ -1, 0, 1, 2, -1 ])
+    numbers[:,[0,4]] = -1
+    numbers = numbers[[0,1,2,3,0,1]]
+    (axes,func), = function.blocks( basis )
+    for ielem, elem in enumerate( domain ):
+      i, j = divmod( ielem, 3 )
+      expect = numbers[i:i+3,j:j+3].ravel()
+      numpy.testing.assert_array_equal( axes[0].eval( elem ).ravel(), expect[expect>=0] )
+
+  @unittest
+  def shared():
+    basis = domain.basis( 'spline', degree=2 )
+    (axes,func), = function.blocks( basis )
+    stds = { id(func.stdmap[elem.transform][0][0]) for elem in domain }
+    assert len(stds) == 3 # periodic x open: 1 x 3 distinct elements
+
+  @unittest
+  def pum():
+    basis = domain.basis( 'bspline', degree=2 )
+    error = numpy.sqrt( domain.integrate( (1-basis.sum(0))**2, geometry=geom, ischeme='gauss4' ) )
+    numpy.testing.assert_almost_equal( error, 0, decimal=14 )
+
+@register
+def indexed():
+
+  domain, geom = mesh.rectilinear( [[0,1,2,3],[0,1,2]] )
+
+  @unittest
+  def csrtable():
+    table = function.CSRTable.fromrows( [[0,1],[],[2,3,4]] )
+    numpy.testing.assert_array_equal( table.offsets, [0,2,2,5] )
+    numpy.testing.assert_array_equal( table[2], [2,3,4] )
+    assert len(table) == 3 and len(table[1]) == 0
+
+  @unittest
+  def sharedindex():
+    funcs = function.outer( domain.basis( 'spline', degree=2 ), domain.basis( 'discont', degree=1 ) )
+    ops, inds = funcs.serialized
+    assert sum( isinstance( op, function.ElemIndex ) for op in ops ) == 1
+
+  @unittest
+  def take():
+    basis = domain.basis( 'discont', degree=1 )
+    (axes,func), = function.blocks( basis[1::2] )
+    assert isinstance( func.stdmap, function.IndexedMap )
+    values = domain.elem_eval( basis, ischeme='gauss2' )
+    numpy.testing.assert_array_almost_equal( domain.elem_eval( basis[1::2], ischeme='gauss2' ), values[:,1::2], decimal=15 )
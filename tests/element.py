@@ -26,3 +26,47 @@ def elem( *ndims ):
     @unittest
     def ribbons():
       ref.ribbons
+
+@register( 'square', 2 )
+@register( 'hexagon', 3 )
+def polyproduct( ndims ):
+
+  ref = element.getsimplex(1)**ndims
+  line = element.PolyLine( element.PolyLine.bernstein_poly(3) )
+  std = line**ndims
+
+  def check( points, grad ):
+    F = std.eval( points, grad )
+    assert F.shape == points.shape[:-1] + (4**ndims,) + (ndims,)*grad
+    for ishape, index in enumerate( numpy.ndindex( (4,)*ndims ) ):
+      f = [ line.eval( points[:,i:i+1], 0 )[:,n] for i, n in enumerate(index) ]
+      df = [ line.eval( points[:,i:i+1], 1 )[:,n,0] for i, n in enumerate(index) ]
+      numpy.testing.assert_array_almost_equal( F[:,ishape] if grad == 0
+        else F[:,ishape,0], numpy.product( [df[0]] + f[1:] if grad else f, axis=0 ), decimal=14 )
+
+  def checkcontract( points, grad ):
+    coeffs = numpy.random.RandomState( 0 ).uniform( size=(4**ndims,3) )
+    numpy.testing.assert_array_almost_equal( std.contract( points, coeffs, grad ),
+      numpy.einsum( 'pi...,ik->pk...', std.eval( points, grad ), coeffs ), decimal=13 )
+
+  @unittest
+  def tensorpoints():
+    points, weights = ref.getischeme( 'gauss4' )
+    assert element._tensorfactors( points[:,:1], points[:,1:] ) is not None
+    check( points, 0 )
+    check( points, 1 )
+
+  @unittest
+  def tensorcontract():
+    points, weights = ref.getischeme( 'gauss4' )
+    for grad in range( 3 ):
+      checkcontract( points, grad )
+
+  @unittest
+  def scatteredpoints():
+    numpy.random.seed( 0 )
+    points = numpy.random.uniform( size=(10,ndims) )
+    assert element._tensorfactors( points[:,:1], points[:,1:] ) is None
+    check( points, 0 )
+    check( points, 1 )
+    checkcontract( points, 1 )
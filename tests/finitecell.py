@@ -47,6 +47,19 @@ def hierarchical():
       with plot.PyPlot( 'basis' ) as plt:
         plt.plot( x, y )
 
+  @unittest
+  def sharedlevels():
+    ref1.basis( 'std', degree=1 )
+    ref2.basis( 'std', degree=1 )
+    assert ref1.basetopo.levels[1] is ref2.basetopo.levels[1]
+    coarse = ref0.refined_by( [e1] ) # reuses level data of ref2
+    basis = coarse.basis( 'std', degree=1 )
+    fresh0, freshgeom = mesh.rectilinear( [[0,1,2]] )
+    fresh = fresh0.refined_by( list(fresh0)[:1] )
+    freshbasis = fresh.basis( 'std', degree=1 )
+    assert basis.shape == freshbasis.shape == (4,)
+    numpy.testing.assert_array_equal( coarse.elem_eval( basis, ischeme='bezier2' ), fresh.elem_eval( freshbasis, ischeme='bezier2' ) )
+
 
 @register
 def hierarchicalboundary():
@@ -191,6 +204,12 @@ def cutdomain( ndims, nelems, maxrefine, errtol ):
     assert trimerr < errtol, 'trim surface tolerance not met: {:.2e} > {:.2e}'.format( trimerr, errtol )
     assert totalerr < errtol, 'total surface tolerance not met: {:.2e} > {:.2e}'.format( totalerr, errtol )
 
+  @unittest
+  def parallel():
+    __nprocs__ = 3
+    partrim = domain.trim( levelset=levelset, maxrefine=maxrefine )
+    assert [ elem.reference for elem in partrim ] == [ elem.reference for elem in pos ]
+
 
 @register
 def multitrim():
@@ -203,3 +222,39 @@ def multitrim():
     numpy.testing.assert_almost_equal( L, 1.4, decimal=4 )
   L = domain.boundary.integrate( 1, geometry=geom, ischeme='gauss1' )
   numpy.testing.assert_almost_equal( L, 5.6, decimal=4 )
+
+@register
+def cutconfigurations():
+  domain, geom = mesh.rectilinear( [numpy.linspace(0,1,5)]*2 )
+  pos = domain.trim( geom[0]-.375, maxrefine=1 )
+  refs = set( elem.reference for elem in pos )
+
+  @unittest
+  def shared():
+    assert len(refs) == 2
+
+  @unittest
+  def persistent():
+    schemes = [ ref.getischeme( 'gauss3' ) for ref in refs ]
+    area = pos.integrate( 1, geometry=geom, ischeme='gauss3' )
+    numpy.testing.assert_almost_equal( area, .625 )
+    for ref, (points, weights) in zip( refs, schemes ):
+      assert ref.getischeme( 'gauss3' )[0] is points
+
+@register
+def momentfitting():
+  domain, geom = mesh.rectilinear( [numpy.linspace(-1,1,5)]*2 )
+  pos = domain.trim( .7-(geom**2).sum(-1), maxrefine=2 )
+  func = geom[0]**2 * geom[1] + geom[1]**2
+
+  @unittest
+  def exact():
+    numpy.testing.assert_almost_equal(
+      pos.integrate( func, geometry=geom, ischeme='moment2' ),
+      pos.integrate( func, geometry=geom, ischeme='gauss6' ), decimal=14 )
+
+  @unittest
+  def npoints():
+    for elem in pos:
+      points, weights = elem.reference.getischeme( 'moment2' )
+      assert points.shape == ( 9, 2 ) and weights.shape == ( 9, )
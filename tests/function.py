@@ -203,3 +203,134 @@ def check( op, n_op, shapes, hasgrad=True ):
     numpy.testing.assert_array_almost_equal(
       n_op( *opposite_args.eval(iface,ifpoints) ),
         function.opposite( op( *args ) ).eval(iface,ifpoints), decimal=15 )
+
+@register
+def elemeval():
+
+  domain, geom = mesh.rectilinear( [[0,1,2,3]]*2 )
+  basis = domain.basis( 'spline', degree=2 )
+  func = function.Tuple([ basis.grad(geom), function.J(geom,2), ( basis * geom[0] ).sum(0), function.PointShape() ])
+
+  @unittest
+  def consistent():
+    elems = list( domain )
+    for ielem, weights, values in func.elemeval( enumerate(elems), 'gauss3' ):
+      points, weights_ = elems[ielem].reference.getischeme( 'gauss3' )
+      numpy.testing.assert_array_equal( weights, weights_ )
+      for value, expect in zip( values, func.eval( elems[ielem], 'gauss3' ) ):
+        numpy.testing.assert_array_almost_equal( value, expect, decimal=15 )
+
+  @unittest
+  def elemindex():
+    elems = list( domain )
+    for ielem, weights, values in func.elemeval( enumerate(elems), 'gauss3', edict=domain.edict ):
+      for value, expect in zip( values, func.eval( elems[ielem], 'gauss3' ) ):
+        numpy.testing.assert_array_almost_equal( value, expect, decimal=15 )
+    elemindex = function.ElemIndex( domain.edict )
+    trans = elems[1].transform, elems[1].opposite
+    assert elemindex.plan.evaluate( cache.WrapperDummyCache(), trans, None )[1] == 1
+    assert elemindex.plan.evaluate( cache.WrapperDummyCache(), trans, None, (domain.edict,3) )[1] == 3, 'element index not taken from loop'
+
+  @unittest
+  def explicitpoints():
+    elems = list( domain )
+    ischeme = { elem: elem.reference.getischeme( 'gauss3' )[0].copy() for elem in elems }
+    for ielem, weights, values in func.elemeval( enumerate(elems), ischeme ):
+      for value, expect in zip( values, func.eval( elems[ielem], ischeme[elems[ielem]] ) ):
+        numpy.testing.assert_array_almost_equal( value, expect, decimal=15 )
+
+@register
+def plan():
+
+  domain, geom = mesh.rectilinear( [[0,1,2]]*2 )
+  basis = domain.basis( 'spline', degree=2 )
+  func = function.Tuple([ basis.grad(geom), ( basis * geom[0] ).sum(0) ])
+  elem = next( iter( domain ) )
+
+  @unittest
+  def serialized():
+    ops, inds = func.serialized
+    assert len( set( ops ) ) == len( ops ), 'duplicate operations'
+    assert len( inds ) == len( ops ) + 1
+
+  @unittest
+  def release():
+    plan = func.plan
+    released = [ i for release in plan.release for i in release ]
+    assert sorted( released ) == list( range( len(function.TOKENS), len(function.TOKENS)+len(plan.ops)-1 ) ), 'every intermediate value should be released exactly once'
+    assert plan.peak < len( plan.ops )
+
+  @unittest
+  def evaluate():
+    points, weights = elem.reference.getischeme( 'gauss2' )
+    values = func.plan.evaluate( cache.WrapperDummyCache(), (elem.transform,elem.opposite), points )
+    for value, f in zip( values, func ):
+      numpy.testing.assert_array_almost_equal( value, f.eval( elem, points ), decimal=15 )
+
+@register
+def optimize():
+
+  domain, geom = mesh.rectilinear( [[0,1,2]]*2 )
+  basis = domain.basis( 'spline', degree=2 )
+  a, b, c = geom[0], function.sin( geom[1] ), function.exp( geom[0] )
+
+  @unittest
+  def multiply():
+    f1 = ( a * b ) * c
+    f2 = a * ( c * b )
+    assert f1 is not f2
+    assert function.optimize( f1 ) is function.optimize( f2 )
+
+  @unittest
+  def add():
+    f1 = ( a + b ) + c
+    f2 = ( c + a ) + b
+    assert function.optimize( f1 ) is function.optimize( f2 )
+
+  @unittest
+  def dot():
+    s, e, o = function.sin( geom ), function.exp( geom ), function.cos( geom )
+    f1 = function.dot( s * e, o, axes=[0] )
+    f2 = function.dot( s, o * e, axes=[0] )
+    assert isinstance( f1, function.Dot ) and f1 is not f2
+    assert function.optimize( f1 ) is function.optimize( f2 )
+
+  @unittest
+  def creationorder():
+    assert ( a + c ).funcs == ( c + a ).funcs == ( a, c )
+
+  @unittest
+  def shared():
+    f1 = ( a * b * c * basis ).grad( geom )
+    f2 = ( ( c * b ) * a * basis ).grad( geom )
+    nops = len( function.Tuple([ f1, f2 ]).serialized[0] )
+    nopt = len( function.Tuple([ function.optimize(f1), function.optimize(f2) ]).serialized[0] )
+    assert nopt < nops
+
+  @unittest
+  def functiondot():
+    u = basis.dot( numpy.arange( len(basis), dtype=float ) )
+    for f in u, u.grad( geom ), u * c, u.grad( geom ) * c:
+      fopt = function.optimize( f )
+      assert any( isinstance( op, function.FunctionDot ) for op in fopt.serialized[0] + (fopt,) )
+      for ischeme in 'gauss4', 'uniform2':
+        numpy.testing.assert_array_almost_equal( domain.elem_eval( fopt, ischeme=ischeme ), domain.elem_eval( f, ischeme=ischeme ), decimal=12 )
+
+  @unittest
+  def functiondot_factorized():
+    domain, geom = mesh.rectilinear( [[0,1,2]]*3 )
+    basis = domain.basis( 'spline', degree=4 )
+    u = basis.dot( numpy.arange( len(basis), dtype=float ) )
+    f = u.grad( geom ).sum( 0 )
+    fopt = function.optimize( f )
+    elem = next( iter( domain ) )
+    points, weights = elem.reference.getischeme( 'gauss8' )
+    assert len(points) * 5**3 > function.FunctionDot.maxtable
+    numpy.testing.assert_array_almost_equal( fopt.eval( elem, 'gauss8' ), f.eval( elem, 'gauss8' ), decimal=10 )
+
+  @unittest
+  def integrate():
+    f = ( a * b ) * c * basis + basis * c * a
+    numpy.testing.assert_array_almost_equal(
+      domain.integrate( f, geometry=geom, ischeme='gauss3' ),
+      domain.integrate( ( b + 1 ) * ( c * a ) * basis, geometry=geom, ischeme='gauss3' ), decimal=14 )
@@ -63,3 +63,36 @@ def check():
     _test( ref, 'uniform1', [[.5,1/3.,1/3.]], [.5] )
     _test( ref, 'uniform2', [[.25,1/6.,1/6.],[.25,1/6.,2/3.],[.25,2/3.,1/6.],[.25,1/3.,1/3.],[.75,1/6.,1/6.],[.75,1/6.,2/3.],[.75,2/3.,1/6.],[.75,1/3.,1/3.]], [1/16.]*8 )
     _test( ref, 'uniform1*gauss2', [[.5,2/3.,1/6.],[.5,1/6.,2/3.],[.5,1/6.,1/6.]], [1/6.]*3 )
+
+@register
+def persistent():
+
+  @unittest
+  def cached():
+    ref = element.getsimplex(1)**2
+    points, weights = ref.getischeme( 'gauss3' )
+    assert not points.flags.writeable and not weights.flags.writeable
+    points_, weights_ = ref.getischeme( 'gauss3' )
+    assert points_ is points and weights_ is weights
+
+  @unittest
+  def tabulated():
+    domain, geom = mesh.rectilinear( [[0,1,2]]*2 )
+    basis = domain.basis( 'spline', degree=2 )
+    elem = next( iter( domain ) )
+    points, weights = elem.reference.getischeme( 'gauss3' )
+    F1 = basis.eval( elem, 'gauss3' )
+    F2 = basis.eval( elem, points.copy() )
+    numpy.testing.assert_array_almost_equal( F1, F2, decimal=15 )
+
+  @unittest
+  def bounded():
+    __ntables__ = 4
+    domain, geom = mesh.rectilinear( [[0,1,2]]*2 )
+    for degree in range( 1, 7 ):
+      basis = domain.basis( 'spline', degree=degree )
+      for elem in domain:
+        basis.eval( elem, 'gauss3' )
+        assert len( function._tables ) <= 4
+    F = basis.eval( elem, elem.reference.getischeme( 'gauss3' )[0].copy() )
+    numpy.testing.assert_array_almost_equal( basis.eval( elem, 'gauss3' ), F, decimal=15 )
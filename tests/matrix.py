@@ -0,0 +1,175 @@
+from nutils import *
+from . import register, unittest
+import scipy.sparse
+
+@register
+def assemble():
+
+  numpy.random.seed( 0 )
+  shape = 7, 5
+  index = numpy.array([ numpy.random.randint( 0, n, 40 ) for n in shape ])
+  data = numpy.random.normal( size=40 )
+  expected = scipy.sparse.coo_matrix( (data,index), shape ).toarray()
+
+  @unittest
+  def sparse():
+    A = matrix.assemble( data, index, shape )
+    assert isinstance( A, matrix.ScipyMatrix )
+    numpy.testing.assert_array_almost_equal( A.toarray(), expected, decimal=15 )
+
+  @unittest
+  def dense():
+    A = matrix.assemble( data, index, shape, force_dense=True )
+    assert isinstance( A, matrix.NumpyMatrix )
+    numpy.testing.assert_array_almost_equal( A.toarray(), expected, decimal=15 )
+
+  @unittest
+  def flat():
+    A = matrix.assemble( data, numpy.ravel_multi_index( index, shape ), shape )
+    numpy.testing.assert_array_almost_equal( A.toarray(), expected, decimal=15 )
+
+  @unittest
+  def pattern():
+    pattern = matrix.SparsityPattern( numpy.ravel_multi_index( index, shape ), shape )
+    assert pattern.nnz == numpy.count_nonzero( expected )
+    A = pattern.assemble( data )
+    B = pattern.assemble( 2 * data )
+    assert numpy.may_share_memory( A.core.indices, B.core.indices )
+    numpy.testing.assert_array_almost_equal( B.toarray(), 2 * expected, decimal=15 )
+
+@register
+def multigrid():
+
+  domain, geom = mesh.rectilinear( [ numpy.linspace(0,1,5) ]*2 )
+  topos = domain.refined.refined, domain.refined, domain
+  bases = [ topo.basis( 'std', degree=1 ) for topo in topos ]
+  fine, basis = topos[0], bases[0]
+  A = fine.integrate( function.outer( basis.grad(geom) ).sum(-1), geometry=geom, ischeme='gauss2' )
+  b = fine.integrate( basis, geometry=geom, ischeme='gauss2' )
+  cons = fine.boundary.project( 0, onto=basis, geometry=geom, ischeme='gauss2' )
+  x0 = A.solve( b, constrain=cons )
+
+  @unittest
+  def prolongation():
+    for finebasis, coarsebasis in zip( bases[:-1], bases[1:] ):
+      P = fine.prolongation( coarsebasis, finebasis, ischeme='gauss2' )
+      assert P.shape == ( len(finebasis), len(coarsebasis) )
+      coarsevals, finevals = fine.elem_eval( [ coarsebasis, finebasis ], ischeme='gauss2' )
+      numpy.testing.assert_array_almost_equal( finevals.dot( P.toarray() ), coarsevals, decimal=14 )
+
+  @unittest
+  def solve():
+    Ps = [ fine.prolongation( coarsebasis, finebasis, ischeme='gauss2' ) for finebasis, coarsebasis in zip( bases[:-1], bases[1:] ) ]
+    x, info = A.solve( b, constrain=cons, tol=1e-10, solver='cg', precon=matrix.Multigrid( Ps ), info=True )
+    x_diag, info_diag = A.solve( b, constrain=cons, tol=1e-10, solver='cg', precon='diag', info=True )
+    numpy.testing.assert_array_almost_equal( x, x0, decimal=10 )
+    assert info.niter < info_diag.niter / 2
+
+  @unittest
+  def fromlevels():
+    precon = matrix.Multigrid.fromlevels( topos[::-1], dict( name='std', degree=1 ), ischeme='gauss2' )
+    assert len( precon.prolongators ) == 2
+    x, info = A.solve( b, constrain=cons, tol=1e-10, solver='cg', precon=precon, info=True )
+    numpy.testing.assert_array_almost_equal( x, x0, decimal=10 )
+
+  @unittest
+  def hierarchical():
+    hierarchical = domain.hierarchical( domain.refined.refined.elements )
+    basis = hierarchical.basis( 'std', degree=1 )
+    A = hierarchical.integrate( function.outer( basis.grad(geom) ).sum(-1), geometry=geom, ischeme='gauss2' )
+    b = hierarchical.integrate( basis, geometry=geom, ischeme='gauss2' )
+    cons = hierarchical.boundary.project( 0, onto=basis, geometry=geom, ischeme='gauss2' )
+    precon = matrix.Multigrid.fromlevels( hierarchical.basetopo.levels, dict( name='std', degree=1 ), ischeme='gauss2' )
+    x, info = A.solve( b, constrain=cons, tol=1e-10, solver='cg', precon=precon, info=True )
+    numpy.testing.assert_array_almost_equal( x, A.solve( b, constrain=cons ), decimal=10 )
+
+@register
+def blockschur():
+
+  domain, geom = mesh.rectilinear( [ numpy.linspace(0,1,5) ]*2 )
+  nu = 2 * len( domain.basis( 'std', degree=2 ) )
+  ubasis, pbasis = function.chain([ domain.basis( 'std', degree=2 ).vector(2), domain.basis( 'std', degree=1 ) ])
+  A = domain.integrate( function.outer( ubasis.grad(geom) ).sum([2,3]) - function.outer( ubasis.div(geom), pbasis ) - function.outer( pbasis, ubasis.div(geom) ), geometry=geom, ischeme='gauss4' )
+  b = domain.integrate( ubasis[:,0], geometry=geom, ischeme='gauss4' )
+  cons = domain.boundary.project( 0, onto=ubasis, geometry=geom, ischeme='gauss4' )
+  cons[-1] = 0
+  x0 = A.solve( b, constrain=cons )
+
+  @unittest
+  def slicing():
+    x, info = A.solve( b, constrain=cons, tol=1e-10, precon=matrix.BlockSchur( slice(nu) ), info=True )
+    numpy.testing.assert_array_almost_equal( x, x0, decimal=8 )
+    assert info.niter < 25
+
+  @unittest
+  def mask():
+    x = A.solve( b, constrain=cons, tol=1e-10, precon=matrix.BlockSchur( numpy.arange( len(b) ) < nu, precon='spilu' ) )
+    numpy.testing.assert_array_almost_equal( x, x0, decimal=8 )
+
+@register
+def amg():
+
+  def laplace( nelems ):
+    domain, geom = mesh.rectilinear( [ numpy.linspace(0,1,nelems+1) ]*2 )
+    domain = domain.simplex
+    basis = domain.basis( 'std', degree=1 )
+    A = domain.integrate( function.outer( basis.grad(geom) ).sum(-1), geometry=geom, ischeme='gauss2' )
+    b = domain.integrate( basis, geometry=geom, ischeme='gauss2' )
+    cons = domain.boundary.project( 0, onto=basis, geometry=geom, ischeme='gauss2' )
+    return A, b, cons
+
+  @unittest
+  def name():
+    A, b, cons = laplace( 16 )
+    x, info = A.solve( b, constrain=cons, tol=1e-10, solver='cg', precon='amg', info=True )
+    numpy.testing.assert_array_almost_equal( x, A.solve( b, constrain=cons ), decimal=10 )
+
+  @unittest
+  def meshindependent():
+    niters = []
+    for nelems in 8, 16, 32:
+      A, b, cons = laplace( nelems )
+      x, info = A.solve( b, constrain=cons, tol=1e-10, solver='cg', precon=matrix.AMG( maxcoarse=16 ), info=True )
+      numpy.testing.assert_array_almost_equal( x, A.solve( b, constrain=cons ), decimal=10 )
+      niters.append( info.niter )
+    assert max( niters ) < 15, niters
+
+  @unittest
+  def reuse():
+    A, b, cons = laplace( 16 )
+    precon = matrix.AMG( maxcoarse=16 )
+    A.solve( b, constrain=cons, tol=1e-10, solver='cg', precon=precon )
+    aggregates = precon.aggregates
+    assert len( aggregates ) == 2
+    x = ( 2 * A ).solve( b, constrain=cons, tol=1e-10, solver='cg', precon=precon )
+    assert precon.aggregates is aggregates
+    numpy.testing.assert_array_almost_equal( x, A.solve( .5 * b, constrain=cons ), decimal=10 )
+
+  @unittest
+  def reusename():
+    A, b, cons = laplace( 16 )
+    A.solve( b, constrain=cons, tol=1e-10, solver='cg', precon='amg' )
+    aggregates = A._amg.aggregates
+    A.core.data *= 2 # as by assembly in place
+    x = A.solve( b, constrain=cons, tol=1e-10, solver='cg', precon='amg' )
+    assert A._amg.aggregates is aggregates
+    numpy.testing.assert_array_almost_equal( x, A.solve( b, constrain=cons ), decimal=10 )
+
+  @unittest
+  def unshared():
+    A, b, cons = laplace( 16 )
+    A.solve( b, constrain=cons, tol=1e-10, solver='cg', precon='amg' )
+    B = 2 * A
+    B.solve( b, constrain=cons, tol=1e-10, solver='cg', precon='amg' )
+    assert B._amg is not A._amg
+    assert not hasattr( matrix, '_amg' )
+
+  @unittest
+  def aggregate():
+    A, b, cons = laplace( 16 )
+    A = A.toscipy().tocsr()
+    aggregates = matrix._aggregate( A, .08 )
+    naggregates = aggregates.max() + 1
+    assert numpy.bincount( aggregates ).min() > 0 and naggregates < A.shape[0] / 4
+    connected = scipy.sparse.csr_matrix( ( numpy.ones( A.nnz ), aggregates[ A.indices ], A.indptr ), shape=( A.shape[0], naggregates ) )
+    assert ( connected.toarray()[ numpy.arange( A.shape[0] ), aggregates ] > 0 ).all() # every dof couples to its aggregate
@@ -0,0 +1,109 @@
+from nutils import *
+from . import register, unittest
+import functools, time
+
+@register( 'fork', 'fork' )
+@register( 'threads', 'threads' )
+def check( backend ):
+
+  domain, geom = mesh.rectilinear( [numpy.linspace(0,1,7)]*2 )
+  basis = domain.basis( 'spline', degree=2 )
+  __parallel__ = backend
+
+  @unittest
+  def integrate():
+    func = function.outer( basis.grad(geom) ).sum(-1)
+    serial = domain.integrate( func, geometry=geom, ischeme='gauss4' ).toarray()
+    __nprocs__ = 3
+    parallel_ = domain.integrate( func, geometry=geom, ischeme='gauss4' ).toarray()
+    numpy.testing.assert_array_almost_equal( serial, parallel_, decimal=15 )
+
+  @unittest
+  def elem_eval():
+    serial = domain.elem_eval( basis, ischeme='gauss2', separate=False )
+    __nprocs__ = 3
+    parallel_ = domain.elem_eval( basis, ischeme='gauss2', separate=False )
+    numpy.testing.assert_array_almost_equal( serial, parallel_, decimal=15 )
+
+  @unittest
+  def parmap():
+    __nprocs__ = 3
+    values = parallel.parmap( lambda x: x**2, range(20) )
+    numpy.testing.assert_array_equal( values, numpy.arange(20)**2 )
+
+  @unittest
+  def unsized():
+    __nprocs__ = 3
+    out = parallel.shzeros( 50, dtype=int )
+    def square( items ):
+      for i in items:
+        out[i] += i**2
+    parallel.parexec( square, ( i for i in range(50) ) )
+    numpy.testing.assert_array_equal( out, numpy.arange(50)**2 )
+
+@register
+def threads():
+
+  __parallel__ = 'threads'
+  __nprocs__ = 3
+
+  @unittest
+  def nested():
+    out = parallel.shzeros( (10,10), dtype=int )
+    def inner( i, items ):
+      for j in items:
+        out[i,j] = i * j
+    def outer( items ):
+      for i in items:
+        parallel.parexec( functools.partial( inner, i ), range(10) )
+    parallel.parexec( outer, range(10) )
+    numpy.testing.assert_array_equal( out, numpy.arange(10)[:,_] * numpy.arange(10) )
+
+  @unittest
+  def logcontext():
+    __log__ = log.CaptureLog()
+    @log.title
+    def work( i ):
+      time.sleep( .001 )
+      log.info( i )
+    def worker( items ):
+      for i in items:
+        work( i, title='work%d' % i )
+    __log__.push( 'main' )
+    parallel.parexec( worker, range(30) )
+    assert __log__.context == [ 'main' ]
+    assert sorted( __log__.lines ) == sorted( 'main > work%d > %d' % ( i, i ) for i in range(30) ), __log__.lines
+
+  @unittest
+  def progress():
+    __log__ = log.CaptureLog()
+    out = parallel.shzeros( 30, dtype=int )
+    def worker( items ):
+      for i in items:
+        time.sleep( .001 )
+        out[i] = len( __log__.context )
+    __log__.push( 'main' )
+    parallel.parexec( worker, log.range( 'item', 30 ) )
+    assert __log__.context == [ 'main' ], __log__.context
+    assert ( out == 2 ).all()
+
+@register
+def chunksize():
+
+  @unittest
+  def guided():
+    sizes = []
+    start = 0
+    while start < 100:
+      size = parallel._chunksize( start, 100, 4 )
+      sizes.append( size )
+      start += size
+    assert sizes[0] == 12 and sizes[-1] == 1
+    assert all( a >= b for a, b in zip( sizes[:-1], sizes[1:] ) )
+
+  @unittest
+  def unknown():
+    assert parallel._chunksize( 0, None, 4 ) == 1
+    __chunksize__ = 5
+    assert parallel._chunksize( 0, None, 4 ) == 5
+    assert parallel._chunksize( 98, 100, 4 ) == 5
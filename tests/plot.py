@@ -0,0 +1,113 @@
+from nutils import *
+from . import register, unittest
+import tempfile, zlib, os, re
+
+def _readvtu( path ):
+  with open( path, 'rb' ) as f:
+    head, data = f.read().split( b'<AppendedData encoding="raw">\n_', 1 )
+  dtypes = { b'Float64': numpy.float64, b'Int32': numpy.int32, b'UInt8': numpy.uint8 }
+  arrays = {}
+  for dtype, name, ncomp, offset in re.findall( b'<DataArray type="(\\w+)"(?: Name="(\\w+)")? NumberOfComponents="(\\d+)" format="appended" offset="(\\d+)"/>', head ):
+    offset = int(offset)
+    if b'vtkZLibDataCompressor' in head:
+      nblocks, blocksize, lastsize = numpy.frombuffer( data, dtype=numpy.uint64, count=3, offset=offset )
+      sizes = numpy.frombuffer( data, dtype=numpy.uint64, count=int(nblocks), offset=offset+24 )
+      offsets = offset + 24 + 8 * int(nblocks) + numpy.concatenate([ [0], numpy.cumsum( sizes, dtype=int ) ])
+      raw = b''.join( zlib.decompress( data[i:j] ) for i, j in zip( offsets[:-1], offsets[1:] ) )
+    else:
+      nbytes, = numpy.frombuffer( data, dtype=numpy.uint64, count=1, offset=offset )
+      raw = data[offset+8:offset+8+int(nbytes)]
+    arrays[ name.decode() or 'Points' ] = numpy.frombuffer( raw, dtype=dtypes[dtype] ).reshape( -1, int(ncomp) )
+  return arrays
+
+@register
+def streamvtu():
+
+  with tempfile.TemporaryDirectory() as __outdir__:
+    domain, geom = mesh.rectilinear( [ numpy.linspace(0,1,5), numpy.linspace(0,1,4) ] )
+    pointdata = { 'u': geom[0] * geom[1], 'v': geom }
+    celldata = { 'c': geom[0] }
+    topo = domain.simplex
+    points, u, v = topo.elem_eval( [ geom, pointdata['u'], pointdata['v'] ], ischeme='vtk' )
+    ncellpoints = [ len( elem.reference.getischeme('vtk')[0] ) for elem in topo ]
+    c, = topo.elem_mean( [ celldata['c'] ], geometry=geom, ischeme='gauss1' )
+
+    def check( name ):
+      arrays = _readvtu( os.path.join( __outdir__, name+'.vtu' ) )
+      numpy.testing.assert_array_almost_equal( arrays['Points'], numpy.concatenate( [ points, numpy.zeros_like(points[:,:1]) ], axis=1 ), decimal=15 )
+      numpy.testing.assert_array_equal( arrays['connectivity'].ravel(), numpy.arange( len(points) ) )
+      numpy.testing.assert_array_equal( arrays['offsets'].ravel(), numpy.cumsum( ncellpoints ) )
+      numpy.testing.assert_array_equal( arrays['types'].ravel(), 9 )
+      numpy.testing.assert_array_almost_equal( arrays['u'].ravel(), u, decimal=15 )
+      numpy.testing.assert_array_almost_equal( arrays['v'][:,:2], v, decimal=15 )
+      numpy.testing.assert_array_equal( arrays['v'][:,2], 0 )
+      numpy.testing.assert_array_almost_equal( arrays['c'].ravel(), c, decimal=15 )
+
+    @unittest
+    def raw():
+      plot.streamvtu( 'raw', domain, geom, pointdata, celldata, chunksize=5 )
+      check( 'raw' )
+
+    @unittest
+    def compressed():
+      plot.streamvtu( 'compressed', domain, geom, pointdata, celldata, compress=True, chunksize=5 )
+      check( 'compressed' )
+
+    @unittest
+    def blocks():
+      blocksize = plot._AppendedArray.blocksize
+      plot._AppendedArray.blocksize = 100
+      try:
+        plot.streamvtu( 'blocks', domain, geom, pointdata, celldata, compress=True, chunksize=5 )
+      finally:
+        plot._AppendedArray.blocksize = blocksize
+      check( 'blocks' )
+
+    @unittest
+    def background():
+      vtufile = plot.streamvtu( 'background', domain, geom, pointdata, celldata, background=True, chunksize=5 )
+      vtufile.wait()
+      check( 'background' )
+
+@register
+def writepvtu():
+
+  with tempfile.TemporaryDirectory() as __outdir__:
+    domain, geom = mesh.rectilinear( [ numpy.linspace(0,1,5), numpy.linspace(0,1,4) ] )
+    pointdata = { 'u': geom[0] * geom[1] }
+    celldata = { 'c': geom }
+    topo = domain.simplex
+    points, u = topo.elem_eval( [ geom, pointdata['u'] ], ischeme='vtk' )
+    c, = topo.elem_mean( [ celldata['c'] ], geometry=geom, ischeme='gauss1' )
+
+    def check( name, nparts ):
+      with open( os.path.join( __outdir__, name+'.pvtu' ) ) as f:
+        pvtu = f.read()
+      assert '<PDataArray type="Float64" Name="u" NumberOfComponents="1"/>' in pvtu
+      assert '<PDataArray type="Float64" Name="c" NumberOfComponents="3"/>' in pvtu
+      pieces = re.findall( '<Piece Source="(.*)"/>', pvtu )
+      assert len( pieces ) == nparts
+      arrays = [ _readvtu( os.path.join( __outdir__, piece ) ) for piece in pieces ]
+      numpy.testing.assert_array_almost_equal( numpy.concatenate([ a['Points'][:,:2] for a in arrays ]), points, decimal=15 )
+      numpy.testing.assert_array_almost_equal( numpy.concatenate([ a['u'].ravel() for a in arrays ]), u, decimal=15 )
+      numpy.testing.assert_array_almost_equal( numpy.concatenate([ a['c'][:,:2] for a in arrays ]), c, decimal=15 )
+      for a in arrays:
+        numpy.testing.assert_array_equal( a['connectivity'].ravel(), numpy.arange( len(a['Points']) ) )
+
+    @unittest
+    def serial():
+      plot.writepvtu( 'serial', domain, geom, pointdata, celldata, nparts=3, chunksize=2 )
+      check( 'serial', 3 )
+
+    @unittest
+    def parallel():
+      __nprocs__ = 3
+      plot.writepvtu( 'parallel', domain, geom, pointdata, celldata, compress=True, chunksize=2 )
+      check( 'parallel', 3 )
+
+    @unittest
+    def threads():
+      __nprocs__ = 2
+      __parallel__ = 'threads'
+      plot.writepvtu( 'threads', domain, geom, pointdata, celldata )
+      check( 'threads', 2 )
@@ -0,0 +1,54 @@
+from nutils import *
+from . import register, unittest
+
+@register
+def iterate():
+
+  @unittest
+  def index():
+    progress = log.range( 'item', 100 )
+    assert list( progress ) == list( range( 100 ) )
+    assert progress.index == 100
+    assert progress.rate > 0
+
+  @unittest
+  def context():
+    __log__ = log.CaptureLog()
+    for i, item in log.enumerate( 'item', 'abc' ):
+      assert __log__.context[-1].startswith( 'item ' )
+      log.info( item )
+    assert not __log__.context
+    assert __log__.lines[0] == 'item 0/3 (-16%) > a', __log__.lines
+    assert [ line.split( ' > ' )[1] for line in __log__.lines ] == [ 'a', 'b', 'c' ], __log__.lines
+    assert all( line.startswith( 'item ' ) for line in __log__.lines ), __log__.lines
+
+  @unittest
+  def nested():
+    __log__ = log.CaptureLog()
+    for i in log.iter( 'outer', log.range( 'inner', 10 ) ):
+      assert len( __log__.context ) == 2, __log__.context
+      assert __log__.context[0].startswith( 'outer ' ) and __log__.context[1].startswith( 'inner ' ), __log__.context
+    assert not __log__.context
+
+  @unittest
+  def abandoned():
+    __log__ = log.CaptureLog()
+    @log.title
+    def loop():
+      items = iter( log.range( 'item', 10 ) ) # generator kept alive by the traceback
+      for i in items:
+        raise ValueError
+    try:
+      loop()
+    except ValueError:
+      pass
+    assert not __log__.context, __log__.context
+
+  @unittest
+  def sampled():
+    __progress_interval__ = 1e6
+    __log__ = log.CaptureLog()
+    for i in log.range( 'item', 1000 ):
+      pass
+    assert not __log__.lines
+    assert not __log__.context
@@ -0,0 +1,57 @@
+from nutils import *
+from . import register, unittest
+
+@register
+def properties():
+
+  __myval__ = 1
+
+  def get():
+    return core.getprop( 'myval', None )
+
+  @log.title
+  def titled():
+    return get()
+
+  @unittest
+  def local():
+    assert get() == 1
+    __myval__ = 2
+    assert get() == 2
+
+  @unittest
+  def context():
+    with core.properties( myval=2 ):
+      assert get() == 2
+      assert titled() == 2
+      with core.properties( myval=3 ):
+        assert get() == 3
+      assert get() == 2
+    assert get() == 1
+
+  @unittest
+  def nested():
+    def inner():
+      __myval__ = 3
+      return get(), titled()
+    with core.properties( myval=2 ):
+      assert inner() == ( 3, 3 )
+
+  @unittest
+  def getprops():
+    __other__ = 'a'
+    with core.properties( myval=2 ):
+      props = core.getprops()
+    assert props['myval'] == 2 and props['other'] == 'a'
+
+  @unittest
+  def threads():
+    __nprocs__ = 2
+    __parallel__ = 'threads'
+    values = []
+    def collect( items ):
+      for item in items:
+        values.append( get() )
+    with core.properties( myval=2 ):
+      parallel.parexec( collect, range(10) )
+    assert values == [ 2 ] * 10, values
@@ -1,7 +1,7 @@
 
 from nutils import *
 from . import register, unittest
-import numpy, copy, sys, pickle, subprocess, base64
+import numpy, copy, sys, pickle, subprocess, base64, weakref, gc
 
 grid = numpy.linspace( 0., 1., 4 )
 
@@ -208,3 +208,225 @@ def revolved():
     numpy.testing.assert_array_almost_equal( surf, 6*numpy.pi )
     wall = domain.boundary['right'].integrate( 1, geometry=geom, ischeme='gauss9' )
     numpy.testing.assert_array_almost_equal( wall, 4*numpy.pi )
+
+@register( 'nonrefined', nrefine=0 )
+@register( 'refined', nrefine=2 )
+def structured( nrefine ):
+
+  root = transform.roottrans( 'test', (3,0) )
+  axes = topology.DimAxis(0,3,True), topology.DimAxis(0,4,False)
+  domain = topology.StructuredTopology( root, axes, nrefine=nrefine )
+
+  def check( topo ):
+    lazy = [ ( elem.transform, elem.opposite ) for elem in topology.StructuredTopology( topo.root, topo.axes, topo.nrefine ) ]
+    assert lazy == list( zip( topo._transform.flat, topo._opposite.flat ) )
+    assert lazy == [ topo.transform_at( index ) for index in numpy.ndindex( *topo.shape ) ]
+
+  def checkindex( topo ):
+    topo = topology.StructuredTopology( topo.root, topo.axes, topo.nrefine )
+    reference = element.getsimplex(1)**topo.ndims
+    for ielem, index in enumerate( numpy.ndindex( *topo.shape ) ):
+      trans, opp = topo.transform_at( index )
+      assert topo.edict[trans] == ielem
+      assert trans.sliceto(-1) not in topo.edict
+      child = element.Element( reference, trans, opp ).children[-1]
+      assert child.transform.lookup( topo.edict ) == trans
+    assert '_transform' not in topo.__dict__
+
+  @unittest
+  def domain_lazy():
+    check( domain )
+
+  @unittest
+  def domain_index():
+    checkindex( domain )
+
+  @unittest
+  def boundary_index():
+    checkindex( domain.boundary['bottom'].basetopo )
+    checkindex( domain.boundary['top'].basetopo )
+
+  @unittest
+  def interfaces_index():
+    for topo in domain.interfaces['dir0'].basetopo._topos:
+      checkindex( topo )
+
+  @unittest
+  def boundary_lazy():
+    check( domain.boundary['bottom'].basetopo )
+    check( domain.boundary['top'].basetopo )
+
+  @unittest
+  def interfaces_lazy():
+    for topo in domain.interfaces['dir0'].basetopo._topos:
+      check( topo )
+
+  @unittest
+  def memoized():
+    topo = topology.StructuredTopology( root, axes, nrefine )
+    next( iter( topo ) )
+    assert '_transform' not in topo.__dict__
+    transforms = [ elem.transform for elem in topo ]
+    assert all( trans is memo for trans, memo in zip( transforms, topo._transform.flat ) )
+    assert topo._opposite is topo._transform
+
+@register
+def integrationplan():
+
+  domain, geom = mesh.rectilinear( [numpy.linspace(0,1,5)]*2 )
+  basis = domain.basis( 'spline', degree=2 )
+  lhs = numpy.arange( len(basis), dtype=float )
+  u = basis.dot( lhs )
+  laplace = function.outer( basis.grad(geom) ).sum(-1)
+  A, b = domain.integrate( [ laplace, basis * u ], geometry=geom, ischeme='gauss4' )
+
+  @unittest
+  def reuse():
+    domain.integrate( [ laplace * 2, basis * u**2 ], geometry=geom, ischeme='gauss4' )
+    plans = domain._integrationplans
+    assert len(plans) == 1
+    plan, = plans.values()
+    domain.integrate( [ laplace * 3, basis * u**3 ], geometry=geom, ischeme='gauss4' )
+    assert plans.popitem()[1] is plan
+
+  @unittest
+  def inplace():
+    A2, b2 = domain.integrate( [ laplace, basis * u ], geometry=geom, ischeme='gauss4' )
+    outA, outb = domain.integrate( [ laplace * 2, basis * u * 2 ], geometry=geom, ischeme='gauss4', out=[ A2, b2 ] )
+    assert outA is A2 and outb is b2
+    numpy.testing.assert_array_almost_equal( A2.toarray(), 2 * A.toarray(), decimal=14 )
+    numpy.testing.assert_array_almost_equal( b2, 2 * b, decimal=14 )
+
+  @unittest
+  def mismatch():
+    B = domain.integrate( function.outer( basis ), geometry=geom, ischeme='gauss4' )
+    try:
+      domain.boundary.integrate( function.outer( basis ), geometry=geom, ischeme='gauss4', out=B )
+    except AssertionError:
+      pass
+    else:
+      raise Exception( 'in place assembly into a different sparsity pattern should fail' )
+
+@register
+def locate():
+
+  domain, geom = mesh.rectilinear( [numpy.linspace(0,1,6)]*2 )
+  geom = geom + .05 * function.sin( numpy.pi * geom[::-1] )
+  numpy.random.seed( 0 )
+  points = numpy.random.uniform( .05, .95, size=(50,2) )
+
+  @unittest
+  def points_():
+    ptopo = domain.locate( geom, points )
+    located = ptopo.elem_eval( geom, ischeme='vertex', separate=False )
+    numpy.testing.assert_array_almost_equal( located, points, decimal=12 )
+
+  @unittest
+  def cached():
+    assert domain.boxindex( geom ) is domain.boxindex( geom )
+
+  @unittest
+  def released():
+    def scaled():
+      scaled = geom * 2
+      domain.boxindex( scaled )
+      return weakref.ref( scaled )
+    ref = scaled()
+    gc.collect()
+    assert ref() is None, 'box index keeps geometry alive'
+    assert geom in domain._boxindices
+
+  @unittest
+  def locatepoints():
+    located = domain.locatepoints( geom, points )
+    assert len( located ) == len( points )
+    x, one = located.eval([ geom, 1 ])
+    numpy.testing.assert_array_almost_equal( x, points, decimal=12 )
+    numpy.testing.assert_array_equal( one, 1 )
+
+  @unittest
+  def previous():
+    located = domain.locatepoints( geom, points )
+    moved = points + .02
+    relocated = domain.locatepoints( geom, moved, previous=located )
+    numpy.testing.assert_array_equal( relocated.ielems, domain.locatepoints( geom, moved ).ielems )
+    numpy.testing.assert_array_almost_equal( relocated.eval( geom ), moved, decimal=12 )
+
+  @unittest
+  def outside():
+    try:
+      domain.locate( geom, [[.5,1.5]] )
+    except Exception as e:
+      assert 'failed to locate point' in str(e.args[0])
+    else:
+      raise Exception( 'point outside domain was located' )
+
+  @unittest
+  def boxindex():
+    bboxes = numpy.array([ [[0,0],[1,1]], [[1,0],[2,1]], [[.5,.5],[1.5,1.5]] ])
+    candidates, ranks = topology.BoxIndex( bboxes ).candidates( [[.2,.2],[1.2,.8],[1.9,1.9]] )
+    assert candidates[ranks[0]:ranks[1]].tolist() == [[0,0],[1,2]]
+    assert candidates[ranks[1]:ranks[2]].tolist() == [[1,1]]
+    assert len(ranks) == 3
+
+@register( 'uniform', [numpy.linspace(0,1,5)]*2 )
+@register( 'nonuniform', [[0,.1,.3,1],[-1,0,.5,.6,2]] )
+def locate_rectilinear( richshape ):
+
+  domain, geom = mesh.rectilinear( richshape )
+  lo, hi = numpy.array([ (v[0],v[-1]) for v in richshape ]).T
+  numpy.random.seed( 0 )
+  points = lo + numpy.random.uniform( 0, 1, size=(50,2) ) * ( hi - lo )
+  points[0] = hi
+
+  @unittest
+  def grid():
+    grid = domain.basetopo.rectilineargrid( geom )
+    assert len(grid) == 2
+    for vertices, v in zip( grid, richshape ):
+      numpy.testing.assert_array_almost_equal( vertices, v, decimal=15 )
+
+  @unittest
+  def mapped():
+    assert domain.basetopo.rectilineargrid( geom + .1 * function.sin( geom[::-1] ) ) is None
+
+  @unittest
+  def released():
+    def scaled():
+      scaled = geom * 2
+      assert domain.basetopo.rectilineargrid( scaled ) is domain.basetopo.rectilineargrid( scaled )
+      return weakref.ref( scaled )
+    ref = scaled()
+    gc.collect()
+    assert ref() is None, 'rectilinear grid keeps geometry alive'
+
+  @unittest
+  def generic():
+    args = geom, points, 'vertex', 1, 1e-12, 0, 100
+    ielems, xis = domain.basetopo._locate( *args )
+    ielems_, xis_ = topology.Topology._locate( domain.basetopo, *args )
+    numpy.testing.assert_array_equal( ielems, ielems_ )
+    numpy.testing.assert_array_almost_equal( xis, xis_, decimal=12 )
+
+  @unittest
+  def eval():
+    x = domain.locatepoints( geom, points ).eval( geom )
+    numpy.testing.assert_array_almost_equal( x, points, decimal=12 )
+
+@register
+def locate_vertexmatch():
+
+  domain, geom = mesh.rectilinear( [numpy.linspace(0,1,5)]*2 )
+  geom = geom + .02 * function.sin( 8 * numpy.pi * geom ) # vanishes in all vertex1 points
+  points = numpy.array([ [.1,.3], [.6,.85], [.5,.5] ])
+
+  @unittest
+  def eval():
+    x = domain.locatepoints( geom, points ).eval( geom )
+    numpy.testing.assert_array_almost_equal( x, points, decimal=12 )
+
+  @unittest
+  def repeated():
+    for i in range( 2 ):
+      x = domain.locatepoints( geom, points ).eval( geom )
+      numpy.testing.assert_array_almost_equal( x, points, decimal=12 )